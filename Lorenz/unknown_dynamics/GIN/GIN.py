@@ -1,7 +1,9 @@
+import itertools
 import tensorflow as tf
 from tensorflow import keras as k
 import numpy as np
 from GINTransitionCell import GINTransitionCell, pack_input, unpack_state
+from InputPipeline import batch_dataset, num_batches
 
 
 class GIN(k.models.Model):
@@ -26,6 +28,7 @@ class GIN(k.models.Model):
         self._output_dim = output_dim
         self._never_invalid = never_invalid
         self._ld_output = np.isscalar(self._output_dim)
+        self.lr = 0.001
 
         # build encoder
         self._enc_hidden_layers = self._time_distribute_layers(self.build_encoder_hidden())
@@ -175,76 +178,130 @@ class GIN(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
-    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size=1):
-        
-        ##val_batching
-        Ybatch_val = []
-        Ubatch_val = []
-        
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Ybatch_val.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Ubatch_val.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch_val = np.array(Ybatch_val)
-        Ubatch_val = np.array(Ubatch_val)
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
+    def _train_step(self, model, obs, target, optimizer):
+        """
+        one rmse step on all weights
+        :return: loss
+        """
+        with tf.GradientTape() as tape:
+            preds = model(obs)
+            loss =  self.rmse(target, preds)
+
+        variables = model.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+        return loss
+
+    def build_optimizers(self, model, example_obs):
+        """
+        persistent optimizer self.train_optimizer, kept for the whole run, so the Adam moments carry over between steps
+        and are part of the checkpoint
+        :param example_obs: one training batch, used to build the model variables
+        self.lr is the learning rate, a float or a k.optimizers.schedules.LearningRateSchedule
+        """
+        model(example_obs)
+        self.train_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.train_optimizer.build(model.trainable_variables)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _train_step on the persistent optimizer of build_optimizers
+        :param example_obs, example_target: one training batch, used to build the model and the input signature. Batch
+            and time dimensions are left unknown in the signature, so the step is traced once for all batch sizes
+            and sequence lengths
+        :param jit_compile: compile the step with XLA. XLA compiles once per distinct input shape
+        :return: tf.function train_step(obs, target) -> loss. Its experimental_get_tracing_count() is the number of
+            traces, XLA compiles within a trace are not counted
+        """
+        # build model and optimizer variables eagerly, so the traced function never creates variables
+        if getattr(self, "train_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._train_step(model, obs, target, self.train_optimizer)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
+    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size=1,
+                 compiled=False, jit_compile=False, checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False,
+                 train_stream=None, steps_per_epoch=None):
+        """
+        :param compiled: run the training step as a traced tf.function (see make_train_step)
+        :param jit_compile: jit compile the traced training step with XLA
+        :param checkpoint_dir: if given, model, optimizer and the epoch are saved there every checkpoint_every epochs
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
+        :param train_stream: iterator of (obs, target) training batches, e.g. LorenzData.LorenzStream, used instead of
+            Train_Obs and Train_Target (which can be None). Every epoch takes the next steps_per_epoch batches from it.
+            The model is built on the validation batches, so nothing is drawn from the stream before a resume, which
+            calls train_stream.seek(start_epoch * steps_per_epoch) to continue after the batches of the saved epochs
+        """
         
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
+        if train_stream is None:
+            train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+            example_obs, example_target = Train_Obs[:batch_size], Train_Target[:batch_size]
+        else:
+            if steps_per_epoch is None:
+                raise AssertionError("training on a train_stream needs steps_per_epoch")
+            example_obs, example_target = Valid_Obs[:batch_size], Valid_Target[:batch_size]
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
         
         
+        self.build_optimizers(model, example_obs)
+        if compiled:
+            train_step = self.make_train_step(model, example_obs, example_target, jit_compile)
+
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, train_optimizer=self.train_optimizer, epoch=start_epoch)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+                if train_stream is not None:
+                    train_stream.seek(int(start_epoch) * steps_per_epoch)
+
         Training_Loss = []
-        for epoch in range(epochs):
-            for i in range(len(Ybatch)):
+        for epoch in range(int(start_epoch), epochs):
+            if train_stream is not None:
+                train_data = itertools.islice(train_stream, steps_per_epoch)
+            for i, (NetIn, target) in enumerate(train_data):
                 # NetIn = tf.expand_dims(Train_Obs[:10], axis=0)
-                NetIn = Ubatch[i]
-                with tf.GradientTape() as tape:
-                    preds = model(NetIn)
-                    loss =  self.rmse(Ybatch[i], preds)
+                if compiled:
+                    loss = train_step(NetIn, target)
+                else:
+                    loss = self._train_step(model, NetIn, target, self.train_optimizer)
 
-
-                variables = model.trainable_variables
-                gradients = tape.gradient(loss, variables)
-                tf.keras.optimizers.Adam(clipnorm=5.0).apply_gradients(zip(gradients, variables))
                 if i %10==0:
-                    rand_sel = np.random.randint(0, len(Ubatch_val))
-                    val_preds = model(Ubatch_val[rand_sel])
-                    val_loss = self.rmse(Ybatch_val[rand_sel], val_preds)
+                    rand_sel = np.random.randint(0, num_valid_batches)
+                    val_preds = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                    val_loss = self.rmse(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)
                     print('val loss: %s' % (val_loss.numpy()))
                 
                 print('epoch: %d  loss: %s' % (epoch, loss.numpy()))
                 
                 #print(mse_loss)
                 Training_Loss.append(loss)  
+            start_epoch.assign(epoch+1)
+            if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                checkpoint_manager.save(checkpoint_number=epoch+1)
+        if compiled:
+            print('train step traces: %d' % train_step.experimental_get_tracing_count())
         return Training_Loss
     
     def testing(self, model, test_obs, test_targets, batch_size=1):
         batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
         
         
         Test_Loss = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
+        for NetIn, target in batch_dataset(test_obs, test_targets, batch_size):
             preds = model(NetIn)
-            loss = self.rmse(Ybatch[i], preds)
+            loss = self.rmse(target, preds)
             print('test loss: %s' % (loss.numpy()))
             Test_Loss.append(loss)
         return Test_Loss
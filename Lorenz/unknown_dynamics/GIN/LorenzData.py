@@ -0,0 +1,255 @@
+"""
+the Lorenz system of parameters.py, model.py and LorenzSysModel.py on numpy, without torch. All functions work on the
+states [batch, m] of all sequences at once. The constants are built on first use and are available as attributes of
+the module under the names of parameters.py, e.g. LorenzData.B
+"""
+import functools
+import math
+import multiprocessing
+import queue
+import numpy as np
+
+# version of the generated data, part of the cache key of the data sets (see DatasetCache). Increase it with every
+# change of the sequences LorenzSystem generates
+DATA_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def constants():
+    """ the values of parameters.py as numpy arrays """
+    m = n = 3
+    B = np.array([[[0, 0, 0], [0, 0, -1], [0, 1, 0]], np.zeros((m, m)), np.zeros((m, m))])
+    C = np.array([[-10, 10, 0],
+                  [28, -1, 0],
+                  [0, 0, -8/3]])
+    delta_t = 0.02
+    H_design = np.eye(n)
+
+    ## Angle of rotation in the 3 axes
+    roll = yaw = pitch = 1 * (math.pi/180)
+    RX = np.array([[1, 0, 0],
+                   [0, math.cos(roll), -math.sin(roll)],
+                   [0, math.sin(roll), math.cos(roll)]])
+    RY = np.array([[math.cos(pitch), 0, math.sin(pitch)],
+                   [0, 1, 0],
+                   [-math.sin(pitch), 0, math.cos(pitch)]])
+    RZ = np.array([[math.cos(yaw), -math.sin(yaw), 0],
+                   [math.sin(yaw), math.cos(yaw), 0],
+                   [0, 0, 1]])
+    RotMatrix = RZ @ RY @ RX
+
+    return dict(m=m, n=n, variance=0, m1x_0=np.ones((m, 1)), m2x_0=np.zeros((m, m)),
+                B=B, C=C, delta_t_gen=1e-5, delta_t=delta_t, delta_t_test=0.01, J=5,
+                H_design=H_design, RotMatrix=RotMatrix, H_mod=RotMatrix @ H_design,
+                B_mod=B, C_mod=C, delta_t_mod=delta_t, J_mod=2)
+
+
+def __getattr__(name):
+    try:
+        return constants()[name]
+    except KeyError:
+        raise AttributeError("module %s has no attribute %s" % (__name__, name))
+
+
+def taylor_transition(x, B, C, dt, J, rotation=None):
+    """
+    model.taylor_transition on numpy: x -> F(x) x for the states x [batch, m], with A(x) = (B x)^T + C and F the Taylor
+    series of exp(A dt) up to order J, evaluated with Horner's scheme on x
+    """
+    m = x.shape[-1]
+    A = (x @ B.transpose(2, 1, 0).reshape(m, m * m)).reshape(-1, m, m) + C
+    if rotation is not None:
+        A = rotation @ A
+    A_dt = A * dt
+
+    Fx = x
+    for j in range(J, 0, -1):
+        Fx = x + (A_dt @ Fx[..., None])[..., 0] / j
+    return Fx
+
+
+def f_test(x):
+    c = constants()
+    return taylor_transition(x, c['B'], c['C'], c['delta_t_test'], c['J'])
+
+
+def f_gen(x):
+    c = constants()
+    return taylor_transition(x, c['B'], c['C'], c['delta_t_gen'], c['J'])
+
+
+def f(x):
+    c = constants()
+    return taylor_transition(x, c['B'], c['C'], c['delta_t'], c['J'])
+
+
+def fInacc(x):
+    c = constants()
+    return taylor_transition(x, c['B_mod'], c['C_mod'], c['delta_t_mod'], c['J_mod'])
+
+
+def fRotate(x):
+    c = constants()
+    return taylor_transition(x, c['B'], c['C'], c['delta_t'], c['J'], rotation=c['RotMatrix'])
+
+
+def h(x):
+    return x @ constants()['H_design'].T
+
+
+def hInacc(x):
+    return x @ constants()['H_mod'].T
+
+
+class LorenzSystem:
+
+    def __init__(self, q, r, f=f, h=h, variance=None, seed=0):
+        """
+        q: standard deviation of the process noise
+        r: standard deviation of the observation noise
+        f, h: transition and observation functions on [batch, m] states
+        variance: scale of the random initial states, None for the variance of parameters.py
+        seed: seed of the random state of sample_data_set
+        """
+        self.q = q
+        self.r = r
+        self.variance = constants()['variance'] if variance is None else variance
+        self.f = f
+        self.h = h
+        self.random = np.random.RandomState(seed)
+
+    def sample_data_set(self, num_seqs, seq_length, random_init=False, seed=None):
+        """
+        num_seqs sequences, generated all at once
+        random_init: random initial states (uniform times variance) instead of m1x_0
+        seed: reseeds the random state of the system
+        :return: obs [num_seqs, seq_length, n] and targets [num_seqs, seq_length, m], float32, in the
+            (samples, length, features) layout the models take
+        """
+        if seed is not None:
+            self.random.seed(seed)
+        return self._generate(self.random, num_seqs, seq_length, random_init)
+
+    def generate_batch(self, bid, batch_size, seq_length, random_init=False, seed=0):
+        """
+        batch bid of a generated data set, from a random state seeded with (seed, bid), so a batch does not depend on
+        the batches generated before it, e.g. by the workers of LorenzStream
+        """
+        return self._generate(np.random.RandomState([seed, int(bid)]), batch_size, seq_length, random_init)
+
+    def _generate(self, random, num_seqs, seq_length, random_init):
+        c = constants()
+        m, n = c['m'], c['n']
+        obs = np.empty((num_seqs, seq_length, n), dtype=np.float32)
+        targets = np.empty((num_seqs, seq_length, m), dtype=np.float32)
+        if random_init:
+            x = random.uniform(size=(num_seqs, m)) * self.variance
+        else:
+            x = np.repeat(c['m1x_0'].reshape(1, m), num_seqs, axis=0)
+
+        for t in range(seq_length):
+            x = self.f(x)
+            if self.q != 0:
+                x += random.normal(0.0, self.q, size=(num_seqs, m))
+            targets[:, t] = x
+            obs[:, t] = self.h(x) + random.normal(0.0, self.r, size=(num_seqs, n))
+        return obs, targets
+
+
+def _stream_worker(system, batch_size, seq_length, random_init, seed, start_bid, worker, workers, batches, stop):
+    # batches start_bid + worker, start_bid + worker + workers, ... until the stream is closed
+    bid = start_bid + worker
+    while not stop.is_set():
+        batch = system.generate_batch(bid, batch_size, seq_length, random_init, seed)
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        bid += workers
+
+
+class LorenzStream:
+
+    def __init__(self, system, batch_size, seq_length, random_init=True, workers=1, queue_size=8, seed=0, start_bid=0,
+                 timeout=60):
+        """
+        endless iterator of (obs, targets) batches of fresh sequences, LorenzSystem.generate_batch(bid, ...) for
+        bid = start_bid, start_bid + 1, ... The batches are generated by background worker processes into a queue of at
+        most queue_size batches, so generation runs alongside the training and the memory does not grow with the number
+        of batches drawn. With several workers the batches may arrive out of bid order. The workers start with the
+        first batch that is drawn and stop on close, use it as context manager to make sure they do
+        system: LorenzSystem with q, r and the initial state variance of the sequences
+        workers: number of worker processes, started with the spawn method. Spawned processes import the main module
+            again, so the script that runs the stream should not import tensorflow at module level
+        start_bid: bid of the first batch, see seek
+        timeout: seconds to wait for a batch before the workers are checked again. The workers are checked before
+            every batch, a worker that exited raises, as its batches would be missing from the stream
+        """
+        self.system = system
+        self.batch_size = batch_size
+        self.seq_length = seq_length
+        self.random_init = random_init
+        self.workers = workers
+        self.queue_size = queue_size
+        self.seed = seed
+        self.start_bid = start_bid
+        self.timeout = timeout
+        self._processes = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        self._batches = context.Queue(self.queue_size)
+        self._stop = context.Event()
+        self._processes = [context.Process(target=_stream_worker, daemon=True,
+                                           args=(self.system, self.batch_size, self.seq_length, self.random_init,
+                                                 self.seed, self.start_bid, worker, self.workers, self._batches,
+                                                 self._stop))
+                           for worker in range(self.workers)]
+        for process in self._processes:
+            process.start()
+
+    def close(self):
+        if self._processes is None:
+            return
+        self._stop.set()
+        # the workers only exit once their queued batches are taken
+        while any(process.is_alive() for process in self._processes):
+            try:
+                self._batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self._processes:
+            process.join()
+        self._processes = None
+
+    def seek(self, bid):
+        """
+        continue the stream with batch bid, e.g. start_epoch * steps_per_epoch when a training is resumed. Running
+        workers are stopped, the next batch drawn starts them at bid. With several workers a few batches around the
+        previous position can be repeated or skipped, as they arrive out of bid order
+        """
+        self.close()
+        self.start_bid = bid
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._processes is None:
+            self.start()
+        while True:
+            exited = [process for process in self._processes if not process.is_alive()]
+            if exited:
+                raise AssertionError("LorenzStream worker exited with code %s" % exited[0].exitcode)
+            try:
+                return self._batches.get(timeout=self.timeout)
+            except queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
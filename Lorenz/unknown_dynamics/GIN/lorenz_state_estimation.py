@@ -1,41 +1,55 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow import keras as k
-from LorenzSysModel import SystemModel
-from parameters import m, n
-import model
-from GIN import GIN
-
-
-def Generate_Data(num_seqs_train=1, num_seqs_test=1, num_seqs_valid=1, seq_length_train=1, seq_length_test=1, seq_length_valid=1, q=1, r=1):
-    
-    obj_sysmodel = SystemModel( model.f, q, model.h, r, seq_length_train,  m, n)
-    train_obs, train_targets = obj_sysmodel.GenerateBatch(num_seqs_train, seq_length_train, randomInit=True)
-    obj_sysmodel = SystemModel( model.f, q, model.h, r, seq_length_test,  m, n)
-    test_obs, test_targets = obj_sysmodel.GenerateBatch(num_seqs_test, seq_length_test, randomInit=True)
-    obj_sysmodel = SystemModel( model.f, q, model.h, r, seq_length_valid,  m, n)
-    valid_obs, valid_targets = obj_sysmodel.GenerateBatch(num_seqs_valid, seq_length_valid, randomInit=True)
-
-    #reorder data to #(num of samples, length, features)
-    train_obs = np.transpose(train_obs.numpy(), axes=[0,2,1]) 
-    train_targets = np.transpose(train_targets.numpy(), axes=[0,2,1])
-    test_obs = np.transpose(test_obs.numpy(), axes=[0,2,1])
-    test_targets = np.transpose(test_targets.numpy(), axes=[0,2,1])
-    valid_obs = np.transpose(valid_obs.numpy(), axes=[0,2,1])
-    valid_targets = np.transpose(valid_targets.numpy(), axes=[0,2,1])
+import LorenzData
+from DatasetCache import cached_arrays
+
+
+def Generate_Data(num_seqs_train=1, num_seqs_test=1, num_seqs_valid=1, seq_length_train=1, seq_length_test=1, seq_length_valid=1, q=1, r=1,
+                  seed=0, cache_dir="./data/cache"):
+    """
+    :param seed: seed of the generation
+    :param cache_dir: the sequences are cached there, keyed by all arguments and the system parameters (see
+        DatasetCache), so runs with the same parameters generate them only once
+    :return: train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets
+    """
+    params = dict(generator="lorenz_numpy", version=LorenzData.DATA_VERSION, num_seqs=[num_seqs_train, num_seqs_test, num_seqs_valid],
+                  seq_lengths=[seq_length_train, seq_length_test, seq_length_valid], q=q, r=r, seed=seed,
+                  system={name: getattr(LorenzData, name) for name in
+                          ["m", "n", "variance", "m1x_0", "m2x_0", "delta_t", "delta_t_gen", "J"]})
+    return cached_arrays(cache_dir, params, lambda: _generate_data(num_seqs_train, num_seqs_test, num_seqs_valid,
+                                                                   seq_length_train, seq_length_test, seq_length_valid,
+                                                                   q, r, seed))
+
+
+def _generate_data(num_seqs_train, num_seqs_test, num_seqs_valid, seq_length_train, seq_length_test, seq_length_valid, q, r,
+                   seed):
+    # all sequences of a set at once, already as float32 in the (num of samples, length, features) layout
+    system = LorenzData.LorenzSystem(q, r, seed=seed)
+    train_obs, train_targets = system.sample_data_set(num_seqs_train, seq_length_train, random_init=True)
+    test_obs, test_targets = system.sample_data_set(num_seqs_test, seq_length_test, random_init=True)
+    valid_obs, valid_targets = system.sample_data_set(num_seqs_valid, seq_length_valid, random_init=True)
     return train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets
 
 
-# Implement Encoder and Decoder hidden layers
-class LorenzStateEstemGIN(GIN):
-    def build_encoder_hidden(self):
-        return [k.layers.Dense(units=3, activation=k.activations.relu)]
+def build_model(**kwargs):
+    """
+    LorenzStateEstemGIN(**kwargs). tensorflow and the model are imported here and not at module level, the LorenzStream
+    workers are spawned processes that import this module again and only need LorenzData
+    """
+    from tensorflow import keras as k
+    from GIN import GIN
 
-    def build_decoder_hidden(self):
-        return [k.layers.Dense(units=3, activation=k.activations.relu)]
+    # Implement Encoder and Decoder hidden layers
+    class LorenzStateEstemGIN(GIN):
+        def build_encoder_hidden(self):
+            return [k.layers.Dense(units=3, activation=k.activations.relu)]
 
-    def build_var_decoder_hidden(self):
-        return [k.layers.Dense(units=3, activation=k.activations.relu)]
+        def build_decoder_hidden(self):
+            return [k.layers.Dense(units=3, activation=k.activations.relu)]
+
+        def build_var_decoder_hidden(self):
+            return [k.layers.Dense(units=3, activation=k.activations.relu)]
+
+    return LorenzStateEstemGIN(**kwargs)
      
 
 def main():
@@ -51,19 +65,22 @@ def main():
 
 
     ##data gen
-    train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets = Generate_Data(num_seqs_train=20, num_seqs_test=1,
+    # fixed test and validation sets, the training sequences are streamed, fresh ones for every step
+    _, _, test_obs, test_targets, valid_obs, valid_targets = Generate_Data(num_seqs_train=0, num_seqs_test=1,
                                        num_seqs_valid=2, seq_length_train=200, seq_length_test=200, seq_length_valid=280, q=q, r=r)
+    train_stream = LorenzData.LorenzStream(LorenzData.LorenzSystem(q, r), batch_size=1, seq_length=200, seed=1)
 
     ##
     ## Build Model
-    Lorenz = LorenzStateEstemGIN(observation_shape=train_obs.shape[-1], latent_observation_dim=3, output_dim=3, num_basis=6,
+    Lorenz = build_model(observation_shape=valid_obs.shape[-1], latent_observation_dim=3, output_dim=3, num_basis=6,
                                  never_invalid=True)
 
 
     # # Train Model
     epochs= 100
-    Training_Loss = Lorenz.training( Lorenz, train_obs, train_targets,
-                                 valid_obs, valid_targets, epochs)
+    with train_stream:
+        Training_Loss = Lorenz.training( Lorenz, None, None,
+                                     valid_obs, valid_targets, epochs, train_stream=train_stream, steps_per_epoch=20)
     Test_Loss = Lorenz.testing( Lorenz, test_obs, test_targets)
 
 if __name__ == '__main__':
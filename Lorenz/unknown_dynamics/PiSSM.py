@@ -1,14 +1,16 @@
      
+import itertools
 import tensorflow as tf
 from tensorflow import keras as k
 import numpy as np
 from PiSSMTransitionCell import PiSSMTransitionCell, pack_input, unpack_state
+from InputPipeline import batch_dataset, num_batches
 
 
 class PiSSM(k.models.Model):
 
     def __init__(self, observation_shape, latent_observation_dim, output_dim, num_basis,
-                 trans_net_hidden_units=[], never_invalid=False, cell_type="gin"):
+                 trans_net_hidden_units=[], never_invalid=False, cell_type="gin", inference_basis="argmax"):
         """
         :param observation_shape: shape of the observation to work with
         :param latent_observation_dim: latent observation dimension (m in paper)
@@ -18,6 +20,7 @@ class PiSSM(k.models.Model):
         :param never_invalid: if you know a-priori that the observation valid flag will always be positive you can set
                               this to true for slightly increased performance (obs_valid mask will be ignored)
         :param cell_type: type of cell to use "gin" for our approach, "lstm" or "gru" for baselines
+        :param inference_basis: deterministic basis selection used by testing, "argmax" or "expected" (see call)
         """
         super().__init__()
 
@@ -27,6 +30,9 @@ class PiSSM(k.models.Model):
         self._output_dim = output_dim
         self._never_invalid = never_invalid
         self._ld_output = np.isscalar(self._output_dim)
+        if inference_basis not in ["argmax", "expected"]:
+            raise AssertionError("Invalid inference basis, needs to be 'argmax' or 'expected'")
+        self.inference_basis = inference_basis
         self.lr = 0.01
         # build encoder
         self._enc_hidden_layers = self._time_distribute_layers(self.build_encoder_hidden())
@@ -97,11 +103,14 @@ class PiSSM(k.models.Model):
         """
         raise NotImplementedError
 
-    def call(self, inputs, training=None, mask=None):
+    def call(self, inputs, training=None, mask=None, basis_selection="sample"):
         """
         :param inputs: model inputs (i.e. observations)
         :param training: required by k.models.Models
         :param mask: required by k.models.Model
+        :param basis_selection: "sample" draws the basis of every step and returns its log-probs for reinforce_loss,
+                                "argmax" or "expected" (softmax weighted mixture of the bases) are deterministic and
+                                return an empty logp_list
         :return:
         """
         if isinstance(inputs, tuple) or isinstance(inputs, list):
@@ -120,10 +129,12 @@ class PiSSM(k.models.Model):
 
         # transition
         rkn_in = pack_input(w_mean, w_covar, obs_valid)
+        self._cell.basis_selection = basis_selection
         z = self._layer_rkn(rkn_in)
 
         # post_mean, post_covar = unpack_state(z, self._lsd)
-        post_mean, post_covar, prior_mean, prior_covar, self.transition_matrix, logp_list = z
+        post_mean, post_covar, prior_mean, prior_covar, self.transition_matrix = z[:5]
+        logp_list = z[5] if basis_selection == "sample" else []
         post_covar = tf.concat(post_covar, -1)
 
         # decode
@@ -178,7 +189,7 @@ class PiSSM(k.models.Model):
             ### Baseline+ REINFORCE
             baseline = tf.reduce_mean(reward, axis=0)  # shape [T]
             baseline = tf.expand_dims(baseline, axis=0)  # [1, T]
-            baseline = tf.tile(baseline, [pred_mean.shape[0], 1])  # [batch, T]
+            baseline = tf.tile(baseline, [tf.shape(pred_mean)[0], 1])  # [batch, T]
             logps = tf.squeeze(logp_list, axis=-1) 
 
             reward = tf.stop_gradient(reward)
@@ -204,103 +215,170 @@ class PiSSM(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
-    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size=1):
-        
-        ##val_batching
-        Ybatch_val = []
-        Ubatch_val = []
-        
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Ybatch_val.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Ubatch_val.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch_val = np.array(Ybatch_val)
-        Ubatch_val = np.array(Ubatch_val)
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
+    def _train_step(self, model, obs, target, reinforce_optimizer, phi_optimizer):
+        """
+        one REINFORCE step on the DynamicsNet weights and one NLL step on the remaining weights from a single forward
+        pass. The DynamicsNet input is cut off from the gradient in the cell, so reinforce_loss only reaches the
+        DynamicsNet weights and the NLL has no path to them, one backward pass of the sum gives both gradient groups.
+        If a loss or gradient is not finite, neither optimizer is applied, so the weights stay those of the last
+        finite step
+        :return: reinforce_loss, phi_loss
+        """
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+
+        with tf.GradientTape() as tape:
+            preds, logp_list = model(obs)
+            reinforce_loss = self.reinforce_loss(target, preds, logp_list)
+            phi_loss = self.gaussian_nll(target, preds)
+            loss = reinforce_loss + phi_loss
+
+        gradients = tape.gradient(loss, dynamic_variables + phi_vars)
+        finite = tf.reduce_all([tf.math.is_finite(reinforce_loss), tf.math.is_finite(phi_loss)] +
+                               [tf.reduce_all(tf.math.is_finite(g)) for g in gradients if g is not None])
+
+        def apply_gradients():
+            reinforce_optimizer.apply_gradients(zip(gradients[:len(dynamic_variables)], dynamic_variables))
+            phi_optimizer.apply_gradients(zip(gradients[len(dynamic_variables):], phi_vars))
+            return tf.constant(True)
+        tf.cond(finite, apply_gradients, lambda: tf.constant(False))
+        return reinforce_loss, phi_loss
+
+    def build_optimizers(self, model, example_obs):
+        """
+        persistent optimizers, one per variable group: self.reinforce_optimizer for the DynamicsNet and
+        self.phi_optimizer for all remaining weights. Both are kept for the whole run, so the Adam moments carry over
+        between steps and are part of the checkpoint
+        :param example_obs: one training batch, used to build the model variables
+        self.lr is the learning rate of both optimizers, a float or a k.optimizers.schedules.LearningRateSchedule
+        """
+        model(example_obs)
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+        self.reinforce_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.phi_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.reinforce_optimizer.build(dynamic_variables)
+        self.phi_optimizer.build(phi_vars)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _train_step on the persistent optimizers of build_optimizers
+        :param example_obs, example_target: one training batch, used to build the model and the input signature. Batch
+            and time dimensions are left unknown in the signature, so the step is traced once for all batch sizes
+            and sequence lengths
+        :param jit_compile: compile the step with XLA. XLA compiles once per distinct input shape
+        :return: tf.function train_step(obs, target) -> reinforce_loss, phi_loss. Its experimental_get_tracing_count()
+            is the number of traces, XLA compiles within a trace are not counted
+        """
+        # build model and optimizer variables eagerly, so the traced function never creates variables
+        if getattr(self, "reinforce_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._train_step(model, obs, target, self.reinforce_optimizer, self.phi_optimizer)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
+    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size=1,
+                 compiled=False, jit_compile=False, checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False,
+                 train_stream=None, steps_per_epoch=None):
+        """
+        :param compiled: run the training step as a traced tf.function (see make_train_step)
+        :param jit_compile: jit compile the traced training step with XLA
+        :param checkpoint_dir: if given, model, optimizers and the epoch are saved there every checkpoint_every epochs.
+            Training stops at the first step with a non-finite loss, without saving the epoch it diverged in
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
+        :param train_stream: iterator of (obs, target) training batches, e.g. LorenzData.LorenzStream, used instead of
+            Train_Obs and Train_Target (which can be None). Every epoch takes the next steps_per_epoch batches from it.
+            The model is built on the validation batches, so nothing is drawn from the stream before a resume, which
+            calls train_stream.seek(start_epoch * steps_per_epoch) to continue after the batches of the saved epochs
+        """
         
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
+        if train_stream is None:
+            train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+            example_obs, example_target = Train_Obs[:batch_size], Train_Target[:batch_size]
+        else:
+            if steps_per_epoch is None:
+                raise AssertionError("training on a train_stream needs steps_per_epoch")
+            example_obs, example_target = Valid_Obs[:batch_size], Valid_Target[:batch_size]
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
         
         
+        self.build_optimizers(model, example_obs)
+        if compiled:
+            train_step = self.make_train_step(model, example_obs, example_target, jit_compile)
+
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, reinforce_optimizer=self.reinforce_optimizer,
+                                             phi_optimizer=self.phi_optimizer, epoch=start_epoch)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+                if train_stream is not None:
+                    train_stream.seek(int(start_epoch) * steps_per_epoch)
+
         Training_Loss = []
-        for epoch in range(epochs):
-            for i in range(len(Ybatch)):
+        diverged = False
+        for epoch in range(int(start_epoch), epochs):
+            if train_stream is not None:
+                train_data = itertools.islice(train_stream, steps_per_epoch)
+            for i, (NetIn, target) in enumerate(train_data):
                 # NetIn = tf.expand_dims(Train_Obs[:10], axis=0)
-                NetIn = Ubatch[i]
-                with tf.GradientTape() as tape:
-                    preds, logp_list = model(NetIn)
-                    # loss = self.rmse(Ybatch[i], preds)
-                    reinforce_loss = self.reinforce_loss(Ybatch[i], preds, logp_list)
+                if compiled:
+                    reinforce_loss, phi_loss = train_step(NetIn, target)
+                else:
+                    reinforce_loss, phi_loss = self._train_step(model, NetIn, target,
+                                                                self.reinforce_optimizer, self.phi_optimizer)
 
-                
-                ##
                 print('epoch: %d  reinforce_loss: %s' % (epoch, reinforce_loss.numpy()))
-                if np.isnan(reinforce_loss.numpy()):
-                    break
-                dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
-                # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
-                gradients = tape.gradient(reinforce_loss, dynamic_variables)
-                tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(gradients, dynamic_variables))
-            
-                ##
-                with tf.GradientTape() as tape2:
-                    preds, _ = model(NetIn)  # recompute
-                    phi_loss = self.gaussian_nll(Ybatch[i], preds)
-                
                 print('epoch: %d  base_loss: %s' % (epoch, phi_loss.numpy()))
-                if np.isnan(phi_loss.numpy()):
+                if not (np.isfinite(reinforce_loss.numpy()) and np.isfinite(phi_loss.numpy())):
+                    diverged = True
                     break
-
-                phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
-                grads_phi = tape2.gradient(phi_loss, phi_vars)
-                tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(grads_phi, phi_vars))
                 ##
                 
                 if i %10==0:
-                    rand_sel = np.random.randint(0, len(Ubatch_val))
-                    val_preds, val_logp_list = model(Ubatch_val[rand_sel])
-                    val_reinforce_loss = self.reinforce_loss(Ubatch_val[rand_sel], val_preds, val_logp_list)
-                    val_phi_loss = self.gaussian_nll(Ubatch_val[rand_sel], val_preds)
+                    rand_sel = np.random.randint(0, num_valid_batches)
+                    val_preds, val_logp_list = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                    val_reinforce_loss = self.reinforce_loss(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds, val_logp_list)
+                    val_phi_loss = self.gaussian_nll(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)
                     val_loss = val_reinforce_loss + val_phi_loss
                     print('val loss: %s' % (val_loss.numpy()))
                 
                 loss = phi_loss + reinforce_loss
                 print('epoch: %d  total_loss: %s' % (epoch, loss.numpy()))
-                if np.isnan(loss.numpy()):
-                    break
 
                 
                 #print(mse_loss)
                 Training_Loss.append(loss)  
+            if diverged:
+                # the diverged epoch is not checkpointed, resume starts from the last saved epoch
+                print('epoch: %d  training diverged, stopped without saving a checkpoint' % epoch)
+                break
+            start_epoch.assign(epoch+1)
+            if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                checkpoint_manager.save(checkpoint_number=epoch+1)
+        if compiled:
+            print('train step traces: %d' % train_step.experimental_get_tracing_count())
         return Training_Loss
     
     def testing(self, model, test_obs, test_targets, batch_size=1):
         batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
         
         
         Test_Loss = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
-            preds = model(NetIn)
-            loss = self.rmse(Ybatch[i], preds)
+        for NetIn, target in batch_dataset(test_obs, test_targets, batch_size):
+            preds, _ = model(NetIn, basis_selection = self.inference_basis)
+            loss = self.rmse(target, preds)
             print('test loss: %s' % (loss.numpy()))
             Test_Loss.append(loss)
         return Test_Loss
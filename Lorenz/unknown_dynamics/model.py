@@ -2,7 +2,6 @@ import math
 
 import torch
 torch.pi = torch.acos(torch.zeros(1)).item() * 2 # which is 3.1415927410125732
-from torch import autograd
 import sys
 from parameters import m, n, J, delta_t,delta_t_test,delta_t_gen, H_design, B, C, B_mod, C_mod, delta_t_mod, J_mod, H_mod, H_design_inv, H_mod_inv,RotMatrix
 
@@ -13,72 +12,98 @@ from parameters import m, n, J, delta_t,delta_t_test,delta_t_gen, H_design, B, C
 #    dev = torch.device("cpu")
 #    print("Running on the CPU")
 
+def _matvec(A, x):
+    # A [batch, m, m] times x [batch, m]
+    return torch.matmul(A, x.unsqueeze(-1)).squeeze(-1)
+
+def taylor_transition(x, B, C, dt, J, rotation=None):
+    """
+    batched transition x -> F(x) x for the states x [batch, m] of all sequences, with the state dependent
+    A(x) = (B x)^T + C (rotation A(x) if a rotation matrix is given) and F = exp(A dt), truncated after order J.
+    The series is evaluated with Horner's scheme on x, F x = x + A dt (x + A dt / 2 (x + ... (x + A dt / J x))),
+    J batched matrix vector products instead of J matrix powers
+    :param J: order of the Taylor series, None for the exact matrix exponential
+    """
+    A = torch.add(torch.matmul(x, B.permute(2, 1, 0).reshape(m, m * m)).view(-1, m, m), C)
+    if rotation is not None:
+        A = torch.matmul(rotation, A)
+    A_dt = A * dt
+    if J is None:
+        return _matvec(torch.linalg.matrix_exp(A_dt), x)
+
+    Fx = x
+    for j in range(J, 0, -1):
+        Fx = torch.add(x, _matvec(A_dt, Fx) / j)
+    return Fx
+
+def taylor_transition_jacobian(x, B, C, dt, J, rotation=None):
+    """
+    Jacobians [batch, m, m] of taylor_transition at the states x [batch, m], in closed form. A(x) is linear in x,
+    dA/dx_k = B[:, :, k]^T, which is carried through the Horner recursion. For J=None the derivatives of the exact
+    matrix exponential are the upper right blocks of exp([[A dt, dA/dx_k dt], [0, A dt]])
+    """
+    A = torch.add(torch.matmul(x, B.permute(2, 1, 0).reshape(m, m * m)).view(-1, m, m), C)
+    # dA_dx[k] = dA/dx_k
+    dA_dx = B.permute(2, 1, 0)
+    if rotation is not None:
+        A = torch.matmul(rotation, A)
+        dA_dx = torch.matmul(rotation, dA_dx)
+    A_dt = A * dt
+    if J is None:
+        block = torch.zeros(x.shape[0], m, 2 * m, 2 * m)
+        block[:, :, :m, :m] = A_dt[:, None]
+        block[:, :, m:, m:] = A_dt[:, None]
+        block[:, :, :m, m:] = dA_dx * dt
+        exp_block = torch.linalg.matrix_exp(block)
+        # d(exp(A dt) x)/dx_k = exp(A dt) e_k + d exp(A dt)/dx_k x
+        return exp_block[:, 0, :m, :m] + _matvec(exp_block[:, :, :m, m:], x[:, None]).transpose(1, 2)
+
+    eye = torch.eye(m).expand(x.shape[0], m, m)
+    Fx, dFx = x, eye
+    for j in range(J, 0, -1):
+        # d(A v)/dx = A dv/dx + [dA/dx_1 v, ..., dA/dx_m v]
+        dFx = torch.add(eye, (torch.matmul(A_dt, dFx) + dt * torch.einsum('kji,bi->bjk', dA_dx, Fx)) / j)
+        Fx = torch.add(x, _matvec(A_dt, Fx) / j)
+    return dFx
+
+def f_test_batch(x):
+    return taylor_transition(x, B, C, delta_t_test, J)
+
+def f_gen_batch(x):
+    return taylor_transition(x, B, C, delta_t_gen, J)
+
+def f_batch(x):
+    return taylor_transition(x, B, C, delta_t, J)
+
+def fInacc_batch(x):
+    return taylor_transition(x, B_mod, C_mod, delta_t_mod, J_mod)
+
+def fRotate_batch(x):
+    return taylor_transition(x, B, C, delta_t, J, rotation=RotMatrix)
+
+# single states, x of shape [m, 1] or [m]
 def f_test(x):
-    
-    #A = torch.add(torch.einsum('nhw,wa->nh', B, x).T,C)
-    A = torch.add(torch.reshape(torch.matmul(B, x),(m,m)).T,C)
-    
-    # Taylor Expansion for F    
-    F = torch.eye(m)
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t_test, j)/math.factorial(j))#.to(dev)
-        F = torch.add(F, F_add)#.to(dev)
-
-    return torch.matmul(F, x)
+    return f_test_batch(x.reshape(1, m)).reshape(x.shape)
 
 def f_gen(x):
-
-    #A = torch.add(torch.einsum('nhw,wa->nh', B, x).T,C)
-    A = torch.add(torch.reshape(torch.matmul(B, x),(m,m)).T,C)
-    
-    # Taylor Expansion for F    
-    F = torch.eye(m)
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t_gen, j)/math.factorial(j))#.to(dev)
-        F = torch.add(F, F_add)#.to(dev)
-
-    return torch.matmul(F, x)
+    return f_gen_batch(x.reshape(1, m)).reshape(x.shape)
 
 def f(x):
-
-    #A = torch.add(torch.einsum('nhw,wa->nh', B, x).T,C)
-    A = (torch.add(torch.reshape(torch.matmul(B, x),(m,m)).T,C))#.to(dev)
-    
-    # Taylor Expansion for F    
-    F = torch.eye(m)
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t, j)/math.factorial(j))#.to(dev)
-        F = torch.add(F, F_add)#.to(dev)
-
-    return torch.matmul(F, x)
+    return f_batch(x.reshape(1, m)).reshape(x.shape)
 
 def h(x):
     return torch.matmul(H_design,x)#.to(dev)
     #return toSpherical(x)
 
-def fInacc(x):
-
-    #A = torch.add(torch.einsum('nhw,wa->nh', B, x).T,C)
-    A = torch.add(torch.reshape(torch.matmul(B_mod, x),(m,m)).T,C_mod)
-    
-    # Taylor Expansion for F    
-    F = torch.eye(m)
-    for j in range(1,J_mod+1):
-        F_add = (torch.matrix_power(A*delta_t_mod, j)/math.factorial(j))#.to(dev)
-        F = torch.add(F, F_add)#.to(dev)
+def h_batch(x):
+    # h for x of shape [batch, m]
+    return torch.matmul(x, H_design.T)
 
-    return torch.matmul(F, x)
+def fInacc(x):
+    return fInacc_batch(x.reshape(1, m)).reshape(x.shape)
 
 def fRotate(x):
-    A = (torch.add(torch.reshape(torch.matmul(B, x),(m,m)).T,C))#.to(dev)
-    A_rot = torch.mm(RotMatrix,A)   
-    # Taylor Expansion for F    
-    F = torch.eye(m)
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A_rot*delta_t, j)/math.factorial(j))#.to(dev)
-        F = torch.add(F, F_add)#.to(dev)
-
-    return torch.matmul(F, x)
+    return fRotate_batch(x.reshape(1, m)).reshape(x.shape)
 
 def hInacc(x):
     return torch.matmul(H_mod,x)
@@ -87,54 +112,69 @@ def hInacc(x):
 def h_nonlinear(x):
     return toSpherical(x)
 
+def h_nonlinear_batch(x):
+    # h_nonlinear for x of shape [..., m], e.g. [batch, T, m]
+    return toSpherical_batch(x)
+
+# Jacobians [batch, n or m, m] at the states x [batch, m]
+def f_jacobian(x):
+    return taylor_transition_jacobian(x, B, C, delta_t, J)
+
+def fInacc_jacobian(x):
+    return taylor_transition_jacobian(x, B_mod, C_mod, delta_t_mod, J_mod)
+
+def h_jacobian(x):
+    return H_design.expand(x.shape[0], n, m)
+
+def hInacc_jacobian(x):
+    return H_mod.expand(x.shape[0], n, m)
+
+def h_nonlinear_jacobian(x):
+    # rows d rho/dx, d theta/dx, d phi/dx of the spherical coordinates
+    rho_sq = torch.sum(x**2, dim=-1)
+    rho = torch.sqrt(rho_sq)
+    r_xy_sq = x[:, 0]**2 + x[:, 1]**2
+    r_xy = torch.sqrt(r_xy_sq)
+    d_rho = x / rho[:, None]
+    d_theta = torch.stack([x[:, 0] * x[:, 2] / (rho_sq * r_xy), x[:, 1] * x[:, 2] / (rho_sq * r_xy), -r_xy / rho_sq], -1)
+    d_phi = torch.stack([-x[:, 1] / r_xy_sq, x[:, 0] / r_xy_sq, torch.zeros_like(r_xy)], -1)
+    return torch.stack([d_rho, d_theta, d_phi], dim=1)
+
 def getJacobian(x, a):
-    
-    # if(x.size()[1] == 1):
-    #     y = torch.reshape((x.T),[x.size()[0]])
-    try:
-        if(x.size()[1] == 1):
-            y = torch.reshape((x.T),[x.size()[0]])
-    except:
-        y = torch.reshape((x.T),[x.size()[0]])
-        
-    if(a == 'ObsAcc'):
-        g = h
-    elif(a == 'ModAcc'):
-        g = f
-    elif(a == 'ObsInacc'):
-        g = hInacc
-    elif(a == 'ModInacc'):
-        g = fInacc
-
-    Jac = autograd.functional.jacobian(g, y)
+    # Jacobian of h, f, hInacc or fInacc at a single state x [m, 1] or [m]
+    jacobians = {'ObsAcc': h_jacobian, 'ModAcc': f_jacobian, 'ObsInacc': hInacc_jacobian, 'ModInacc': fInacc_jacobian}
+    Jac = jacobians[a](x.reshape(1, m))[0]
     Jac = Jac.view(-1,m)
     return Jac
 
-def toSpherical(cart):
-
-    rho = torch.norm(cart, p=2).view(1,1)
-    phi = torch.atan2(cart[1, ...], cart[0, ...]).view(1, 1)
+def toSpherical_batch(cart):
+    # (rho, theta, phi) of the cartesian points cart [..., 3]
+    rho = torch.linalg.norm(cart, dim=-1)
+    phi = torch.atan2(cart[..., 1], cart[..., 0])
     phi = phi + (phi < 0).type_as(phi) * (2 * torch.pi)
 
-    theta = torch.acos(cart[2, ...] / rho).view(1, 1)
-
-    spher = torch.cat([rho, theta, phi], dim=0)
+    theta = torch.acos(cart[..., 2] / rho)
 
-    return spher
+    return torch.stack([rho, theta, phi], dim=-1)
 
-def toCartesian(sphe):
+def toCartesian_batch(sphe):
+    # cartesian points of the spherical coordinates sphe [..., 3]
+    rho = sphe[..., 0]
+    theta = sphe[..., 1]
+    phi = sphe[..., 2]
 
-    rho = sphe[0,:]
-    theta = sphe[1,:]
-    phi = sphe[2,:]
+    x = rho * torch.sin(theta) * torch.cos(phi)
+    y = rho * torch.sin(theta) * torch.sin(phi)
+    z = rho * torch.cos(theta)
 
-    x = (rho * torch.sin(theta) * torch.cos(phi)).view(1,-1)
-    y = (rho * torch.sin(theta) * torch.sin(phi)).view(1,-1)
-    z = (rho * torch.cos(theta)).view(1,-1)
+    return torch.stack([x, y, z], dim=-1)
 
-    cart = torch.cat([x,y,z],dim=0)
+# column vectors [3, N]
+def toSpherical(cart):
+    return toSpherical_batch(cart.reshape(3, -1).T).T
 
-    return cart
+def toCartesian(sphe):
+    return toCartesian_batch(sphe.reshape(3, -1).T).T
 
 def hInv(y):
     return torch.matmul(H_design_inv,y)
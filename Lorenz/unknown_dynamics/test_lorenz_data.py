@@ -0,0 +1,119 @@
+"""
+checks of the numpy Lorenz system of LorenzData against the original matrix power loops of model.py, copied below on
+numpy, against parameters.py and model.py (skipped without torch), and of the sequences LorenzSystem generates
+run from this directory: python -m pytest test_lorenz_data.py
+"""
+import math
+
+import numpy as np
+import pytest
+
+import LorenzData
+from LorenzData import LorenzSystem
+
+
+def original_transition(x, B, C, delta_t, J, rotation=None):
+    # f, f_test, f_gen, fInacc and fRotate of the original model.py for a single state x [m, 1], on numpy
+    m = x.shape[0]
+    A = np.reshape(B @ x, (m, m)).T + C
+    if rotation is not None:
+        A = rotation @ A
+    F = np.eye(m)
+    for j in range(1, J + 1):
+        F_add = (np.linalg.matrix_power(A * delta_t, j) / math.factorial(j))
+        F = F + F_add
+    return F @ x
+
+
+def random_states(batch=50, seed=0):
+    # states of the magnitude of the Lorenz attractor
+    return 10 * np.random.RandomState(seed).randn(batch, LorenzData.m)
+
+
+transitions = [
+    (LorenzData.f, ('B', 'C', 'delta_t', 'J')),
+    (LorenzData.f_test, ('B', 'C', 'delta_t_test', 'J')),
+    (LorenzData.f_gen, ('B', 'C', 'delta_t_gen', 'J')),
+    (LorenzData.fInacc, ('B_mod', 'C_mod', 'delta_t_mod', 'J_mod')),
+    (LorenzData.fRotate, ('B', 'C', 'delta_t', 'J', 'RotMatrix'))]
+
+
+@pytest.mark.parametrize("batched, original_args", transitions)
+def test_horner_matches_matrix_powers(batched, original_args):
+    x = random_states()
+    args = [LorenzData.constants()[name] for name in original_args]
+    original = np.stack([original_transition(state.reshape(-1, 1), *args)[:, 0] for state in x])
+    np.testing.assert_allclose(batched(x), original, rtol=1e-10, atol=1e-10)
+
+
+def test_constants_match_parameters():
+    torch = pytest.importorskip("torch")
+    import parameters
+    for name, value in LorenzData.constants().items():
+        reference = getattr(parameters, name)
+        if isinstance(reference, torch.Tensor):
+            reference = reference.numpy()
+        np.testing.assert_allclose(value, reference, rtol=1e-6, atol=1e-7, err_msg=name)
+    assert LorenzData.RotMatrix is LorenzData.constants()['RotMatrix']
+    with pytest.raises(AttributeError):
+        LorenzData.no_such_constant
+
+
+@pytest.mark.parametrize("batched, original_args", transitions)
+def test_transitions_match_model(batched, original_args):
+    torch = pytest.importorskip("torch")
+    import model
+    torch_batched = {LorenzData.f: model.f_batch, LorenzData.f_test: model.f_test_batch,
+                     LorenzData.f_gen: model.f_gen_batch, LorenzData.fInacc: model.fInacc_batch,
+                     LorenzData.fRotate: model.fRotate_batch}[batched]
+    x = random_states(seed=1)
+    reference = torch_batched(torch.tensor(x, dtype=torch.float32)).numpy()
+    np.testing.assert_allclose(batched(x), reference, rtol=1e-5, atol=1e-4)
+
+
+def test_observations():
+    x = random_states(seed=2)
+    np.testing.assert_array_equal(LorenzData.h(x), x)
+    np.testing.assert_allclose(LorenzData.hInacc(x), x @ LorenzData.RotMatrix.T)
+
+
+def test_sample_data_set_layout_and_seed():
+    system = LorenzSystem(q=0.1, r=0.5, variance=100)
+    obs, targets = system.sample_data_set(7, 11, random_init=True, seed=3)
+    assert obs.shape == (7, 11, LorenzData.n) and targets.shape == (7, 11, LorenzData.m)
+    assert obs.dtype == np.float32 and targets.dtype == np.float32
+    again = LorenzSystem(q=0.1, r=0.5, variance=100).sample_data_set(7, 11, random_init=True, seed=3)
+    for a, b in zip((obs, targets), again):
+        np.testing.assert_array_equal(a, b)
+    other = system.sample_data_set(7, 11, random_init=True, seed=4)
+    assert not np.allclose(other[1], targets)
+
+
+def test_noise_free_sequences_follow_the_transition():
+    # the loop of the original GenerateSequence, x_t = f(x_{t-1}) from m1x_0 and y_t = h(x_t)
+    obs, targets = LorenzSystem(q=0, r=0).sample_data_set(3, 20)
+    x = LorenzData.m1x_0.reshape(1, -1)
+    for t in range(20):
+        x = LorenzData.f(x)
+        np.testing.assert_allclose(targets[:, t], np.repeat(x, 3, 0).astype(np.float32), rtol=1e-6)
+    np.testing.assert_array_equal(obs, targets)
+
+
+def test_noise_has_the_given_standard_deviations():
+    q, r = 0.3, 2.
+    obs, targets = LorenzSystem(q=q, r=r).sample_data_set(2000, 5, seed=5)
+    np.testing.assert_allclose(np.std(obs - targets), r, rtol=0.02)
+    # the first state is f(m1x_0) plus the process noise
+    first = LorenzData.f(LorenzData.m1x_0.reshape(1, -1))
+    np.testing.assert_allclose(np.std(targets[:, 0] - first), q, rtol=0.05)
+
+
+def test_generate_batch_does_not_depend_on_the_order():
+    system = LorenzSystem(q=0.1, r=0.5, variance=100)
+    forward = [system.generate_batch(bid, 4, 6, random_init=True, seed=7) for bid in range(3)]
+    backward = [system.generate_batch(bid, 4, 6, random_init=True, seed=7) for bid in reversed(range(3))][::-1]
+    for a, b in zip(forward, backward):
+        for x, y in zip(a, b):
+            np.testing.assert_array_equal(x, y)
+    assert not np.allclose(forward[0][1], forward[1][1])
+    assert not np.allclose(forward[0][1], system.generate_batch(0, 4, 6, random_init=True, seed=8)[1])
@@ -0,0 +1,128 @@
+"""
+checks of the batched Taylor transitions of model.py against the original matrix power loops, of the closed form
+Jacobians against autograd and of the batched spherical coordinates against the original toSpherical, copied below.
+Skipped without torch
+run from this directory: python -m pytest test_lorenz_model.py
+"""
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import model
+from parameters import m, J, delta_t, delta_t_test, delta_t_gen, B, C, B_mod, C_mod, delta_t_mod, J_mod, RotMatrix, H_design, H_mod
+
+
+def original_transition(x, B, C, delta_t, J, rotation=None):
+    # f, f_test, f_gen, fInacc and fRotate of the original model.py for a single state x [m, 1]
+    A = torch.add(torch.reshape(torch.matmul(B, x), (m, m)).T, C)
+    if rotation is not None:
+        A = torch.mm(rotation, A)
+    F = torch.eye(m)
+    for j in range(1, J + 1):
+        F_add = (torch.matrix_power(A * delta_t, j) / math.factorial(j))
+        F = torch.add(F, F_add)
+    return torch.matmul(F, x)
+
+
+def original_getJacobian(x, a):
+    # getJacobian of the original model.py, autograd of the single state functions
+    g = {'ObsAcc': lambda y: torch.matmul(H_design, y), 'ModAcc': lambda y: original_transition(y, B, C, delta_t, J),
+         'ObsInacc': lambda y: torch.matmul(H_mod, y),
+         'ModInacc': lambda y: original_transition(y, B_mod, C_mod, delta_t_mod, J_mod)}[a]
+    Jac = torch.autograd.functional.jacobian(g, x.reshape(m, 1))
+    return Jac.view(-1, m)
+
+
+def original_toSpherical(cart):
+    # toSpherical of the original model.py for a single point [3, 1]
+    rho = torch.norm(cart, p=2).view(1,1)
+    phi = torch.atan2(cart[1, ...], cart[0, ...]).view(1, 1)
+    phi = phi + (phi < 0).type_as(phi) * (2 * torch.pi)
+
+    theta = torch.acos(cart[2, ...] / rho).view(1, 1)
+
+    spher = torch.cat([rho, theta, phi], dim=0)
+
+    return spher
+
+
+def batch_autograd_jacobian(g, x):
+    # Jacobians [batch, n, m] of the single state function g at the rows of x
+    return torch.stack([torch.autograd.functional.jacobian(g, state) for state in x])
+
+
+def random_states(batch=50, seed=0):
+    # states of the magnitude of the Lorenz attractor
+    return 10 * torch.randn(batch, m, generator=torch.Generator().manual_seed(seed))
+
+
+@pytest.mark.parametrize("batched, original_args", [
+    (model.f_batch, (B, C, delta_t, J)),
+    (model.f_test_batch, (B, C, delta_t_test, J)),
+    (model.f_gen_batch, (B, C, delta_t_gen, J)),
+    (model.fInacc_batch, (B_mod, C_mod, delta_t_mod, J_mod)),
+    (model.fRotate_batch, (B, C, delta_t, J, RotMatrix))])
+def test_horner_matches_matrix_powers(batched, original_args):
+    x = random_states()
+    original = torch.stack([original_transition(state.reshape(m, 1), *original_args)[:, 0] for state in x])
+    torch.testing.assert_close(batched(x), original, rtol=1e-5, atol=1e-4)
+
+
+def test_single_state_wrappers_keep_the_shape():
+    x = random_states(1)[0]
+    for single, batched in [(model.f, model.f_batch), (model.fInacc, model.fInacc_batch),
+                            (model.fRotate, model.fRotate_batch)]:
+        for shape in [(m, 1), (m,)]:
+            y = single(x.reshape(shape))
+            assert y.shape == shape
+            torch.testing.assert_close(y.reshape(1, m), batched(x.reshape(1, m)))
+
+
+def test_high_order_series_approaches_the_matrix_exponential():
+    x = random_states()
+    torch.testing.assert_close(model.taylor_transition(x, B, C, delta_t, 12),
+                               model.taylor_transition(x, B, C, delta_t, None), rtol=1e-5, atol=1e-4)
+
+
+@pytest.mark.parametrize("jacobian, transition_args", [
+    (model.f_jacobian, (B, C, delta_t, J)),
+    (model.fInacc_jacobian, (B_mod, C_mod, delta_t_mod, J_mod)),
+    (lambda x: model.taylor_transition_jacobian(x, B, C, delta_t, J, RotMatrix), (B, C, delta_t, J, RotMatrix)),
+    (lambda x: model.taylor_transition_jacobian(x, B, C, delta_t, None), (B, C, delta_t, None)),
+    (lambda x: model.taylor_transition_jacobian(x, B, C, delta_t, None, RotMatrix), (B, C, delta_t, None, RotMatrix))])
+def test_transition_jacobians_match_autograd(jacobian, transition_args):
+    x = random_states(20, seed=1)
+    reference = batch_autograd_jacobian(lambda y: model.taylor_transition(y[None], *transition_args)[0], x)
+    torch.testing.assert_close(jacobian(x), reference, rtol=1e-4, atol=1e-4)
+
+
+def test_spherical_jacobian_matches_autograd():
+    x = random_states(20, seed=2)
+    reference = batch_autograd_jacobian(model.toSpherical_batch, x)
+    torch.testing.assert_close(model.h_nonlinear_jacobian(x), reference, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("a", ['ObsAcc', 'ModAcc', 'ObsInacc', 'ModInacc'])
+def test_get_jacobian_matches_original(a):
+    for state in random_states(5, seed=3):
+        for shape in [(m, 1), (m,)]:
+            Jac = model.getJacobian(state.reshape(shape), a)
+            reference = original_getJacobian(state, a)
+            assert Jac.shape == reference.shape
+            torch.testing.assert_close(Jac, reference, rtol=1e-4, atol=1e-4)
+
+
+def test_spherical_coordinates_match_original():
+    x = random_states(50, seed=4)
+    original = torch.cat([original_toSpherical(state.reshape(3, 1)) for state in x], dim=1)
+    torch.testing.assert_close(model.toSpherical(x.T), original)
+    torch.testing.assert_close(model.toSpherical(x[0].reshape(3, 1)), original[:, :1])
+    assert model.toSpherical(x[0].reshape(3, 1)).shape == (3, 1)
+
+
+def test_spherical_round_trip():
+    x = random_states(50, seed=5).reshape(5, 10, m)
+    torch.testing.assert_close(model.toCartesian_batch(model.toSpherical_batch(x)), x, rtol=1e-5, atol=1e-4)
+    torch.testing.assert_close(model.toCartesian(model.toSpherical(x[0].T)), x[0].T, rtol=1e-5, atol=1e-4)
@@ -0,0 +1,66 @@
+"""
+checks of LorenzStream: its batches are the batches of LorenzSystem.generate_batch for consecutive bids with any
+number of workers, seek continues at the given batch and a worker that died raises instead of hanging
+run from this directory: python -m pytest test_lorenz_stream.py
+"""
+import numpy as np
+import pytest
+
+from LorenzData import LorenzStream, LorenzSystem
+
+batch_size, seq_length = 4, 5
+
+
+def make_stream(workers, **kwargs):
+    return LorenzStream(LorenzSystem(q=0.1, r=0.5, variance=1), batch_size, seq_length, workers=workers, seed=3,
+                        timeout=1, **kwargs)
+
+
+def reference_batches(stream, bids):
+    return {bid: stream.system.generate_batch(bid, batch_size, seq_length, stream.random_init, stream.seed)
+            for bid in bids}
+
+
+def find_bid(batch, reference):
+    matches = [bid for bid, (obs, targets) in reference.items()
+               if np.array_equal(batch[0], obs) and np.array_equal(batch[1], targets)]
+    assert len(matches) == 1
+    return matches[0]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_batches_match_generate_batch(workers):
+    draws, start_bid = 12, 5
+    with make_stream(workers, start_bid=start_bid, queue_size=4) as stream:
+        batches = [next(stream) for _ in range(draws)]
+    # a worker can run ahead of the others by the queue size
+    reference = reference_batches(stream, range(start_bid, start_bid + workers * draws))
+    bids = [find_bid(batch, reference) for batch in batches]
+    assert len(set(bids)) == draws
+    # every worker delivers its bids start_bid + worker, start_bid + worker + workers, ... in order, without gaps
+    for worker in range(workers):
+        worker_bids = [bid for bid in bids if (bid - start_bid) % workers == worker]
+        assert worker_bids == list(range(start_bid + worker, start_bid + worker + workers * len(worker_bids), workers))
+    if workers == 1:
+        assert bids == list(range(start_bid, start_bid + draws))
+
+
+def test_seek_continues_at_the_batch():
+    with make_stream(1) as stream:
+        reference = reference_batches(stream, [0, 1, 7, 2])
+        assert find_bid(next(stream), reference) == 0
+        stream.seek(7)
+        assert find_bid(next(stream), reference) == 7
+        stream.seek(2)
+        assert find_bid(next(stream), reference) == 2
+
+
+def test_dead_worker_raises():
+    with make_stream(1) as stream:
+        next(stream)
+        worker = stream._processes[0]
+        worker.terminate()
+        worker.join()
+        # the batches it queued before are not returned, the stream raises right away
+        with pytest.raises(AssertionError):
+            next(stream)
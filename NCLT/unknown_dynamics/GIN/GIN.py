@@ -2,6 +2,7 @@ import tensorflow as tf
 from tensorflow import keras as k
 import numpy as np
 from GINTransitionCell import GINTransitionCell, pack_input, unpack_state
+from InputPipeline import batch_dataset, num_batches
 
 
 class GIN(k.models.Model):
@@ -26,6 +27,7 @@ class GIN(k.models.Model):
         self._output_dim = output_dim
         self._never_invalid = never_invalid
         self._ld_output = np.isscalar(self._output_dim)
+        self.lr = 0.001
 
         # build encoder
         self._enc_hidden_layers = self._time_distribute_layers(self.build_encoder_hidden())
@@ -172,86 +174,132 @@ class GIN(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
-    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size, ratio):
-        
-        ##val_batching
-        Ybatch_val = []
-        Ubatch_val = []
-        
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Ybatch_val.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Ubatch_val.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch_val = np.array(Ybatch_val)
-        Ubatch_val = np.array(Ubatch_val)
-        
-        ##train_batching
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
+    def _window_step(self, model, obs, target):
+        """
+        rmse and its gradients on all weights for one batch of a ratio window, applied by training once per window
+        :return: loss, gradients
+        """
+        with tf.GradientTape() as tape:
+            preds = model(obs)
+            loss = self.rmse(target, preds)
+
+        return loss, tape.gradient(loss, model.trainable_variables)
+
+    def build_optimizers(self, model, example_obs):
+        """
+        persistent optimizer self.train_optimizer, kept for the whole run, so the Adam moments carry over between
+        windows and are part of the checkpoint
+        :param example_obs: one training batch, used to build the model variables
+        self.lr is the learning rate, a float or a k.optimizers.schedules.LearningRateSchedule
+        """
+        model(example_obs)
+        self.train_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.train_optimizer.build(model.trainable_variables)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _window_step, the window sum and the apply on the persistent optimizer stay in training
+        :param example_obs, example_target: one training batch, used to build the model and the input signature. Batch
+            and time dimensions are left unknown in the signature, so the step is traced once for all batch sizes
+            and sequence lengths
+        :param jit_compile: compile the step with XLA. XLA compiles once per distinct input shape
+        :return: tf.function train_step(obs, target) -> loss, gradients. Its experimental_get_tracing_count() is the
+            number of traces, XLA compiles within a trace are not counted
+        """
+        # build model variables eagerly, so the traced function never creates variables
+        if getattr(self, "train_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._window_step(model, obs, target)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
+    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size, ratio,
+                 compiled=False, jit_compile=False, checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False):
+        """
+        the loss summed over every ratio batches is applied at once, through the persistent optimizer
+        :param compiled: run the per batch loss and gradients as a traced tf.function (see make_train_step)
+        :param jit_compile: jit compile the traced step with XLA
+        :param checkpoint_dir: if given, model, optimizer and the epoch are saved there every checkpoint_every epochs
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
+        """
         
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
+        train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
         
         
+        self.build_optimizers(model, Train_Obs[:batch_size])
+        if compiled:
+            train_step = self.make_train_step(model, Train_Obs[:batch_size], Train_Target[:batch_size], jit_compile)
+        variables = model.trainable_variables
+
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, train_optimizer=self.train_optimizer, epoch=start_epoch)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+
         Training_Loss = []
-        for epoch in range(epochs):
+        for epoch in range(int(start_epoch), epochs):
             loss_show_tr = 0.
             loss_show_val = 0.
-            for i in range(len(Ybatch)):
+            # gradient of the loss summed over the window, a partial window at the end of an epoch is dropped
+            window_gradients = None
+            for i, (NetIn, target) in enumerate(train_data):
                 
-                NetIn = Ubatch[i]
-                with tf.GradientTape() as tape:
-                    preds = model(NetIn)
-                    loss = self.rmse(Ybatch[i], preds)
-                    loss_show_tr += loss
+                if compiled:
+                    loss, gradients = train_step(NetIn, target)
+                else:
+                    loss, gradients = self._window_step(model, NetIn, target)
+                loss_show_tr += loss
+                if window_gradients is None:
+                    window_gradients = list(gradients)
+                else:
+                    window_gradients = [w + g for w, g in zip(window_gradients, gradients)]
                 
-                variables = model.trainable_variables
                 if i%(ratio-1)==0 and i!= 0:
-                    gradients = tape.gradient(loss_show_tr, variables)
-                    tf.keras.optimizers.Adam(clipnorm=5.0).apply_gradients(zip(gradients, variables))
+                    self.train_optimizer.apply_gradients(zip(window_gradients, variables))
+                    window_gradients = None
                         
-                rand_sel = np.random.randint(0, len(Ubatch_val))
-                val_preds = model(Ubatch_val[rand_sel])
-                loss_show_val += self.rmse(Ybatch_val[rand_sel], val_preds)    
+                rand_sel = np.random.randint(0, num_valid_batches)
+                val_preds = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                loss_show_val += self.rmse(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)    
                 if i%(ratio-1)==0 and i!= 0:
                     print('val loss %s' % (loss_show_val.numpy() ))
                     loss_show_val = 0
                 
-                #print('epoch %d  loss %s' % (epoch, self.rmse(Ybatch[i], preds).numpy() ))
+                #print('epoch %d  loss %s' % (epoch, self.rmse(target, preds).numpy() ))
                 if i%(ratio-1) ==0 and i !=0:
                     print('epoch %d  loss %s' % (epoch, loss_show_tr.numpy() ))
                     loss_show_tr = 0
                 
                 
                 Training_Loss.append(loss/batch_size)  
+            start_epoch.assign(epoch+1)
+            if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                checkpoint_manager.save(checkpoint_number=epoch+1)
+        if compiled:
+            print('train step traces: %d' % train_step.experimental_get_tracing_count())
         return Training_Loss
     
     def testing(self, model, test_obs, test_targets, batch_size, ratio):
         batch_size = 1
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])        
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
 
         Test_Loss = []
         Test_loss_show = 0
         Test_loss_show_arr = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
+        for i, (NetIn, target) in enumerate(batch_dataset(test_obs, test_targets, batch_size)):
             preds = model(NetIn)
-            loss = self.rmse(Ybatch[i], preds)
+            loss = self.rmse(target, preds)
             #print('test loss: %s' % (loss))
             Test_Loss.append(loss.numpy())
             
@@ -8,6 +8,11 @@ import pandas as pd
 import torch
 import pickle
 import math
+from DatasetCache import cached_arrays
+
+# version of the generated data, part of the cache key of the data sets (see DatasetCache). Increase it with every
+# change of the loading and splitting of NCLT_DG
+DATA_VERSION = 1
 
 dates = ['2012-01-22']
 path_gps = "./dataset/gps.csv"
@@ -359,6 +364,19 @@ def NCLT_DG(split_size):
 
     return train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets
 
+
+def NCLT_DG_cached(split_size, cache_dir="./dataset/cache"):
+    """
+    NCLT_DG(split_size), cached in cache_dir and keyed by split_size and the size and modification time of the raw
+    files (see DatasetCache), so launches with unchanged data skip the loading and splitting
+    """
+    sources = [path_gps, path_gps_rtk, path_gps_rtk_err] + [path_gt % date for date in dates]
+    if not any(os.path.exists(path) for path in sources):
+        sources = [compact_path % date for date in dates]
+    stats = [[path, os.path.getsize(path), os.path.getmtime(path)] for path in sources if os.path.exists(path)]
+    return cached_arrays(cache_dir, dict(generator="nclt", version=DATA_VERSION, split_size=split_size, sources=stats),
+                         lambda: NCLT_DG(split_size))
+
 # if __name__ == '__main__':
 #     for date in dates:
 #         dataset = NCLT('2012-01-22', partition='train')
@@ -33,7 +33,7 @@ def main():
     ratio = 40
     
     ##data Length and Batch_Size
-    train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets = NCLT_data.NCLT_DG(T)
+    train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets = NCLT_data.NCLT_DG_cached(T)
     
     data = [train_obs, train_targets, test_obs, test_targets, valid_obs, valid_targets]
 
@@ -0,0 +1,45 @@
+import numpy as np
+import tensorflow as tf
+
+
+def num_batches(num_seqs, batch_size):
+    """number of full batches, an incomplete last batch is dropped"""
+    return int(num_seqs / batch_size)
+
+
+def batch_dataset(obs, targets, batch_size, shuffle=False, seed=None):
+    """
+    batched and prefetched tf.data.Dataset of (obs, targets) over arrays of shape (num_seqs, T, ...)
+    only batch indices go through tf.data. Each batch is sliced (in order) or gathered (shuffled) from the arrays when
+    it is requested, so the data set is never copied as a whole and memory mapped arrays stay on disk. Batches are
+    prepared on the tf.data threads while the model works on the previous one
+    obs, targets: arrays with the same number of sequences, e.g. PymunkData.images and PymunkData.state
+    shuffle: draw the sequences in a new random order on every pass over the data set
+    seed: seed of the shuffling
+    """
+    # array likes with a shape (memory maps, PymunkFrames) are indexed as they are, without loading them
+    obs, targets = [x if hasattr(x, 'shape') else np.asarray(x) for x in (obs, targets)]
+    if len(obs) != len(targets):
+        raise AssertionError("obs and targets need the same number of sequences")
+    out_dtypes = [tf.as_dtype(obs.dtype), tf.as_dtype(targets.dtype)]
+    out_shapes = [(batch_size,) + obs.shape[1:], (batch_size,) + targets.shape[1:]]
+
+    if shuffle:
+        def fetch(index):
+            # sorted gather reads the arrays front to back
+            index = np.sort(index)
+            return obs[index], targets[index]
+        dataset = tf.data.Dataset.range(len(obs)).shuffle(len(obs), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+    else:
+        def fetch(bid):
+            return obs[bid*batch_size:(bid+1)*batch_size], targets[bid*batch_size:(bid+1)*batch_size]
+        dataset = tf.data.Dataset.range(num_batches(len(obs), batch_size))
+
+    def load(index):
+        batch = tf.numpy_function(fetch, [index], out_dtypes)
+        for tensor, shape in zip(batch, out_shapes):
+            tensor.set_shape(shape)
+        return tuple(batch)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -3,12 +3,13 @@ import tensorflow as tf
 from tensorflow import keras as k
 import numpy as np
 from PiSSMTransitionCell import PiSSMTransitionCell, pack_input, unpack_state
+from InputPipeline import batch_dataset, num_batches
 
 
 class PiSSM(k.models.Model):
 
     def __init__(self, observation_shape, latent_observation_dim, output_dim, num_basis,
-                 trans_net_hidden_units=[], never_invalid=False, cell_type="gin"):
+                 trans_net_hidden_units=[], never_invalid=False, cell_type="gin", inference_basis="argmax"):
         """
         :param observation_shape: shape of the observation to work with
         :param latent_observation_dim: latent observation dimension (m in paper)
@@ -18,6 +19,7 @@ class PiSSM(k.models.Model):
         :param never_invalid: if you know a-priori that the observation valid flag will always be positive you can set
                               this to true for slightly increased performance (obs_valid mask will be ignored)
         :param cell_type: type of cell to use "gin" for our approach, "lstm" or "gru" for baselines
+        :param inference_basis: deterministic basis selection used by testing, "argmax" or "expected" (see call)
         """
         super().__init__()
 
@@ -27,6 +29,10 @@ class PiSSM(k.models.Model):
         self._output_dim = output_dim
         self._never_invalid = never_invalid
         self._ld_output = np.isscalar(self._output_dim)
+        if inference_basis not in ["argmax", "expected"]:
+            raise AssertionError("Invalid inference basis, needs to be 'argmax' or 'expected'")
+        self.inference_basis = inference_basis
+        self.lr = 0.01
 
         # build encoder
         self._enc_hidden_layers = self._time_distribute_layers(self.build_encoder_hidden())
@@ -97,11 +103,14 @@ class PiSSM(k.models.Model):
         """
         raise NotImplementedError
 
-    def call(self, inputs, training=None, mask=None):
+    def call(self, inputs, training=None, mask=None, basis_selection="sample"):
         """
         :param inputs: model inputs (i.e. observations)
         :param training: required by k.models.Models
         :param mask: required by k.models.Model
+        :param basis_selection: "sample" draws the basis of every step and returns its log-probs for reinforce_loss,
+                                "argmax" or "expected" (softmax weighted mixture of the bases) are deterministic and
+                                return an empty logp_list
         :return:
         """
         if isinstance(inputs, tuple) or isinstance(inputs, list):
@@ -118,10 +127,12 @@ class PiSSM(k.models.Model):
 
         # transition
         rkn_in = pack_input(w_mean, w_covar, obs_valid)
+        self._cell.basis_selection = basis_selection
         z = self._layer_rkn(rkn_in)
 
         # post_mean, post_covar = unpack_state(z, self._lsd)
-        post_mean, post_covar, prior_mean, prior_covar, self.transition_matrix, logp_list = z
+        post_mean, post_covar, prior_mean, prior_covar, self.transition_matrix = z[:5]
+        logp_list = z[5] if basis_selection == "sample" else []
         post_covar = tf.concat(post_covar, -1)
 
         # decode
@@ -175,7 +186,7 @@ class PiSSM(k.models.Model):
             ### Baseline+ REINFORCE
             baseline = tf.reduce_mean(reward, axis=0)  # shape [T]
             baseline = tf.expand_dims(baseline, axis=0)  # [1, T]
-            baseline = tf.tile(baseline, [pred_mean.shape[0], 1])  # [batch, T]
+            baseline = tf.tile(baseline, [tf.shape(pred_mean)[0], 1])  # [batch, T]
             logps = tf.squeeze(logp_list, axis=-1) 
 
             reward = tf.stop_gradient(reward)
@@ -202,123 +213,173 @@ class PiSSM(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
-    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size, ratio):
-        
-        ##val_batching
-        Ybatch_val = []
-        Ubatch_val = []
-        
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Ybatch_val.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Ubatch_val.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
-        
-        Ybatch_val = np.array(Ybatch_val)
-        Ubatch_val = np.array(Ubatch_val)
-        
-        ##train_batching
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
+    def _train_step(self, model, obs, target, reinforce_optimizer, phi_optimizer):
+        """
+        one REINFORCE step on the DynamicsNet weights and one NLL step on the remaining weights from a single forward
+        pass. The DynamicsNet input is cut off from the gradient in the cell, so reinforce_loss only reaches the
+        DynamicsNet weights and the NLL has no path to them, one backward pass of the sum gives both gradient groups.
+        If a loss or gradient is not finite, neither optimizer is applied, so the weights stay those of the last
+        finite step
+        :return: reinforce_loss, phi_loss
+        """
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+
+        with tf.GradientTape() as tape:
+            preds, logp_list = model(obs)
+            reinforce_loss = self.reinforce_loss(target, preds, logp_list)
+            phi_loss = self.gaussian_nll(target, preds)
+            loss = reinforce_loss + phi_loss
+
+        gradients = tape.gradient(loss, dynamic_variables + phi_vars)
+        finite = tf.reduce_all([tf.math.is_finite(reinforce_loss), tf.math.is_finite(phi_loss)] +
+                               [tf.reduce_all(tf.math.is_finite(g)) for g in gradients if g is not None])
+
+        def apply_gradients():
+            reinforce_optimizer.apply_gradients(zip(gradients[:len(dynamic_variables)], dynamic_variables))
+            phi_optimizer.apply_gradients(zip(gradients[len(dynamic_variables):], phi_vars))
+            return tf.constant(True)
+        tf.cond(finite, apply_gradients, lambda: tf.constant(False))
+        return reinforce_loss, phi_loss
+
+    def build_optimizers(self, model, example_obs):
+        """
+        persistent optimizers, one per variable group: self.reinforce_optimizer for the DynamicsNet and
+        self.phi_optimizer for all remaining weights. Both are kept for the whole run, so the Adam moments carry over
+        between steps and are part of the checkpoint
+        :param example_obs: one training batch, used to build the model variables
+        self.lr is the learning rate of both optimizers, a float or a k.optimizers.schedules.LearningRateSchedule
+        """
+        model(example_obs)
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+        self.reinforce_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.phi_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0)
+        self.reinforce_optimizer.build(dynamic_variables)
+        self.phi_optimizer.build(phi_vars)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _train_step on the persistent optimizers of build_optimizers
+        :param example_obs, example_target: one training batch, used to build the model and the input signature. Batch
+            and time dimensions are left unknown in the signature, so the step is traced once for all batch sizes
+            and sequence lengths
+        :param jit_compile: compile the step with XLA. XLA compiles once per distinct input shape
+        :return: tf.function train_step(obs, target) -> reinforce_loss, phi_loss. Its experimental_get_tracing_count()
+            is the number of traces, XLA compiles within a trace are not counted
+        """
+        # build model and optimizer variables eagerly, so the traced function never creates variables
+        if getattr(self, "reinforce_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._train_step(model, obs, target, self.reinforce_optimizer, self.phi_optimizer)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
+    def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target, epochs, batch_size, ratio,
+                 compiled=False, jit_compile=False, checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False):
+        """
+        :param compiled: run the training step as a traced tf.function (see make_train_step)
+        :param jit_compile: jit compile the traced training step with XLA
+        :param checkpoint_dir: if given, model, optimizers and the epoch are saved there every checkpoint_every epochs.
+            Training stops at the first step with a non-finite loss, without saving the epoch it diverged in
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
+        """
         
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
+        train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
         
         
+        self.build_optimizers(model, Train_Obs[:batch_size])
+        if compiled:
+            train_step = self.make_train_step(model, Train_Obs[:batch_size], Train_Target[:batch_size], jit_compile)
+
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, reinforce_optimizer=self.reinforce_optimizer,
+                                             phi_optimizer=self.phi_optimizer, epoch=start_epoch)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+
         Training_Loss = []
-        for epoch in range(epochs):
+        diverged = False
+        for epoch in range(int(start_epoch), epochs):
             loss_show_tr = 0.
             loss_show_val = 0.
-            for i in range(len(Ybatch)):
-                
-                NetIn = Ubatch[i]
-                with tf.GradientTape() as tape:
-                    preds, logp_list = model(NetIn)
-                    # loss = self.rmse(Ybatch[i], preds)
-                    reinforce_loss = self.reinforce_loss(Ybatch[i], preds, logp_list)
-                    loss_show_tr += loss
+            for i, (NetIn, target) in enumerate(train_data):
                 
-                ##
-                print('epoch: %d  reinforce_loss: %s' % (epoch, reinforce_loss.numpy()))
-                if np.isnan(reinforce_loss.numpy()):
-                    break
-                dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
-                # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
-                gradients = tape.gradient(reinforce_loss, dynamic_variables)
-                tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(gradients, dynamic_variables))
+                if compiled:
+                    reinforce_loss, phi_loss = train_step(NetIn, target)
+                else:
+                    reinforce_loss, phi_loss = self._train_step(model, NetIn, target,
+                                                                self.reinforce_optimizer, self.phi_optimizer)
 
-
-                ##
-                with tf.GradientTape() as tape2:
-                    preds, _ = model(NetIn)  # recompute
-                    phi_loss = self.gaussian_nll(Ybatch[i], preds)
-                
+                print('epoch: %d  reinforce_loss: %s' % (epoch, reinforce_loss.numpy()))
                 print('epoch: %d  base_loss: %s' % (epoch, phi_loss.numpy()))
-                if np.isnan(phi_loss.numpy()):
+                if not (np.isfinite(reinforce_loss.numpy()) and np.isfinite(phi_loss.numpy())):
+                    diverged = True
                     break
-
-                phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
-                grads_phi = tape2.gradient(phi_loss, phi_vars)
-                tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(grads_phi, phi_vars))
                 ##
                 if i %10==0:
-                    rand_sel = np.random.randint(0, len(Valid_Ubatch))
-                    val_preds, val_logp_list = model(Valid_Ubatch[rand_sel])
-                    val_reinforce_loss = self.reinforce_loss(Valid_Ybatch[rand_sel], val_preds, val_logp_list)
-                    val_phi_loss = self.gaussian_nll(Valid_Ybatch[rand_sel], val_preds)
+                    rand_sel = np.random.randint(0, num_valid_batches)
+                    val_preds, val_logp_list = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                    val_reinforce_loss = self.reinforce_loss(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds, val_logp_list)
+                    val_phi_loss = self.gaussian_nll(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)
                     val_loss = val_reinforce_loss + val_phi_loss
                     print('val loss: %s' % (val_loss.numpy()))
                 
                 loss = phi_loss + reinforce_loss
                 print('epoch: %d  total_loss: %s' % (epoch, loss.numpy()))
-                if np.isnan(loss.numpy()):
-                    break
                             
                 # variables = model.trainable_variables
                 # if i%(ratio-1)==0 and i!= 0:
                 #     gradients = tape.gradient(loss_show_tr, variables)
                 #     tf.keras.optimizers.Adam(clipnorm=5.0).apply_gradients(zip(gradients, variables))
                         
-                # rand_sel = np.random.randint(0, len(Ubatch_val))
-                # val_preds = model(Ubatch_val[rand_sel])
-                # loss_show_val += self.rmse(Ybatch_val[rand_sel], val_preds)    
+                # rand_sel = np.random.randint(0, num_valid_batches)
+                # val_preds = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                # loss_show_val += self.rmse(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)    
                 # if i%(ratio-1)==0 and i!= 0:
                 #     print('val loss %s' % (loss_show_val.numpy() ))
                 #     loss_show_val = 0
                 
-                #print('epoch %d  loss %s' % (epoch, self.rmse(Ybatch[i], preds).numpy() ))
+                #print('epoch %d  loss %s' % (epoch, self.rmse(target, preds).numpy() ))
                 if i%(ratio-1) ==0 and i !=0:
                     print('epoch %d  loss %s' % (epoch, loss.numpy() ))
                     loss = 0
                 
                 
                 Training_Loss.append(loss/batch_size)  
+            if diverged:
+                # the diverged epoch is not checkpointed, resume starts from the last saved epoch
+                print('epoch: %d  training diverged, stopped without saving a checkpoint' % epoch)
+                break
+            start_epoch.assign(epoch+1)
+            if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                checkpoint_manager.save(checkpoint_number=epoch+1)
+        if compiled:
+            print('train step traces: %d' % train_step.experimental_get_tracing_count())
         return Training_Loss
     
     def testing(self, model, test_obs, test_targets, batch_size, ratio):
         batch_size = 1
-        Ybatch = []
-        Ubatch = []
-        
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])        
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
 
         Test_Loss = []
         Test_loss_show = 0
         Test_loss_show_arr = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
-            preds = model(NetIn)
-            loss = self.rmse(Ybatch[i], preds)
+        for i, (NetIn, target) in enumerate(batch_dataset(test_obs, test_targets, batch_size)):
+            preds, _ = model(NetIn, basis_selection = self.inference_basis)
+            loss = self.rmse(target, preds)
             #print('test loss: %s' % (loss))
             Test_Loss.append(loss.numpy())
             
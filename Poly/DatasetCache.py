@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import socket
+import time
+import numpy as np
+
+
+def _to_json(x):
+    # numpy scalars and arrays in the parameters
+    return np.asarray(x).tolist()
+
+
+# seconds between checks of a waiting run whether the entry is done or the lock is free
+LOCK_POLL = 1.0
+
+
+def cache_key(params):
+    """
+    hex digest of the json encoded generator parameters, any change of a parameter or seed gives a new key. The code of
+    the generator is not part of it, params carry a version of the generator (e.g. PolyboxData.DATA_VERSION) that is
+    increased with every change of the data it generates
+    """
+    encoded = json.dumps(params, sort_keys=True, default=_to_json)
+    return hashlib.sha1(encoded.encode()).hexdigest()[:16]
+
+
+def _lock_owner():
+    return "%d %s" % (os.getpid(), socket.gethostname())
+
+
+def _read_lock(lock_path):
+    try:
+        with open(lock_path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _owner_exited(owner):
+    """whether the run "pid hostname" that wrote a lock has exited, only known for runs on this host"""
+    try:
+        pid, host = owner.split(" ", 1)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname() or os.name != "posix":
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _take_over(lock_path, owner):
+    # the runs waiting on the same exited owner race for its lock, only one of them moves it away
+    moved = "%s.%s" % (lock_path, _lock_owner().replace(" ", "."))
+    try:
+        os.rename(lock_path, moved)
+    except OSError:
+        return
+    if _read_lock(moved) == owner:
+        os.remove(moved)
+    else:
+        # another waiting run took over first and holds the lock now
+        os.rename(moved, lock_path)
+
+
+def cached_dir(cache_root, params, generate, lock_timeout=None):
+    """
+    directory cache_root/<cache_key(params)>, filled by generate(path) on the first call and reused afterwards
+    generate writes into cache_root/<cache_key(params)>.partial, which is only renamed once it returns, so an
+    interrupted run never leaves a half written entry. The partial directory is kept for the next run with the same
+    parameters, generators that resume (e.g. PolyboxData.generate_parallel) continue there, others overwrite it.
+    Runs with the same parameters generate one at a time, under the lock file <cache_key(params)>.partial.lock, the
+    others wait and then use the entry of the run that held it. The lock holds "pid hostname" of its run, the lock of
+    a run on this host that was killed is taken over
+    lock_timeout: seconds to wait for a lock that is not taken over (held by a running or a remote run) before
+        raising, None waits until it is released
+    params.json in the entry records the parameters it was generated from
+    """
+    path = os.path.join(cache_root, cache_key(params))
+    if os.path.exists(path):
+        print("using cached data set %s" % path)
+        return path
+
+    os.makedirs(cache_root, exist_ok=True)
+    partial_path = path + ".partial"
+    lock_path = partial_path + ".lock"
+    waiting_since = None
+    while True:
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if os.path.exists(path):
+                print("using cached data set %s" % path)
+                return path
+            owner = _read_lock(lock_path)
+            if owner is not None and _owner_exited(owner):
+                print("taking over %s of the exited run %s" % (lock_path, owner))
+                _take_over(lock_path, owner)
+                continue
+            if waiting_since is None:
+                print("waiting for %s, held by %s" % (lock_path, owner))
+                waiting_since = time.time()
+            elif lock_timeout is not None and time.time() - waiting_since > lock_timeout:
+                raise AssertionError("%s is still held by %s after %s seconds, remove it if that run is gone"
+                                     % (lock_path, owner, lock_timeout))
+            time.sleep(LOCK_POLL)
+
+    try:
+        os.write(lock, _lock_owner().encode())
+        # the run that held the lock before may have finished the entry
+        if os.path.exists(path):
+            print("using cached data set %s" % path)
+        else:
+            os.makedirs(partial_path, exist_ok=True)
+            generate(partial_path)
+            with open(os.path.join(partial_path, "params.json"), "w") as f:
+                json.dump(params, f, sort_keys=True, indent=1, default=_to_json)
+            os.rename(partial_path, path)
+    finally:
+        os.close(lock)
+        os.remove(lock_path)
+    return path
+
+
+def cached_arrays(cache_root, params, generate):
+    """
+    arrays returned by generate(), stored in cache_root/<cache_key(params)>/arrays.npz on the first call and loaded
+    from there afterwards
+    """
+    def save(path):
+        np.savez(os.path.join(path, "arrays.npz"), *generate())
+
+    path = cached_dir(cache_root, params, save)
+    with np.load(os.path.join(path, "arrays.npz")) as arrays:
+        return [arrays["arr_%d" % i] for i in range(len(arrays.files))]
@@ -6,6 +6,7 @@ import numpy as np
 
 from GINTransitionCell import GINTransitionCell, pack_input, unpack_state, pack_state
 from GINSmoothCell import GINSmoothingCell
+from InputPipeline import batch_dataset, num_batches
 
 
 class GIN(k.models.Model):
@@ -175,7 +176,7 @@ class GIN(k.models.Model):
             post_covar = tf.concat(post_covar, -1)
             if self.Smoothing:
                 smooth_mean_init, smooth_covar_init, post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse, transition_matrix_reverse = self.z_time_reverse(z)
-                init_state = pack_state(smooth_mean_init, smooth_covar_init)
+                init_state = self._smoothing_cell.pack_initial_state(smooth_mean_init, smooth_covar_init)
                 post_mean_reverse, post_covar_reverse = self._layer_smooth((post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse,
                                                             transition_matrix_reverse), initial_state = init_state)
                 post_mean_reverse = tf.concat([tf.expand_dims(smooth_mean_init, axis=1), post_mean_reverse], axis=1)
@@ -253,92 +254,151 @@ class GIN(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
+    def _train_step(self, model, obs, target, optimizer):
+        """
+        one NLL step on all weights, returns the loss. If the loss or a gradient is not finite, the optimizer is not
+        applied
+        """
+        with tf.GradientTape() as tape:
+            preds = model(obs)
+            loss = self.gaussian_nll(target, preds)
+
+        variables = model.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        finite = tf.reduce_all([tf.math.is_finite(loss)] +
+                               [tf.reduce_all(tf.math.is_finite(g)) for g in gradients if g is not None])
+
+        def apply_gradients():
+            optimizer.apply_gradients(zip(gradients, variables))
+            return tf.constant(True)
+        tf.cond(finite, apply_gradients, lambda: tf.constant(False))
+        return loss
+
+    def build_optimizers(self, model, example_obs, steps_per_epoch=1):
+        """
+        persistent optimizer self.train_optimizer, kept for the whole run, so the Adam moments carry over between
+        steps and are part of the checkpoint
+        the learning rate decays by lr_decay every lr_decay_it epochs (staircase schedule on the optimizer steps)
+        example_obs: one training batch, used to build the model variables
+        steps_per_epoch: number of training batches per epoch
+        """
+        model(example_obs)
+        self.lr_schedule = k.optimizers.schedules.ExponentialDecay(self.lr, decay_steps=self.lr_decay_it * steps_per_epoch,
+                                                                   decay_rate=self.lr_decay, staircase=True)
+        self.train_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr_schedule, clipnorm=5.0)
+        self.train_optimizer.build(model.trainable_variables)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _train_step on the persistent optimizer of build_optimizers
+        example_obs, example_target: one training batch, used to build the model and the input signature. Batch and
+            time dimensions are left unknown in the signature, so the step is traced once for all batch sizes and
+            sequence lengths
+        jit_compile: compile the step with XLA. XLA compiles once per distinct input shape
+        returns the tf.function, its experimental_get_tracing_count() is the number of traces. XLA compiles within a
+            trace are not counted
+        """
+        # build model and optimizer variables eagerly, so the traced function never creates variables
+        if getattr(self, "train_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._train_step(model, obs, target, self.train_optimizer)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
     def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target,
                  test_obs, test_targets, epochs, batch_size, 
-                 x_epoch, record, fig, ax0, draw_fig):
+                 x_epoch, record, fig, ax0, draw_fig, compiled=False, jit_compile=False,
+                 checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False):
         """
         training procedure
         depending on the task, appropriate loss function is taken account
+        compiled: run the training step as a traced tf.function (see make_train_step), optionally jit compiled by XLA
+        checkpoint_dir: if given, model, optimizer and training progress are saved there every checkpoint_every epochs.
+            Training stops at the first step with a non-finite loss, without saving the epoch it diverged in
+        resume: continue from the latest checkpoint in checkpoint_dir, the loss files are appended to
+        shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
         """
 
-        #valid batching
-        batch_size = batch_size
-        Valid_Ybatch = []
-        Valid_Ubatch = []
-        Valid_ValidBatch = []
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Valid_Ybatch.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Valid_Ubatch.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
-
-        Valid_Ybatch = np.array(Valid_Ybatch)
-        Valid_Ubatch = np.array(Valid_Ubatch)
+        train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
 
-        
-        #train batching
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        ValidBatch = []
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
-
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
+        self.build_optimizers(model, Train_Obs[:batch_size], steps_per_epoch=num_batches(len(Train_Obs), batch_size))
+        if compiled:
+            train_step = self.make_train_step(model, Train_Obs[:batch_size], Train_Target[:batch_size], jit_compile)
 
-        
         Training_Loss = []
-        min_test_loss = 500
-        min_train_loss = 500
-        with open(self.result_path + '/trainloss.txt', 'w') as trl:
-            with open(self.result_path + '/testloss.txt', 'w') as tel:
+        min_test_loss = tf.Variable(500., dtype=tf.float64, trainable=False)
+        min_train_loss = tf.Variable(500., dtype=tf.float64, trainable=False)
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, train_optimizer=self.train_optimizer, epoch=start_epoch,
+                                             min_train_loss=min_train_loss, min_test_loss=min_test_loss)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+        file_mode = 'a' if resume else 'w'
+        with open(self.result_path + '/trainloss.txt', file_mode) as trl:
+            with open(self.result_path + '/testloss.txt', file_mode) as tel:
                 
-                for epoch in range(epochs):
+                diverged = False
+                for epoch in range(int(start_epoch), epochs):
                     train_loss_epoch =[]
-                    for i in range(len(Ybatch)):
-                        NetIn = Ubatch[i]
-                        with tf.GradientTape() as tape:
-                            preds = model(NetIn)
-                            loss = self.gaussian_nll(Ybatch[i], preds)
+                    for i, (NetIn, target) in enumerate(train_data):
+                        if compiled:
+                            loss = train_step(NetIn, target)
+                        else:
+                            loss = self._train_step(model, NetIn, target, self.train_optimizer)
 
                         print('epoch: %d  loss_Gaussian: %s' % (epoch, loss.numpy()))
-                        if np.isnan(loss.numpy()):
+                        if not np.isfinite(loss.numpy()):
+                            diverged = True
                             break
-                            
-                            
-                        variables = model.trainable_variables
-                        gradients = tape.gradient(loss, variables)
-                        tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(gradients, variables))
                         if i %10==0:
-                            rand_sel = np.random.randint(0, len(Valid_Ubatch))
-                            val_preds = model(Valid_Ubatch[rand_sel])
-                            val_loss = self.gaussian_nll(Valid_Ybatch[rand_sel], val_preds)
+                            rand_sel = np.random.randint(0, num_valid_batches)
+                            val_preds = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                            val_loss = self.gaussian_nll(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)
                             print('val loss: %s' % (val_loss.numpy()))
                         
                         
                         train_loss_epoch.append(loss)
                         Training_Loss.append(loss)  
 
+                    if diverged:
+                        # the diverged epoch is not checkpointed, resume starts from the last saved epoch
+                        trl.write("epoch: {}, diverged \n".format(epoch))
+                        print('epoch: %d  training diverged, stopped without saving a checkpoint' % epoch)
+                        break
+
                     average_train_loss = np.mean(np.array(train_loss_epoch))
                     
                     if (average_train_loss < min_train_loss):
-                        min_train_loss = average_train_loss
-                        trl.write("*********************************min_train_loss:{} \n".format(min_train_loss))
+                        min_train_loss.assign(average_train_loss)
+                        trl.write("*********************************min_train_loss:{} \n".format(average_train_loss))
                     average_test_loss = np.mean(np.array(self.testing(model, test_obs, test_targets, batch_size)))
                     if (average_test_loss < min_test_loss):
-                        min_test_loss = average_test_loss
-                        tel.write("*********************************min_train_loss:{} \n".format(min_test_loss))
+                        min_test_loss.assign(average_test_loss)
+                        tel.write("*********************************min_train_loss:{} \n".format(average_test_loss))
                     tel.write("epoch: {}, test_loss:{} \n".format(epoch, average_test_loss))
                     trl.write("epoch: {}, train_loss:{} \n".format(epoch, average_train_loss))
                     if np.isnan(average_train_loss):
                         break
                     self.draw_curve(epoch, average_train_loss, average_test_loss, record, fig, ax0, x_epoch, batch_size, batch_size)
+                    if compiled:
+                        print('train step traces: %d' % train_step.experimental_get_tracing_count())
 
                     if ((epoch+1) % self.lr_decay_it == 0):
-                        self.lr *= self.lr_decay
-                        print(self.lr)
+                        print(float(self.lr_schedule(self.train_optimizer.iterations)))
+                    start_epoch.assign(epoch+1)
+                    if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                        checkpoint_manager.save(checkpoint_number=epoch+1)
                     
             tel.close()
         trl.close()
@@ -350,24 +410,10 @@ class GIN(k.models.Model):
         depending on the task, appropriate loss function is taken account
         """
         
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        ValidBatch = []
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])
-
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
-
-        
         Test_Loss = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
+        for NetIn, target in batch_dataset(test_obs, test_targets, batch_size):
             preds = model(NetIn)
-            loss = self.gaussian_nll(Ybatch[i], preds)
+            loss = self.gaussian_nll(target, preds)
             print('test loss: %s' % (loss.numpy()))
             Test_Loss.append(loss)
         return Test_Loss
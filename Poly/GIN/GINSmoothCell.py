@@ -76,28 +76,26 @@ class GINSmoothingCell(k.layers.Layer):
         self.init_KF_matrices = init_KF_matrices
         self.eye_init = lambda shape, dtype=np.float32: np.eye(*shape, dtype=dtype)
         self.USE_CONV = USE_CONV 
+        # hidden state of the J gru cell is carried in the RNN state after mean and covariance
+        self.GRUJunit = 2 * self._lsd
         
     def build(self, input_shape):
         input_shape = input_shape[0]      
         
         if self.USE_CONV == True:
             #build J gru parameters
-            self.GRUJunit = 2 * self._lsd 
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(J, lsd^2)
             self.LastWeightKG = self.add_weight(shape=[2 * self._lsd * self._lsd , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(4*J, J)
             self.NextWeightKG = self.add_weight(shape=[self.GRUJunit ,2 * self._lsd * self._lsd], name="grunextweight", initializer='random_normal') #(gru out, J*4)
             self.PrevWeightKG = self.add_weight(shape=[3*self._lsd , self.GRUJunit*2], name="gruprevweight", initializer='random_normal')# ( lsd^2, gru in)
             self.GRUJ = k.layers.GRUCell( self.GRUJunit)
-            self.GRUJ_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUJunit ])
         if self.USE_CONV == False:
             #build J gru parameters
-            self.GRUJunit = 2 * self._lsd 
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(J, lsd^2)
             self.LastWeightKG = self.add_weight(shape=[2 * self._lsd * self._lsd , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(4*J, J)
             self.NextWeightKG = self.add_weight(shape=[self.GRUJunit ,2 * self._lsd * self._lsd], name="grunextweight", initializer='random_normal') #(gru out, J*4)
             self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 , self.GRUJunit*2], name="gruprevweight", initializer='random_normal')# ( lsd^2, gru in)
             self.GRUJ = k.layers.GRUCell( self.GRUJunit)
-            self.GRUJ_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUJunit ])
         
         #build dense layer for diag covariance
         self._layer_covar_gru = k.layers.Dense(self._lsd, activation=lambda x: k.activations.elu(x) + 1)
@@ -108,7 +106,7 @@ class GINSmoothingCell(k.layers.Layer):
         """ similar to the LSTM and GRU cells. The names and parameters of the GIN cell 
         mathch with those of the RNN based cells
         inputs: Mean and covariance vectors 
-        states: Last Latent Posterior State 
+        states: Last Latent Posterior State and the hidden state of the J gru cell
         
         """
         # unpack inputs; filt_mean_t = mu_t|t
@@ -118,34 +116,36 @@ class GINSmoothingCell(k.layers.Layer):
         #                transition_matrix_tp1 = A_t+1
         filt_t_mean, filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix = inputs
         # self.A_tp1_matrix = transition_tp1_matrix
-        smooth_tp1_mean, smooth_tp1_covar = unpack_state( states[0], self._lsd)  
+        smooth_tp1_mean, smooth_tp1_covar = unpack_state( states[0][..., :self._lsd + self._lsd**2], self._lsd)  
+        gru_j_state = states[0][..., self._lsd + self._lsd**2:]
         
         # # update step (current smooth from next smooth)
+        J, gru_j_state = self._predict_J_gru(prior_tp1_covar, gru_j_state)
         smooth_t_mean, smooth_t_covar = self._update(smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, 
-                                filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix)
+                                filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix, J)
 
-        post_state = pack_state(smooth_t_mean, smooth_t_covar)
+        post_state = tf.concat([pack_state(smooth_t_mean, smooth_t_covar), gru_j_state], -1)
 
         
         return [smooth_t_mean, smooth_t_covar], [post_state]
     
 
     
-    def _predict_J_gru(self, prior_covar):
+    def _predict_J_gru(self, prior_covar, gru_j_state):
         
         if self.USE_CONV == True:
             #propagate covar matrix through the conv2d
-            prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+            prior_covar_matrix = tf.reshape(prior_covar, [-1, self._lsd, self._lsd])
             prior_covar_matrix = tf.expand_dims(prior_covar_matrix, -1)
             prior_covar = self._prop_to_layers(prior_covar_matrix, self.build_conv_gru())
             
 
         in_GRU = tf.matmul(prior_covar, self.PrevWeightKG)
-        J, _ = self.GRUJ(in_GRU, self.GRUJ_state)
-        self.GRUKG_state = J # next self.GRUKG_state
+        J, _ = self.GRUJ(in_GRU, gru_j_state)
+        gru_j_state = J # next gru_j_state
         J = tf.matmul(J, self.NextWeightKG)
         J = tf.matmul(J, self.LastWeightKG)
-        J = tf.reshape(J, [J.shape[0], self._lsd, self._lsd])
+        J = tf.reshape(J, [-1, self._lsd, self._lsd])
 
         # J = tf.matmul(J, self.NextWeightKG)
         # J = tf.matmul(J, self.LastWeightKG)
@@ -157,7 +157,7 @@ class GINSmoothingCell(k.layers.Layer):
         # Positive_J = elup_Diag_elements + ( J - tf.linalg.diag(tf.linalg.diag_part(J)))
         # J = tf.matmul(tf.matmul(prior_covar, tf.transpose(self.A_tp1_matrix)), tf.matmul(Positive_J, tf.transpose(Positive_J)))
 
-        return J
+        return J, gru_j_state
     
     def build_conv_gru(self):
         return [
@@ -177,13 +177,11 @@ class GINSmoothingCell(k.layers.Layer):
 
 
     def _update(self, smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar, prior_tp1_mean,
-                                             prior_tp1_covar, transition_tp1_matrix):
-        
-        J = self._predict_J_gru( prior_tp1_covar)
+                                             prior_tp1_covar, transition_tp1_matrix, J):
 
-        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [smooth_tp1_covar.shape[0], self._lsd, self._lsd])
-        filt_t_covar = tf.reshape(filt_t_covar, [filt_t_covar.shape[0], self._lsd, self._lsd])
-        prior_tp1_covar = tf.reshape(prior_tp1_covar, [prior_tp1_covar.shape[0], self._lsd, self._lsd])
+        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [-1, self._lsd, self._lsd])
+        filt_t_covar = tf.reshape(filt_t_covar, [-1, self._lsd, self._lsd])
+        prior_tp1_covar = tf.reshape(prior_tp1_covar, [-1, self._lsd, self._lsd])
 
         
         mu_es = smooth_tp1_mean - tf.squeeze( tf.matmul(transition_tp1_matrix, tf.expand_dims( filt_t_mean, -1) ), -1)
@@ -201,15 +199,15 @@ class GINSmoothingCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         smooth_t_covar = elup_Diag_elements + ( smooth_t_covar - tf.linalg.diag(tf.linalg.diag_part(smooth_t_covar)))
         #
-        smooth_t_covar = tf.reshape(smooth_t_covar, [smooth_t_covar.shape[0], -1])
+        smooth_t_covar = tf.reshape(smooth_t_covar, [-1, self._lsd**2])
         return smooth_t_mean, smooth_t_covar # mu_t|t, sigma_t|t at t
 
     def _update_conventional(self, smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar, prior_tp1_mean,
                                              prior_tp1_covar, transition_tp1_matrix):
         
-        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [smooth_tp1_covar.shape[0], self._lsd, self._lsd])
-        filt_t_covar = tf.reshape(filt_t_covar, [filt_t_covar.shape[0], self._lsd, self._lsd])
-        prior_tp1_covar = tf.reshape(prior_tp1_covar, [prior_tp1_covar.shape[0], self._lsd, self._lsd])
+        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [-1, self._lsd, self._lsd])
+        filt_t_covar = tf.reshape(filt_t_covar, [-1, self._lsd, self._lsd])
+        prior_tp1_covar = tf.reshape(prior_tp1_covar, [-1, self._lsd, self._lsd])
 
         #
         Diag_elements = tf.linalg.diag_part(prior_tp1_covar)
@@ -237,7 +235,7 @@ class GINSmoothingCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         smooth_t_covar = elup_Diag_elements + ( smooth_t_covar - tf.linalg.diag(tf.linalg.diag_part(smooth_t_covar)))
         #
-        smooth_t_covar = tf.reshape(smooth_t_covar, [smooth_t_covar.shape[0], -1])
+        smooth_t_covar = tf.reshape(smooth_t_covar, [-1, self._lsd**2])
         return smooth_t_mean, smooth_t_covar # mu_t|t, sigma_t|t at t
         
     
@@ -249,9 +247,16 @@ class GINSmoothingCell(k.layers.Layer):
             h = layer(h)
         return h
     
+    def pack_initial_state(self, smooth_mean_init, smooth_covar_init):
+        """
+        initial RNN state of the backward pass: last filtered mean and covariance and a fresh J gru state
+        """
+        initial_gru_j_state = self.init_KF_matrices * tf.ones([tf.shape(smooth_mean_init)[0], self.GRUJunit], dtype=smooth_mean_init.dtype)
+        return tf.concat([pack_state(smooth_mean_init, smooth_covar_init), initial_gru_j_state], -1)
+
     @property
     def state_size(self):
         """ state size as a required function of RNN based cell"""
-        return self._lsd + self._lsd**2
+        return self._lsd + self._lsd**2 + self.GRUJunit
         # return [(k.layers.Input(shape=(None, self._lsd)), k.layers.Input(shape=(None, self._lsd**2)))]
         
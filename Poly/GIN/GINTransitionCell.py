@@ -145,6 +145,9 @@ class GINTransitionCell(k.layers.Layer):
         self.KG_InputSize = KG_InputSize
         self.Xgru_InputSize = Xgru_InputSize
         self.Fgru_InputSize = Fgru_InputSize
+        # hidden states of the KG and Q gru cells are part of the RNN state, Q has none unless a gru is used
+        self.GRUKGunit = self.KG_Units
+        self.GRUQunit = {"Fgru": self.Fgru_Units, "Xgru": self.Xgru_Units}.get(self.Qnetwork, 0)
         
     def build(self, input_shape):
         
@@ -192,54 +195,42 @@ class GINTransitionCell(k.layers.Layer):
             
         if self.Qnetwork == "Fgru":
             #build Q gru parameters
-            self.GRUQunit = self.Fgru_Units
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lod * self._lod], name="grulastweight", initializer='random_normal') #(KG, lod^2)
             self.NextWeightGRUQ = self.add_weight(shape=[self.GRUQunit , self._lsd], name="grunextweight", initializer='random_normal') #(gru out, Q)
             self.PrevWeightGRUQ = self.add_weight(shape=[  self._lsd**2 , self.Fgru_InputSize ], name="gruprevweight", initializer='random_normal')# (2*lsd, gru in)
             self.GRUQ = k.layers.GRUCell( self.GRUQunit)
-            self.GRUQ_state = self.init_Q_matrices * tf.ones([input_shape[0],  self.GRUQunit ])
             
         if self.Qnetwork == "Xgru":
             #build Q gru parameters
-            self.GRUQunit = self.Xgru_Units
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lod * self._lod], name="grulastweight", initializer='random_normal') #(KG, lod^2)
             self.NextWeightGRUQ = self.add_weight(shape=[self.GRUQunit , self._lsd], name="grunextweight", initializer='random_normal') #(gru out, Q)
             self.PrevWeightGRUQ = self.add_weight(shape=[  self._lsd , self.Xgru_InputSize ], name="gruprevweight", initializer='random_normal')# (2*lsd, gru in)
             self.GRUQ = k.layers.GRUCell( self.GRUQunit)
-            self.GRUQ_state = self.init_Q_matrices * tf.ones([input_shape[0],  self.GRUQunit ])
             
         
         
         if self.USE_CONV == True:
             #build KG gru parameters
             if self.USE_MLP_AFTER_KGGRU == True:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[4 * self._lsd * self._lod , self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(4*KG, KG)
                 self.NextWeightKG = self.add_weight(shape=[self.GRUKGunit ,4 * self._lsd * self._lod], name="grunextweight", initializer='random_normal') #(gru out, KG*4)
                 self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
             else:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[self.GRUKGunit, self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(gru out, KG)
                 self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
         if self.USE_CONV == False:
             #build KG gru parameters
             if self.USE_MLP_AFTER_KGGRU == True:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[4 * self._lsd * self._lod , self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(4*KG, KG)
                 self.NextWeightKG = self.add_weight(shape=[self.GRUKGunit ,4 * self._lsd * self._lod], name="grunextweight", initializer='random_normal') #(gru out, KG*4)
                 self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
             else:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[self.GRUKGunit, self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(gru out, KG)
                 self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
         
         #build dense layer for diag covariance
         self._layer_covar_gru = k.layers.Dense(self._lsd, activation=lambda x: k.activations.elu(x) + 1)
@@ -250,22 +241,23 @@ class GINTransitionCell(k.layers.Layer):
         """ similar to the LSTM and GRU cells. The names and parameters of the GIN cell 
         mathch with those of the RNN based cells
         inputs: Mean and covariance vectors 
-        states: Last Latent Posterior State 
+        states: Last Latent Posterior State and the hidden states of the KG and Q gru cells
         
         """
         # unpack inputs
         obs_mean, obs_covar, obs_valid = unpack_input(inputs)
-        state_mean, state_covar = states[0]  # mu_t-1 and sigma_t-1 at time t
+        state_mean, state_covar, gru_kg_state, gru_q_state = states[0]  # mu_t-1 and sigma_t-1 at time t
 
         # predict step (next prior from current posterior (i.e. cell state))
-        prior_mean, prior_covar = self._predict(state_mean, state_covar) # mu_t|t-1 and sigma_t|t-1 at time t
+        prior_mean, prior_covar, gru_q_state = self._predict(state_mean, state_covar, gru_q_state) # mu_t|t-1 and sigma_t|t-1 at time t
         
 
         # update step (current posterior from current prior)
+        KG, gru_kg_state = self._predict_kg_gru(prior_covar, obs_covar, gru_kg_state)
         if self._never_invalid:
-            dec_mean, dec_covar = self._update(prior_mean, prior_covar, obs_mean, obs_covar)# mu_t|t  and sigma_t|t  at time t
+            dec_mean, dec_covar = self._update(prior_mean, prior_covar, obs_mean, obs_covar, KG)# mu_t|t  and sigma_t|t  at time t
         else:
-            dec_mean, dec_covar = self._masked_update(prior_mean, prior_covar, obs_mean, obs_covar, obs_valid)
+            dec_mean, dec_covar = self._masked_update(prior_mean, prior_covar, obs_mean, obs_covar, obs_valid, KG)
         
 
         # pack outputs;[ dec_mean = mu_t|t, (posterior_mean, i.e. mean filtered),
@@ -275,13 +267,13 @@ class GINTransitionCell(k.layers.Layer):
                        # transition_matrix = A_t
         output = [dec_mean, dec_covar, prior_mean, prior_covar, self.transition_matrix]
         # pack states
-        post_state = (dec_mean, dec_covar)
+        post_state = (dec_mean, dec_covar, gru_kg_state, gru_q_state)
         
         return output, [post_state]
     
     
 
-    def _predict(self, post_mean, prior_covar):
+    def _predict(self, post_mean, prior_covar, gru_q_state):
         """ 
         Performs prediction step
         
@@ -311,73 +303,73 @@ class GINTransitionCell(k.layers.Layer):
         new_mean = tf.squeeze(tf.matmul(self.transition_matrix, expanded_state_mean), -1)
         
         #compute Q 
-        prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+        prior_covar_matrix = tf.reshape(prior_covar, [-1, self._lsd, self._lsd])
         if self.Qnetwork == "Fmlp":
             Q = self._predict_q_Fmlp(self.transition_matrix)
             new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "Fgru":
-            Q = self._predict_q_Fgru(self.transition_matrix)
+            Q, gru_q_state = self._predict_q_Fgru(self.transition_matrix, gru_q_state)
             new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "Xmlp":
             Q = self._predict_q_Xmlp(post_mean)
             new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "Xgru":
-            Q = self._predict_q_Xgru(post_mean)
+            Q, gru_q_state = self._predict_q_Xgru(post_mean, gru_q_state)
             new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "nothing":
             # Q = self._predict_q_Xgru(post_mean)
             new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) 
-        new_covar = tf.reshape(new_covar, [new_covar.shape[0], -1])
+        new_covar = tf.reshape(new_covar, [-1, self._lsd**2])
      
-        return new_mean, new_covar
+        return new_mean, new_covar, gru_q_state
     
     def _predict_q_Fmlp(self, transition_matrix): # F_t is used
-        stacked_states = tf.reshape(transition_matrix, [transition_matrix.shape[0], -1])
+        stacked_states = tf.reshape(transition_matrix, [-1, self._lsd**2])
         Q = self._layer_Q_MLP(stacked_states)   
         return Q
     
     def _predict_q_Xmlp(self, state_mean): # state_mean = mu_t-1|t-1
-        stacked_states = tf.reshape(state_mean, [state_mean.shape[0], -1])
+        stacked_states = tf.reshape(state_mean, [-1, self._lsd])
         Q = self._layer_Q_MLP(stacked_states)   
         return Q
     
-    def _predict_q_Fgru(self, transition_matrix): # F_t is used
-        stacked_states = tf.reshape(transition_matrix, [transition_matrix.shape[0], -1])
+    def _predict_q_Fgru(self, transition_matrix, gru_q_state): # F_t is used
+        stacked_states = tf.reshape(transition_matrix, [-1, self._lsd**2])
         in_GRU = tf.matmul(stacked_states, self.PrevWeightGRUQ)
-        Q, _ = self.GRUQ(in_GRU, self.GRUQ_state)
-        self.GRUQ_state = Q # next self.GRUQ_state
+        Q, _ = self.GRUQ(in_GRU, gru_q_state)
+        gru_q_state = Q # next gru_q_state
         Q = tf.matmul(Q, self.NextWeightGRUQ)
         Q = elup1(Q)
-        return Q
+        return Q, gru_q_state
     
-    def _predict_q_Xgru(self, state_mean): # state_mean = mu_t-1|t-1
+    def _predict_q_Xgru(self, state_mean, gru_q_state): # state_mean = mu_t-1|t-1
         # stacked_states = tf.concat([state_mean, prior_mean], axis=-1)
         in_GRU = tf.matmul(state_mean, self.PrevWeightGRUQ)
-        Q, _ = self.GRUQ(in_GRU, self.GRUQ_state)
-        self.GRUQ_state = Q # next self.GRUQ_state
+        Q, _ = self.GRUQ(in_GRU, gru_q_state)
+        gru_q_state = Q # next gru_q_state
         Q = tf.matmul(Q, self.NextWeightGRUQ)
         Q = elup1(Q)
-        return Q
+        return Q, gru_q_state
     
-    def _predict_kg_gru(self, prior_covar, obs_covar):
+    def _predict_kg_gru(self, prior_covar, obs_covar, gru_kg_state):
         
         if self.USE_CONV == True:
             #propagate covar matrix through the conv2d
-            prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+            prior_covar_matrix = tf.reshape(prior_covar, [-1, self._lsd, self._lsd])
             prior_covar_matrix = tf.expand_dims(prior_covar_matrix, -1)
             prior_covar = self._prop_to_layers(prior_covar_matrix, self.build_conv_gru())
             
         #
         stacked_covars = tf.concat([prior_covar, obs_covar], axis=-1)
         in_GRU = tf.matmul(stacked_covars, self.PrevWeightKG)
-        KG, _ = self.GRUKG(in_GRU, self.GRUKG_state)
-        self.GRUKG_state = KG # next self.GRUKG_state
+        KG, _ = self.GRUKG(in_GRU, gru_kg_state)
+        gru_kg_state = KG # next gru_kg_state
         if self.USE_MLP_AFTER_KGGRU == True:
             KG = tf.matmul(KG, self.NextWeightKG)
             KG = tf.matmul(KG, self.LastWeightKG)
         else:
             KG = tf.matmul(KG, self.LastWeightKG)
-        KG = tf.reshape(KG, [KG.shape[0], self._lsd, self._lod])
+        KG = tf.reshape(KG, [-1, self._lsd, self._lod])
 
         # KG = tf.matmul(KG, self.NextWeightKG)
         # KG = tf.matmul(KG, self.LastWeightKG)
@@ -389,7 +381,7 @@ class GINTransitionCell(k.layers.Layer):
         # Positive_KG = elup_Diag_elements + ( KG - tf.linalg.diag(tf.linalg.diag_part(KG)))
         # KG = tf.matmul(tf.matmul(prior_covar, tf.transpose(self.H_matrix)), tf.matmul(Positive_KG, tf.transpose(Positive_KG)))
 
-        return KG
+        return KG, gru_kg_state
     
     def build_conv_gru(self):
         return [
@@ -407,37 +399,34 @@ class GINTransitionCell(k.layers.Layer):
             # 3: Dense Layer
             k.layers.Dense(3*self._lsd, activation=k.activations.linear, name="dense gru")]
 
-    def _masked_update(self, prior_mean, prior_covar, obs_mean, obs_covar, obs_valid):
+    def _masked_update(self, prior_mean, prior_covar, obs_mean, obs_covar, obs_valid, KG):
         
 
-        posterior_mean, posterior_covar_vector = self._update(prior_mean, prior_covar, obs_mean, obs_covar)
+        posterior_mean, posterior_covar_vector = self._update(prior_mean, prior_covar, obs_mean, obs_covar, KG)
         
         #select posterior if obs is available, otherwise select prior
+        #obs_valid is [batch], expand it so one tf.where broadcasts over the whole batch
+        obs_valid = tf.expand_dims(obs_valid, -1)
         #select mean
-        masked_mean = tf.squeeze(tf.convert_to_tensor([tf.where(obs_valid[i], posterior_mean[i], prior_mean[i]) for i in range(len(obs_valid))],
-                                 dtype=tf.float32)) # masked_mean = posterior_mean if obs_valid else prior_mean
-        
+        masked_mean = tf.where(obs_valid, posterior_mean, prior_mean) # masked_mean = posterior_mean if obs_valid else prior_mean
         
         #select covar        
-        masked_covar = tf.convert_to_tensor([tf.where(obs_valid[i], posterior_covar_vector[i], prior_covar[i]) for i in range(len(obs_valid))],
-                                 dtype=tf.float32) # masked_mean = posterior_mean if obs_valid else prior_mean
+        masked_covar = tf.where(obs_valid, posterior_covar_vector, prior_covar) # masked_covar = posterior_covar if obs_valid else prior_covar
         
         return masked_mean, masked_covar
 
-    def _update(self, prior_mean, prior_covar, obs_mean, obs_covar):
-        #(mu_t|t-1, sigma_t|t-1, obs_mu_t, obs_covar_t)
-        
+    def _update(self, prior_mean, prior_covar, obs_mean, obs_covar, KG):
+        #(mu_t|t-1, sigma_t|t-1, obs_mu_t, obs_covar_t, KG_t)
         
-        KG = self._predict_kg_gru( prior_covar, obs_covar)
         
         # posterior mean
         expanded_prior_mean_mean = tf.expand_dims(prior_mean, -1)
         expanded_obs_mean = tf.expand_dims(obs_mean, -1)
         diff_y = expanded_obs_mean - tf.matmul(self.H_matrix, expanded_prior_mean_mean)
-        posterior_mean = prior_mean - tf.squeeze(tf.matmul(KG, diff_y))
+        posterior_mean = prior_mean - tf.squeeze(tf.matmul(KG, diff_y), -1)
         
         #posterior covar
-        prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+        prior_covar_matrix = tf.reshape(prior_covar, [-1, self._lsd, self._lsd])
         S = tf.matmul( tf.matmul(self.H_matrix , prior_covar_matrix), tf.transpose(self.H_matrix, perm=[0, 2, 1])) + tf.linalg.diag(obs_covar)
         posterior_covar_matrix = prior_covar_matrix - tf.matmul(tf.matmul(KG,S), tf.transpose(KG, perm=[0, 2, 1]))
         #
@@ -446,7 +435,7 @@ class GINTransitionCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         posterior_covar_matrix = elup_Diag_elements + ( posterior_covar_matrix - tf.linalg.diag(tf.linalg.diag_part(posterior_covar_matrix)))
         #
-        posterior_covar_vector = tf.reshape(posterior_covar_matrix, [posterior_covar_matrix.shape[0], -1])
+        posterior_covar_vector = tf.reshape(posterior_covar_matrix, [-1, self._lsd**2])
         return posterior_mean, posterior_covar_vector # mu_t|t, sigma_t|t at t
         
     
@@ -457,8 +446,11 @@ class GINTransitionCell(k.layers.Layer):
         """
         initial_mean = tf.zeros([batch_size,  self._lsd], dtype=dtype)
         initial_covar = tf.ones([batch_size,  self._lsd * self._lsd], dtype=dtype)
+        # gru hidden states start from their init value at the beginning of every sequence
+        initial_gru_kg_state = self.init_KF_matrices * tf.ones([batch_size, self.GRUKGunit], dtype=dtype)
+        initial_gru_q_state = self.init_Q_matrices * tf.ones([batch_size, self.GRUQunit], dtype=dtype)
         
-        return [(initial_mean, initial_covar)]
+        return [(initial_mean, initial_covar, initial_gru_kg_state, initial_gru_q_state)]
     
     @staticmethod
     def _prop_to_layers(inputs, convlayers):
@@ -471,4 +463,4 @@ class GINTransitionCell(k.layers.Layer):
     @property
     def state_size(self):
         """ state size as a required function of RNN based cell"""
-        return self._lsd + self._lsd**2
\ No newline at end of file
+        return self._lsd + self._lsd**2 + self.GRUKGunit + self.GRUQunit
\ No newline at end of file
@@ -1,15 +1,53 @@
 import numpy as np
+import os
+
+
+class PymunkFrames(object):
+    """ float32 frames (sequences, timesteps, d1, d2, 1) on top of memory mapped uint8 or bit packed frames, bit
+    packed frames decode to the occupancy 0 or 1
+
+    Indexing over the leading axes decodes only the selected frames, everything else stays on disk.
+    """
+    def __init__(self, frames, packed):
+        self.frames = frames
+        self.packed = packed
+        width = frames.shape[-1] * 8 if packed else frames.shape[-1]
+        self.shape = frames.shape[:-1] + (width, 1)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        frames = np.asarray(self.frames[index])
+        if self.packed:
+            frames = np.unpackbits(frames, axis=-1).astype(np.float32)
+        else:
+            frames = frames.astype(np.float32) / 255
+        return np.expand_dims(frames, axis=-1)
 
 
 class PymunkData(object):
     """ Load sequences of images
 
+    file_path: a .npz file, or the base path of the .npy files written by BallBox.run with save='uint8' or 'bits'.
+        The latter are memory mapped and self.images decodes them per batch (see PymunkFrames). Frames saved as 'bits'
+        decode to 0 or 1 for every pixel, so they differ from the 'uint8' frames of the same data set wherever the
+        render is not binary (walls, ball outline), see BallBox.run
     """
     def __init__(self, file_path):
         # Load data
-        npzfile = np.load(file_path)
-        self.images = npzfile['images'].astype(np.float32)
-        self.images = np.expand_dims(self.images, axis=-1)
+        if file_path.endswith('.npz'):
+            npzfile = np.load(file_path)
+            self.images = npzfile['images'].astype(np.float32)
+            self.images = np.expand_dims(self.images, axis=-1)
+            state = npzfile['state'] if 'state' in npzfile else None
+        else:
+            packed = os.path.exists(file_path + '_bits.npy')
+            frames = np.load(file_path + ('_bits.npy' if packed else '_images.npy'), mmap_mode='r')
+            self.images = PymunkFrames(frames, packed)
+            state = np.load(file_path + '_state.npy') if os.path.exists(file_path + '_state.npy') else None
 
         
         # self.target = self.images[:, :-1, ...]
@@ -18,16 +56,14 @@ class PymunkData(object):
         #     self.images = (self.images > 0).astype('float32')
 
         # Load ground truth position and velocity (if present). This is not used in the KVAE experiments in the paper.
-        if 'state' in npzfile:
-            # Only load the position, not velocity
-            self.state = npzfile['state'].astype(np.float32)[:, :, :2]
-            self.velocity = npzfile['state'].astype(np.float32)[:, :, 2:]
-            self.pos_velocity = npzfile['state'].astype(np.float32)[:, :]
-            # Normalize the mean
-            self.state = self.state - self.state.mean(axis=(0, 1))
-
+        if state is not None:
+            # raw velocity and normalized position are views, only the raw and the normalized state are kept
+            state = state.astype(np.float32)
+            self.velocity = state[:, :, 2:]
             # Normalize the pos_velocity 
-            self.pos_velocity = self.pos_velocity - self.pos_velocity.mean(axis=(0, 1))
+            self.pos_velocity = state - state.mean(axis=(0, 1))
+            # Only the position, normalized to zero mean
+            self.state = self.pos_velocity[:, :, :2]
             # Set state dimension
             self.state_dim = self.state.shape[-1]
 
@@ -2,6 +2,7 @@ import tensorflow as tf
 from tensorflow import keras as k
 import numpy as np
 from LayerNormalizer import LayerNormalizer
+from PiSSMTransitionCell import packed_covar_size, pack_covar, unpack_covar, pack_low_rank_covar, unpack_low_rank_covar, tria
 
 
 
@@ -43,6 +44,70 @@ def unpack_input_smooth(input_as_vector):
     return filt_mean, filt_covar
 
 
+def compose_affine(late, early):
+    """
+    (E, g, C) of applying the affine step early and then late, s -> E s + g, P -> E P E^T + C
+    """
+    E_late, g_late, C_late = late
+    E_early, g_early, C_early = early
+    E = tf.matmul(E_late, E_early)
+    g = g_late + tf.squeeze(tf.matmul(E_late, tf.expand_dims(g_early, -1)), -1)
+    C = C_late + tf.matmul(tf.matmul(E_late, C_early), E_late, transpose_b=True)
+    return E, g, C
+
+
+def affine_prefix_scan(E, g, C):
+    """
+    inclusive prefix composition along the time axis of the affine steps s_i = E_i s_i-1 + g_i and
+    P_i = E_i P_i-1 E_i^T + C_i, as a work efficient parallel scan (O(T) compositions in 2 log2(T) rounds).
+    E: [batch, T, lsd, lsd], g: [batch, T, lsd], C: [batch, T, lsd, lsd]
+    returns the composed (E, g, C) mapping the state before step 0 to the state after step i
+    """
+    lsd = E.shape[-1]
+    shapes = [tf.TensorShape([None, None, lsd, lsd]), tf.TensorShape([None, None, lsd]), tf.TensorShape([None, None, lsd, lsd])]
+
+    # up sweep: compose neighbouring pairs until one element is left, every level is kept for the down sweep
+    def up_sweep(level, elems, levels):
+        levels = [level_array.write(level, elem) for level_array, elem in zip(levels, elems)]
+        n = tf.shape(elems[0])[1]
+        paired = compose_affine([elem[:, 1:n // 2 * 2:2] for elem in elems], [elem[:, 0:n // 2 * 2:2] for elem in elems])
+        # an odd last element is carried to the next level unpaired
+        elems = [tf.concat([pair, elem[:, n // 2 * 2:]], 1) for pair, elem in zip(paired, elems)]
+        return level + 1, elems, levels
+
+    levels = [tf.TensorArray(E.dtype, size=0, dynamic_size=True, infer_shape=False) for _ in range(3)]
+    level, scanned, levels = tf.while_loop(lambda level, elems, levels: tf.shape(elems[0])[1] > 1, up_sweep,
+                                           [tf.constant(0), [E, g, C], levels],
+                                           shape_invariants=[tf.TensorShape([]), shapes, [None] * 3])
+
+    # down sweep: odd positions are the scanned pairs, even positions compose their element with the pair before
+    def down_sweep(level, scanned):
+        level = level - 1
+        elems = [level_array.read(level) for level_array in levels]
+        for elem, shape in zip(elems, shapes):
+            elem.set_shape(shape)
+        n = tf.shape(elems[0])[1]
+        odd = [scan[:, :n // 2] for scan in scanned]
+        even = compose_affine([elem[:, 2::2] for elem in elems], [scan[:, :(n - 1) // 2] for scan in scanned])
+        even = [tf.concat([elem[:, :1], e], 1) for elem, e in zip(elems, even)]
+        return level, [interleave(e, o) for e, o in zip(even, odd)]
+
+    _, scanned = tf.while_loop(lambda level, scanned: level > 0, down_sweep, [level, scanned],
+                               shape_invariants=[tf.TensorShape([]), shapes])
+    return scanned
+
+
+def interleave(even, odd):
+    """
+    [e0, o0, e1, o1, ...] along axis 1, even has as many or one more element than odd
+    """
+    n_even, n_odd = tf.shape(even)[1], tf.shape(odd)[1]
+    odd = tf.concat([odd, even[:, n_odd:]], 1)
+    stacked = tf.stack([even, odd], 2)
+    stacked = tf.reshape(stacked, tf.concat([tf.shape(even)[:1], [2 * n_even], tf.shape(even)[2:]], 0))
+    return tf.ensure_shape(stacked[:, :n_even + n_odd], tf.TensorShape([None, None]).concatenate(even.shape[2:]))
+
+
 class PiSSMSmoothingCell(k.layers.Layer):
     """Implementing the GIN cell. This implementation is a subclass of the Keras Layer Class, such
      that it can be used with tf.keras.layers.RNN"""
@@ -52,7 +117,11 @@ class PiSSMSmoothingCell(k.layers.Layer):
                  latent_obs_dim,
                  init_kf_matrices,
                  init_KF_matrices,
-                 USE_CONV):
+                 USE_CONV,
+                 packed_covar=False,
+                 covar_rank=0,
+                 sqrt_covar=False,
+                 parallel_scan=False):
 
         """
         latent_state_dim: dimension of the latent state 
@@ -63,6 +132,12 @@ class PiSSMSmoothingCell(k.layers.Layer):
         init_KF_matrices: initialization of gru cell of the kalman gain network
         trans_net_hidden_units: list of number 
         never_invalid: boolean indicating whether all observations are available or a part of it is missing
+        packed_covar: covariances are given and carried as packed upper triangles (lsd*(lsd+1)/2 entries)
+        covar_rank: if > 0, covariances are given and carried as diagonal plus rank-covar_rank factors
+        sqrt_covar: covariances are given and carried as lower triangular Cholesky factors
+        parallel_scan: smooth_parallel is used instead of running the cell through an RNN layer. Its gains have no
+            recurrence over time and its covariance correction is applied once, so it is a different smoother
+            (see smooth_parallel)
         
         """
 
@@ -76,28 +151,45 @@ class PiSSMSmoothingCell(k.layers.Layer):
         self.init_KF_matrices = init_KF_matrices
         self.eye_init = lambda shape, dtype=np.float32: np.eye(*shape, dtype=dtype)
         self.USE_CONV = USE_CONV 
+        # hidden state of the J gru cell, carried in the RNN state after mean and covariance
+        self.GRUJunit = 2 * self._lsd
+        self.packed_covar = packed_covar
+        self.covar_rank = covar_rank
+        self.sqrt_covar = sqrt_covar
+        self.parallel_scan = parallel_scan
+        if self.sqrt_covar and (self.packed_covar or self.covar_rank > 0):
+            raise AssertionError("sqrt_covar can not be combined with packed_covar or covar_rank > 0")
+        if self.parallel_scan and (self.sqrt_covar or self.covar_rank > 0):
+            raise AssertionError("parallel_scan needs full or packed covariances, it can not be combined with sqrt_covar or covar_rank > 0")
+        if self.covar_rank > 0:
+            if self.packed_covar or self.USE_CONV:
+                raise AssertionError("covar_rank > 0 can not be combined with packed_covar or USE_CONV")
+            self._covar_size = self._lsd * (self.covar_rank + 1)
+        elif self.packed_covar:
+            self._covar_size = packed_covar_size(self._lsd)
+        else:
+            self._covar_size = self._lsd**2
         
     def build(self, input_shape):
         input_shape = input_shape[0]      
         
         if self.USE_CONV == True:
             #build J gru parameters
-            self.GRUJunit = 2 * self._lsd 
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(J, lsd^2)
             self.LastWeightKG = self.add_weight(shape=[2 * self._lsd * self._lsd , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(4*J, J)
             self.NextWeightKG = self.add_weight(shape=[self.GRUJunit ,2 * self._lsd * self._lsd], name="grunextweight", initializer='random_normal') #(gru out, J*4)
             self.PrevWeightKG = self.add_weight(shape=[3*self._lsd , self.GRUJunit*2], name="gruprevweight", initializer='random_normal')# ( lsd^2, gru in)
             self.GRUJ = k.layers.GRUCell( self.GRUJunit)
-            self.GRUJ_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUJunit ])
+            #build conv covariance encoder once, its weights are tracked by the cell and reused at every step
+            self._conv_covar_layers = self.build_conv_gru()
+            self._build_layers(self._conv_covar_layers, [None, self._lsd, self._lsd, 1])
         if self.USE_CONV == False:
             #build J gru parameters
-            self.GRUJunit = 2 * self._lsd 
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(J, lsd^2)
             self.LastWeightKG = self.add_weight(shape=[2 * self._lsd * self._lsd , self._lsd * self._lsd], name="grulastweight", initializer='random_normal') #(4*J, J)
             self.NextWeightKG = self.add_weight(shape=[self.GRUJunit ,2 * self._lsd * self._lsd], name="grunextweight", initializer='random_normal') #(gru out, J*4)
-            self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 , self.GRUJunit*2], name="gruprevweight", initializer='random_normal')# ( lsd^2, gru in)
+            self.PrevWeightKG = self.add_weight(shape=[self._covar_size , self.GRUJunit*2], name="gruprevweight", initializer='random_normal')# ( covar, gru in)
             self.GRUJ = k.layers.GRUCell( self.GRUJunit)
-            self.GRUJ_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUJunit ])
         
         #build dense layer for diag covariance
         self._layer_covar_gru = k.layers.Dense(self._lsd, activation=lambda x: k.activations.elu(x) + 1)
@@ -108,7 +200,7 @@ class PiSSMSmoothingCell(k.layers.Layer):
         """ similar to the LSTM and GRU cells. The names and parameters of the GIN cell 
         mathch with those of the RNN based cells
         inputs: Mean and covariance vectors 
-        states: Last Latent Posterior State 
+        states: Last Latent Posterior State and the hidden state of the J gru cell
         
         """
         # unpack inputs; filt_mean_t = mu_t|t
@@ -118,34 +210,47 @@ class PiSSMSmoothingCell(k.layers.Layer):
         #                transition_matrix_tp1 = A_t+1
         filt_t_mean, filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix = inputs
         # self.A_tp1_matrix = transition_tp1_matrix
-        smooth_tp1_mean, smooth_tp1_covar = unpack_state( states[0], self._lsd)  
+        smooth_tp1_mean, smooth_tp1_covar = unpack_state( states[0][..., :self._lsd + self._covar_size], self._lsd)  
+        gru_j_state = states[0][..., self._lsd + self._covar_size:]
         
         # # update step (current smooth from next smooth)
+        J, gru_j_state = self._predict_J_gru(prior_tp1_covar, gru_j_state)
         smooth_t_mean, smooth_t_covar = self._update(smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, 
-                                filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix)
+                                filt_t_covar, prior_tp1_mean, prior_tp1_covar, transition_tp1_matrix, J)
 
-        post_state = pack_state(smooth_t_mean, smooth_t_covar)
+        post_state = tf.concat([pack_state(smooth_t_mean, smooth_t_covar), gru_j_state], -1)
 
         
         return [smooth_t_mean, smooth_t_covar], [post_state]
     
 
     
-    def _predict_J_gru(self, prior_covar):
+    def _predict_J_gru(self, prior_covar, gru_j_state):
+        
+        in_GRU = self._J_gru_input(prior_covar)
+        J, _ = self.GRUJ(in_GRU, gru_j_state)
+        gru_j_state = J # next gru_j_state
+        return self._J_gru_output(J), gru_j_state
+
+    def _J_gru_input(self, prior_covar):
         
+        if self.sqrt_covar:
+            # the J network gets the covariance sigma = L L^T as in the dense mode, not its Cholesky factor
+            prior_L = self._covar_to_matrix(prior_covar)
+            prior_covar = self._matrix_to_covar(tf.matmul(prior_L, prior_L, transpose_b=True))
         if self.USE_CONV == True:
             #propagate covar matrix through the conv2d
-            prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+            prior_covar_matrix = self._covar_to_matrix(prior_covar)
             prior_covar_matrix = tf.expand_dims(prior_covar_matrix, -1)
-            prior_covar = self._prop_to_layers(prior_covar_matrix, self.build_conv_gru())
+            prior_covar = self._prop_to_layers(prior_covar_matrix, self._conv_covar_layers)
             
+        return tf.matmul(prior_covar, self.PrevWeightKG)
 
-        in_GRU = tf.matmul(prior_covar, self.PrevWeightKG)
-        J, _ = self.GRUJ(in_GRU, self.GRUJ_state)
-        self.GRUKG_state = J # next self.GRUKG_state
+    def _J_gru_output(self, J):
+        
         J = tf.matmul(J, self.NextWeightKG)
         J = tf.matmul(J, self.LastWeightKG)
-        J = tf.reshape(J, [J.shape[0], self._lsd, self._lsd])
+        J = tf.reshape(J, [-1, self._lsd, self._lsd])
 
         # J = tf.matmul(J, self.NextWeightKG)
         # J = tf.matmul(J, self.LastWeightKG)
@@ -177,18 +282,22 @@ class PiSSMSmoothingCell(k.layers.Layer):
 
 
     def _update(self, smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar, prior_tp1_mean,
-                                             prior_tp1_covar, transition_tp1_matrix):
+                                             prior_tp1_covar, transition_tp1_matrix, J):
         
-        J = self._predict_J_gru( prior_tp1_covar)
-
-        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [smooth_tp1_covar.shape[0], self._lsd, self._lsd])
-        filt_t_covar = tf.reshape(filt_t_covar, [filt_t_covar.shape[0], self._lsd, self._lsd])
-        prior_tp1_covar = tf.reshape(prior_tp1_covar, [prior_tp1_covar.shape[0], self._lsd, self._lsd])
 
-        
         mu_es = smooth_tp1_mean - tf.squeeze( tf.matmul(transition_tp1_matrix, tf.expand_dims( filt_t_mean, -1) ), -1)
         smooth_t_mean = filt_t_mean + tf.squeeze( tf.matmul(J, tf.expand_dims( mu_es,-1 )), -1)
 
+        if self.covar_rank > 0:
+            return smooth_t_mean, self._update_low_rank_covar(J, smooth_tp1_covar, filt_t_covar, prior_tp1_covar)
+        if self.sqrt_covar:
+            return smooth_t_mean, self._update_sqrt_covar(J, self._covar_to_matrix(smooth_tp1_covar), self._covar_to_matrix(filt_t_covar),
+                                                          self._covar_to_matrix(prior_tp1_covar), transition_tp1_matrix)
+
+        smooth_tp1_covar = self._covar_to_matrix(smooth_tp1_covar)
+        filt_t_covar = self._covar_to_matrix(filt_t_covar)
+        prior_tp1_covar = self._covar_to_matrix(prior_tp1_covar)
+
         smooth_t_covar = smooth_tp1_covar - prior_tp1_covar
         smooth_t_covar = tf.matmul(smooth_t_covar, tf.transpose(J, perm=[0, 2, 1]))
         smooth_t_covar = tf.matmul(J, smooth_t_covar)
@@ -201,15 +310,62 @@ class PiSSMSmoothingCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         smooth_t_covar = elup_Diag_elements + ( smooth_t_covar - tf.linalg.diag(tf.linalg.diag_part(smooth_t_covar)))
         #
-        smooth_t_covar = tf.reshape(smooth_t_covar, [smooth_t_covar.shape[0], -1])
+        smooth_t_covar = self._matrix_to_covar(smooth_t_covar)
         return smooth_t_mean, smooth_t_covar # mu_t|t, sigma_t|t at t
 
+    def _update_low_rank_covar(self, J, smooth_tp1_covar, filt_t_covar, prior_tp1_covar):
+        """
+        sigma_t|T = sigma_t|t + J (sigma_t+1|T - sigma_t+1|t) J^T in diagonal plus low rank form, the same recursion as
+        the dense path. The smoothed covariance keeps the factors of the filtered one, the correction J (.) J^T is
+        projected on the diagonal, so the diagonal matches the dense step and its off-diagonal part is dropped. The
+        elu+1 correction acts on the diagonal part d only, the dense path corrects the whole diagonal
+        """
+        smooth_diag, smooth_factors = unpack_low_rank_covar(smooth_tp1_covar, self._lsd, self.covar_rank)
+        filt_diag, filt_factors = unpack_low_rank_covar(filt_t_covar, self._lsd, self.covar_rank)
+        prior_diag, prior_factors = unpack_low_rank_covar(prior_tp1_covar, self._lsd, self.covar_rank)
+
+        J_smooth_factors = tf.matmul(J, smooth_factors)
+        J_prior_factors = tf.matmul(J, prior_factors)
+        smooth_t_diag = filt_diag + tf.reduce_sum(tf.square(J) * tf.expand_dims(smooth_diag - prior_diag, 1), -1) \
+                        + tf.reduce_sum(tf.square(J_smooth_factors) - tf.square(J_prior_factors), -1)
+        #
+        smooth_t_diag = elup1(self._layer_covar_gru(smooth_t_diag))
+        #
+        return pack_low_rank_covar(smooth_t_diag, filt_factors)
+
+    def _update_sqrt_covar(self, J, smooth_tp1_L, filt_t_L, prior_tp1_L, transition_tp1_matrix):
+        """
+        square root smoothing step on Cholesky factors. Q = sigma_t+1|t - A sigma_t|t A^T is diagonal in the transition
+        cell, so its square root is recovered from the factors, and
+        sigma_t|T = (I - J A) sigma_t|t (I - J A)^T + J Q J^T + J sigma_t+1|T J^T
+        is triangularized by a QR decomposition. This is the RTS recursion sigma_t|t + J (sigma_t+1|T - sigma_t+1|t) J^T
+        of the dense path only for the optimal J = sigma_t|t A^T sigma_t+1|t^-1. With the learned J of _update it is a
+        different smoother, which stays positive definite for any J. The elu+1 correction acts on the diagonal of the
+        factor
+        """
+        A_filt_L = tf.matmul(transition_tp1_matrix, filt_t_L)
+        Q = tf.reduce_sum(tf.square(prior_tp1_L), -1) - tf.reduce_sum(tf.square(A_filt_L), -1)
+        I_JA = tf.eye(self._lsd, batch_shape=[1]) - tf.matmul(J, transition_tp1_matrix)
+        pre_array = tf.concat([tf.matmul(I_JA, filt_t_L),
+                               J * tf.expand_dims(tf.sqrt(tf.maximum(Q, 1e-12)), 1),
+                               tf.matmul(J, smooth_tp1_L)], -1) # [batch, lsd, 3*lsd]
+        smooth_t_L = tria(pre_array)
+        #
+        Diag_elements_dense = self._layer_covar_gru(tf.linalg.diag_part(smooth_t_L))
+        smooth_t_L = tf.linalg.set_diag(smooth_t_L, elup1(Diag_elements_dense))
+        #
+        return self._matrix_to_covar(smooth_t_L)
+
     def _update_conventional(self, smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar, prior_tp1_mean,
                                              prior_tp1_covar, transition_tp1_matrix):
+
+        if self.sqrt_covar:
+            return self._update_conventional_sqrt(smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar,
+                                                  transition_tp1_matrix, prior_tp1_covar)
         
-        smooth_tp1_covar = tf.reshape(smooth_tp1_covar, [smooth_tp1_covar.shape[0], self._lsd, self._lsd])
-        filt_t_covar = tf.reshape(filt_t_covar, [filt_t_covar.shape[0], self._lsd, self._lsd])
-        prior_tp1_covar = tf.reshape(prior_tp1_covar, [prior_tp1_covar.shape[0], self._lsd, self._lsd])
+        smooth_tp1_covar = self._covar_to_matrix(smooth_tp1_covar)
+        filt_t_covar = self._covar_to_matrix(filt_t_covar)
+        prior_tp1_covar = self._covar_to_matrix(prior_tp1_covar)
 
         #
         Diag_elements = tf.linalg.diag_part(prior_tp1_covar)
@@ -237,10 +393,54 @@ class PiSSMSmoothingCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         smooth_t_covar = elup_Diag_elements + ( smooth_t_covar - tf.linalg.diag(tf.linalg.diag_part(smooth_t_covar)))
         #
-        smooth_t_covar = tf.reshape(smooth_t_covar, [smooth_t_covar.shape[0], -1])
+        smooth_t_covar = self._matrix_to_covar(smooth_t_covar)
         return smooth_t_mean, smooth_t_covar # mu_t|t, sigma_t|t at t
+
+    def _update_conventional_sqrt(self, smooth_tp1_mean, smooth_tp1_covar, filt_t_mean, filt_t_covar,
+                                  transition_tp1_matrix, prior_tp1_covar):
+        """
+        RTS step on Cholesky factors, J = sigma_t|t A^T sigma_t+1|t^-1 is obtained by a Cholesky solve instead of an inverse
+        """
+        smooth_tp1_L = self._covar_to_matrix(smooth_tp1_covar)
+        filt_t_L = self._covar_to_matrix(filt_t_covar)
+        prior_tp1_L = self._covar_to_matrix(prior_tp1_covar)
+
+        #
+        Diag_elements_dense = self._layer_covar_gru(tf.linalg.diag_part(prior_tp1_L))
+        prior_tp1_L = tf.linalg.set_diag(prior_tp1_L, elup1(Diag_elements_dense))
+        #
+
+        A_sigmat = tf.matmul(transition_tp1_matrix, tf.matmul(filt_t_L, tf.transpose(filt_t_L, perm=[0, 2, 1])))
+        J = tf.transpose(tf.linalg.cholesky_solve(prior_tp1_L, A_sigmat), perm=[0, 2, 1])
+
+        mu_es = smooth_tp1_mean - tf.squeeze( tf.matmul(transition_tp1_matrix, tf.expand_dims( filt_t_mean, -1) ), -1)
+        smooth_t_mean = filt_t_mean + tf.squeeze( tf.matmul(J, tf.expand_dims( mu_es,-1 )), -1)
+
+        smooth_t_covar = self._update_sqrt_covar(J, smooth_tp1_L, filt_t_L, prior_tp1_L, transition_tp1_matrix)
+        return smooth_t_mean, smooth_t_covar # mu_t|T, L_t|T at t
         
     
+    def _covar_to_matrix(self, covar):
+        """flat (or packed) covariance vector to [batch, lsd, lsd]"""
+        if self.packed_covar:
+            return unpack_covar(covar, self._lsd)
+        return tf.reshape(covar, [-1, self._lsd, self._lsd])
+
+    def _matrix_to_covar(self, covar_matrix):
+        """[batch, lsd, lsd] to flat (or packed) covariance vector"""
+        if self.packed_covar:
+            return pack_covar(covar_matrix, self._lsd)
+        return tf.reshape(covar_matrix, [-1, self._covar_size])
+
+    @staticmethod
+    def _build_layers(layers, input_shape):
+        """builds layers once, in order, starting from input_shape"""
+        shape = tf.TensorShape(input_shape)
+        for layer in layers:
+            layer.build(shape)
+            shape = layer.compute_output_shape(shape)
+        return shape
+
     @staticmethod
     def _prop_to_layers(inputs, convlayers):
         """propagation"""
@@ -249,9 +449,74 @@ class PiSSMSmoothingCell(k.layers.Layer):
             h = layer(h)
         return h
     
+    def smooth_parallel(self, smooth_mean_init, smooth_covar_init, inputs):
+        """
+        backward pass as a parallel prefix scan instead of a sequential RNN. inputs are the time reversed
+        sequences the RNN layer would get (filt_mean, filt_covar, prior_mean, prior_covar, transition_matrix),
+        the outputs are the time reversed smoothed means and covariances, as returned by the RNN layer.
+        The gains come from _parallel_J, one step of the J gru from its initial state at every time step, so
+        nothing runs sequentially over time. With fixed gains every smoothing step is affine in the next smoothed
+        state:
+            mu_t|T = J mu_t+1|T + (mu_t|t - J A mu_t|t)
+            sigma_t|T = J sigma_t+1|T J^T + (sigma_t|t - J sigma_t+1|t J^T)
+        and is composed in log2(T) rounds. The positive diagonal layer is not affine and can not be carried
+        through the composition, it is applied once to the smoothed covariances after the scan. This is a different
+        smoother than the RNN cell, whose J gru is recurrent: run with the gains of _parallel_J, the sequential steps
+        give the same means, and the same covariances only where the correction is the identity. It is chosen at
+        training time (see PiSSM parallel_smoothing)
+        """
+        filt_mean, filt_covar, _, prior_covar, transition_matrix = inputs
+        if not self.built:
+            self.build([filt_mean.shape[:1] + filt_mean.shape[2:]])
+        batch_size, T = tf.shape(filt_mean)[0], tf.shape(filt_mean)[1]
+
+        J = self._parallel_J(tf.reshape(prior_covar, [-1, self._covar_size]))
+
+        # affine step of every time step
+        A = tf.reshape(transition_matrix, [-1, self._lsd, self._lsd])
+        filt_mean_flat = tf.reshape(filt_mean, [-1, self._lsd])
+        filt_covar_matrix = self._covar_to_matrix(tf.reshape(filt_covar, [-1, self._covar_size]))
+        prior_covar_matrix = self._covar_to_matrix(tf.reshape(prior_covar, [-1, self._covar_size]))
+        g = filt_mean_flat - tf.squeeze(tf.matmul(tf.matmul(J, A), tf.expand_dims(filt_mean_flat, -1)), -1)
+        C = filt_covar_matrix - tf.matmul(tf.matmul(J, prior_covar_matrix), J, transpose_b=True)
+
+        E, g, C = affine_prefix_scan(tf.reshape(J, [batch_size, T, self._lsd, self._lsd]),
+                                     tf.reshape(g, [batch_size, T, self._lsd]),
+                                     tf.reshape(C, [batch_size, T, self._lsd, self._lsd]))
+
+        smooth_mean = tf.squeeze(tf.matmul(E, tf.expand_dims(tf.expand_dims(smooth_mean_init, 1), -1)), -1) + g
+        smooth_covar_init = tf.expand_dims(self._covar_to_matrix(smooth_covar_init), 1)
+        smooth_covar = tf.matmul(tf.matmul(E, smooth_covar_init), E, transpose_b=True) + C
+
+        #
+        smooth_covar = tf.reshape(smooth_covar, [-1, self._lsd, self._lsd])
+        smooth_covar = tf.linalg.set_diag(smooth_covar, elup1(self._layer_covar_gru(tf.linalg.diag_part(smooth_covar))))
+        #
+        smooth_covar = tf.reshape(self._matrix_to_covar(smooth_covar), [batch_size, T, self._covar_size])
+        return smooth_mean, smooth_covar
+
+    def _parallel_J(self, prior_covar):
+        """
+        gains of smooth_parallel, [N, lsd, lsd] for N prior covariances sigma_t+1|t: one J gru step from the initial
+        gru state per covariance. The gain depends on its own time step only, so all steps are computed at once
+        """
+        in_GRU = self._J_gru_input(prior_covar)
+        if not self.GRUJ.built:
+            self.GRUJ.build(in_GRU.shape[-1:])
+        initial_gru_j_state = self.init_KF_matrices * tf.ones([tf.shape(in_GRU)[0], self.GRUJunit], dtype=in_GRU.dtype)
+        J, _ = self.GRUJ(in_GRU, initial_gru_j_state)
+        return self._J_gru_output(J)
+
+    def pack_initial_state(self, smooth_mean_init, smooth_covar_init):
+        """
+        initial RNN state of the backward pass: last filtered mean and covariance and a fresh J gru state
+        """
+        initial_gru_j_state = self.init_KF_matrices * tf.ones([tf.shape(smooth_mean_init)[0], self.GRUJunit], dtype=smooth_mean_init.dtype)
+        return tf.concat([pack_state(smooth_mean_init, smooth_covar_init), initial_gru_j_state], -1)
+
     @property
     def state_size(self):
         """ state size as a required function of RNN based cell"""
-        return self._lsd + self._lsd**2
+        return self._lsd + self._covar_size + self.GRUJunit
         # return [(k.layers.Input(shape=(None, self._lsd)), k.layers.Input(shape=(None, self._lsd**2)))]
         
@@ -2,27 +2,57 @@ import numpy as np
 """
 distorting images with noise, same noise generation algorithm with (Becker et al.,2019)
 """
-def add_img_noise(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0):
+
+# noise values drawn at once, bounds the memory of the float64 noise of a chunk of sequences
+CHUNK_ELEMENTS = 2 ** 20
+
+
+def _sequence_chunks(batch_size, seq_elements, chunk_size):
+    """ slices over the sequences, chunk_size sequences each, or as many as fit into CHUNK_ELEMENTS if it is None """
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_ELEMENTS // max(1, seq_elements))
+    return [slice(start, start + chunk_size) for start in range(0, batch_size, chunk_size)]
+
+
+def _blend(factors, imgs, noise, out):
+    """ factors * imgs + (1 - factors) * noise into out, cast like astype(out.dtype) """
+    blended = np.multiply(factors, imgs)
+    blended += (1 - factors) * noise
+    out[...] = blended
+
+
+def _correlated_factors(random, size, seq_len, corr):
+    """
+    random walks in [0, 1] of shape [size[0], seq_len] + size[1:], with steps uniform in [-corr, corr]
+    all steps are drawn at once, in the order the draws per time step used
+    """
+    steps = random.uniform(low=0.0, high=1.0, size=size), random.uniform(low=-corr, high=corr, size=[seq_len - 1] + size)
+    factors = np.zeros([seq_len] + size)
+    factors[0] = steps[0]
+    for i in range(seq_len - 1):
+        factors[i + 1] = np.clip(factors[i] + steps[1][i], a_min=0.0, a_max=1.0)
+    return np.moveaxis(factors, 0, 1)
+
+
+def add_img_noise(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0, chunk_size=None):
     """
     imgs: Images to add noise to
-    first_n_clean: Keep first_n_images without distortion 
-    random: np.random.RandomState 
-    corr: "correlation (over time) 
+    first_n_clean: Keep first_n_images without distortion
+    random: np.random.RandomState
+    corr: "correlation (over time)
     lowlow: lower bound of the interval the lower bound for each sequence is sampled from
     lowup: upper bound of the interval the lower bound for each sequence is sampled from
     uplow: lower bound of the interval the upper bound for each sequence is sampled from
     upup: upper bound of the interval the upper bound for each sequence is sampled from
-    
+    chunk_size: sequences whose noise is drawn and blended at once, None to fit CHUNK_ELEMENTS
+
     """
 
     assert lowlow <= lowup <= uplow <= upup, "Invalid bounds"
     if len(imgs.shape) < 5:
         imgs = np.expand_dims(imgs, -1)
     batch_size, seq_len = imgs.shape[:2]
-    factors = np.zeros([batch_size, seq_len])
-    factors[:, 0] = random.uniform(low=0.0, high=1.0, size=batch_size)
-    for i in range(seq_len - 1):
-        factors[:, i + 1] = np.clip(factors[:, i] + random.uniform(low=-corr, high=corr, size=batch_size), a_min=0.0, a_max=1.0)
+    factors = _correlated_factors(random, [batch_size], seq_len, corr)
 
     t1 = random.uniform(low=lowlow, high=lowup, size=(batch_size, 1))
     t2 = random.uniform(low=uplow, high=upup, size=(batch_size, 1))
@@ -31,30 +61,29 @@ def add_img_noise(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25,
     factors = np.clip(factors, a_min=0.0, a_max=1.0)
     factors = np.reshape(factors, list(factors.shape) + [1, 1, 1])
     factors[:, :first_n_clean] = 1.0
-    noisy_imgs = []
 
-    for i in range(batch_size):
-        if imgs.dtype == np.uint8:
-            noise = random.uniform(low=0.0, high=255, size=imgs.shape[1:])
-            noisy_imgs.append((factors[i] * imgs[i] + (1 - factors[i]) * noise).astype(np.uint8))
-        else:
-            noise = random.uniform(low=0.0, high=1.1, size=imgs.shape[1:])
-            noisy_imgs.append(factors[i] * imgs[i] + (1 - factors[i]) * noise)
+    # the noise of a chunk is the same draw as the noise of its sequences one after another
+    noise_high = 255 if imgs.dtype == np.uint8 else 1.1
+    noisy_imgs = np.zeros(imgs.shape, dtype=np.uint8 if imgs.dtype == np.uint8 else np.result_type(imgs, factors))
+    for chunk in _sequence_chunks(batch_size, np.prod(imgs.shape[1:]), chunk_size):
+        noise = random.uniform(low=0.0, high=noise_high, size=imgs[chunk].shape)
+        _blend(factors[chunk], imgs[chunk], noise, noisy_imgs[chunk])
 
-    return np.squeeze(np.concatenate([np.expand_dims(n, 0) for n in noisy_imgs], 0)), factors
+    return np.squeeze(noisy_imgs), factors
 
 
-def add_img_noise4(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0):
+def add_img_noise4(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0, chunk_size=None):
     """
     imgs: Images to add noise to
-    first_n_clean: Keep first_n_images without distortion 
-    random: np.random.RandomState 
-    corr: "correlation (over time) 
+    first_n_clean: Keep first_n_images without distortion
+    random: np.random.RandomState
+    corr: "correlation (over time)
     lowlow: lower bound of the interval the lower bound for each sequence is sampled from
     lowup: upper bound of the interval the lower bound for each sequence is sampled from
     uplow: lower bound of the interval the upper bound for each sequence is sampled from
     upup: upper bound of the interval the upper bound for each sequence is sampled from
-    
+    chunk_size: sequences whose noise is drawn and blended at once, None to fit CHUNK_ELEMENTS
+
     """
 
     half_x = int(imgs.shape[2] / 2)
@@ -63,10 +92,7 @@ def add_img_noise4(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25
     if len(imgs.shape) < 5:
         imgs = np.expand_dims(imgs, -1)
     batch_size, seq_len = imgs.shape[:2]
-    factors = np.zeros([batch_size, seq_len, 4])
-    factors[:, 0] = random.uniform(low=0.0, high=1.0, size=(batch_size, 4))
-    for i in range(seq_len - 1):
-        factors[:, i + 1] = np.clip(factors[:, i] + random.uniform(low=-corr, high=corr, size=(batch_size, 4)), a_min=0.0, a_max=1.0)
+    factors = _correlated_factors(random, [batch_size, 4], seq_len, corr)
 
     t1 = random.uniform(low=lowlow, high=lowup, size=(batch_size, 1, 4))
     t2 = random.uniform(low=uplow, high=upup, size=(batch_size, 1, 4))
@@ -75,52 +101,41 @@ def add_img_noise4(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25
     factors = np.clip(factors, a_min=0.0, a_max=1.0)
     factors = np.reshape(factors, list(factors.shape) + [1, 1, 1])
     factors[:, :first_n_clean] = 1.0
-    noisy_imgs = []
-    qs = []
-    for i in range(batch_size):
+
+    quadrants = [np.s_[:half_x, :half_y], np.s_[:half_x, half_y:], np.s_[half_x:, :half_y], np.s_[half_x:, half_y:]]
+    noise_shape = [4, seq_len, half_x, half_y, imgs.shape[-1]]
+    noisy_imgs = np.zeros(imgs.shape, dtype=np.uint8 if imgs.dtype == np.uint8 else np.float64)
+    q = np.zeros([batch_size, seq_len, 3], dtype=np.int64)
+    for chunk in _sequence_chunks(batch_size, np.prod(noise_shape), chunk_size):
+        chunk_imgs = imgs[chunk]
         if imgs.dtype == np.uint8:
-            qs.append(detect_pendulums(imgs[i], half_x, half_y))
-            noise = random.uniform(low=0.0, high=255, size=[4, seq_len, half_x, half_y, imgs.shape[-1]]).astype(np.uint8)
-            curr = np.zeros(imgs.shape[1:], dtype=np.uint8)
-            curr[:, :half_x, :half_y] = (factors[i, :, 0] * imgs[i, :, :half_x, :half_y] + (1 - factors[i, :, 0]) * noise[0]).astype(np.uint8)
-            curr[:, :half_x, half_y:] = (factors[i, :, 1] * imgs[i, :, :half_x, half_y:] + (1 - factors[i, :, 1]) * noise[1]).astype(np.uint8)
-            curr[:, half_x:, :half_y] = (factors[i, :, 2] * imgs[i, :, half_x:, :half_y] + (1 - factors[i, :, 2]) * noise[2]).astype(np.uint8)
-            curr[:, half_x:, half_y:] = (factors[i, :, 3] * imgs[i, :, half_x:, half_y:] + (1 - factors[i, :, 3]) * noise[3]).astype(np.uint8)
+            q[chunk] = detect_pendulums(chunk_imgs, half_x, half_y)
+            noise = random.uniform(low=0.0, high=255, size=[len(chunk_imgs)] + noise_shape).astype(np.uint8)
         else:
-            noise = random.uniform(low=0.0, high=1.0, size=[4, seq_len, half_x, half_y, imgs.shape[-1]])
-            curr = np.zeros(imgs.shape[1:])
-            curr[:, :half_x, :half_y] = factors[i, :, 0] * imgs[i, :, :half_x, :half_y] + (1 - factors[i, :, 0]) * noise[0]
-            curr[:, :half_x, half_y:] = factors[i, :, 1] * imgs[i, :, :half_x, half_y:] + (1 - factors[i, :, 1]) * noise[1]
-            curr[:, half_x:, :half_y] = factors[i, :, 2] * imgs[i, :, half_x:, :half_y] + (1 - factors[i, :, 2]) * noise[2]
-            curr[:, half_x:, half_y:] = factors[i, :, 3] * imgs[i, :, half_x:, half_y:] + (1 - factors[i, :, 3]) * noise[3]
-        noisy_imgs.append(curr)
+            noise = random.uniform(low=0.0, high=1.0, size=[len(chunk_imgs)] + noise_shape)
+        for k, quadrant in enumerate(quadrants):
+            pixels = (Ellipsis,) + quadrant + (slice(None),)
+            _blend(factors[chunk, :, k], chunk_imgs[pixels], noise[:, k], noisy_imgs[chunk][pixels])
 
-    factors_ext = np.concatenate([np.squeeze(factors), np.zeros([factors.shape[0], factors.shape[1], 1])], -1)
-    q = np.concatenate([np.expand_dims(q, 0) for q in qs], 0)
-    f = np.zeros(q.shape)
-    for i in range(f.shape[0]):
-        for j in range(f.shape[1]):
-            for k in range(3):
-                f[i, j, k] = factors_ext[i, j, q[i, j, k]]
+    # factor of the quadrant each color channel's pendulum is in, 0 if it is not detected
+    factors_ext = np.concatenate([factors[..., 0, 0, 0], np.zeros([batch_size, seq_len, 1])], -1)
+    f = np.take_along_axis(factors_ext, q, axis=-1)
 
-    return np.squeeze(np.concatenate([np.expand_dims(n ,0) for n in noisy_imgs], 0)), f
+    return np.squeeze(noisy_imgs), f
 
 
 def detect_pendulums(imgs, half_x, half_y):
-    qs = [imgs[:, :half_x, :half_y], imgs[:, :half_x, half_y:], imgs[:, half_x:, :half_y], imgs[:, half_x:, half_y:]]
-
-    r_cts = np.array([np.count_nonzero(q[:, :, :, 0] > 5, axis=(-1, -2)) for q in qs]).T
-    g_cts = np.array([np.count_nonzero(q[:, :, :, 1] > 5, axis=(-1, -2)) for q in qs]).T
-    b_cts = np.array([np.count_nonzero(q[:, :, :, 2] > 5, axis=(-1, -2)) for q in qs]).T
+    """
+    quadrant (0 to 3, 4 if none) of the pendulum of each color channel
+    imgs: uint8 images, shape (..., H, W, 3 or more channels)
+    returns: shape (..., 3)
+    """
+    qs = [imgs[..., :half_x, :half_y, :], imgs[..., :half_x, half_y:, :],
+          imgs[..., half_x:, :half_y, :], imgs[..., half_x:, half_y:, :]]
 
-    cts = np.concatenate([np.expand_dims(c, 1) for c in [r_cts, g_cts, b_cts]], 1)
+    cts = np.stack([np.stack([np.count_nonzero(q[..., c] > 5, axis=(-1, -2)) for q in qs], -1) for c in range(3)], -2)
 
     q_max = np.max(cts, -1)
     q = np.argmax(cts, -1)
     q[q_max < 10] = 4
     return q
-
-
-
-
-
@@ -1,10 +1,134 @@
 
+import math
 import numpy as np
 from PIL import Image
 from PIL import ImageDraw
 import ImageGen as noise_gen
 
 
+def _lanczos_weights(in_size, out_size):
+    """
+    (out_size, in_size) matrix of PIL's Image.resize with the Lanczos filter (Image.ANTIALIAS) along one axis. PIL
+    resizes float images along the width first, resized = float32(weights @ float32(image @ weights.T))
+    """
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = 3.0 * filter_scale
+    weights = np.zeros((out_size, in_size))
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        x_min = max(int(center - support + 0.5), 0)
+        x_max = min(int(center + support + 0.5), in_size)
+        x = (np.arange(x_min, x_max) - center + 0.5) * (1.0 / filter_scale)
+        w = np.where((x >= -3.0) & (x < 3.0), np.sinc(x) * np.sinc(x / 3), 0.0)
+        weights[xx, x_min:x_max] = w / w.sum()
+    return weights
+
+
+def _round_up(f):
+    # ROUND_UP of PIL's Draw.c, halves away from zero
+    return np.where(f >= 0, np.floor(f + f.dtype.type(0.5)), -np.floor(np.abs(f) + f.dtype.type(0.5))).astype(np.int64)
+
+
+def _round_down(f):
+    # ROUND_DOWN of PIL's Draw.c, halves towards zero
+    return np.where(f >= 0, np.ceil(f - f.dtype.type(0.5)), -np.ceil(np.abs(f) - f.dtype.type(0.5))).astype(np.int64)
+
+
+def _wide_line_masks(x0, y0, x1, y1, width, size, window=None):
+    """
+    masks, shape (N, size, size), of ImageDraw.line([(x0, y0), (x1, y1)], width=width) for N integer end points:
+    the parallelogram of PIL's ImagingDrawWideLine, filled with the scan lines of its polygon_generic
+    window: (ox, oy, win), only the part [oy:oy + win, ox:ox + win] of the masks is rasterized and returned, shape
+        (N, win, win). The scan lines are computed in image coordinates, the float32 rounding depends on them
+    """
+    x0, y0 = np.broadcast_to(x0, np.shape(x1)).astype(np.int64), np.broadcast_to(y0, np.shape(y1)).astype(np.int64)
+    ox, oy, win = (np.zeros(len(x1), dtype=np.int64), np.zeros(len(x1), dtype=np.int64), size) if window is None \
+        else window
+    dx, dy = x1 - x0, y1 - y0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hypotenuse = np.hypot(dx, dy)
+        ratio_max = _round_up(np.float64((width - 1) / 2.0)) / hypotenuse
+        ratio_min = _round_down(np.float64((width - 1) / 2.0)) / hypotenuse
+        dx_min, dx_max = _round_down(np.nan_to_num(ratio_min * dy)), _round_down(np.nan_to_num(ratio_max * dy))
+        dy_min, dy_max = _round_down(np.nan_to_num(ratio_min * dx)), _round_down(np.nan_to_num(ratio_max * dx))
+    vx = np.stack([x0 - dx_min, x1 - dx_min, x1 + dx_max, x0 + dx_max], axis=1)
+    vy = np.stack([y0 + dy_max, y1 + dy_max, y1 - dy_min, y0 - dy_min], axis=1)
+
+    # edges i from vertex i to vertex i + 1
+    ex0, ey0, ex1, ey1 = vx, vy, np.roll(vx, -1, axis=1), np.roll(vy, -1, axis=1)
+    e_ymin, e_ymax = np.minimum(ey0, ey1), np.maximum(ey0, ey1)
+    horizontal = ey0 == ey1
+    e_dx = np.where(horizontal, 0, (ex1 - ex0).astype(np.float32) / np.where(horizontal, 1, ey1 - ey0)).astype(np.float32)
+    y_min = np.maximum(np.minimum(size - 1, e_ymin.min(axis=1)), 0)[:, None]
+    y_max = np.minimum(np.maximum(0, e_ymax.max(axis=1)), size)[:, None]
+
+    rows = oy[:, None] + np.arange(win + 1)[None, :]
+    row_on = (rows >= y_min) & (rows <= y_max)
+
+    def edge_x(i, y):
+        return (y - ey0[:, i, None]).astype(np.float32) * e_dx[:, i, None] + ex0[:, i, None].astype(np.float32)
+
+    xx = np.full((len(x1), win + 1, 8), np.inf, dtype=np.float32)
+    j = np.zeros((len(x1), win + 1), dtype=np.int64)
+    n_idx, r_idx = np.indices(j.shape)
+    for i in range(4):
+        on = row_on & ~horizontal[:, i, None] & (rows >= e_ymin[:, i, None]) & (rows <= e_ymax[:, i, None])
+        x = edge_x(i, rows)
+        at_ymax = rows == e_ymax[:, i, None]
+        # the end row of an edge is counted twice, so the spans of the rows stay paired
+        twice = on & at_ymax & (rows < y_max)
+        # discontiguous corners with an earlier edge are connected
+        corner = on & ~twice & ((rows == e_ymin[:, i, None]) | at_ymax) & (e_dx[:, i, None] != 0)
+        joined = np.zeros_like(corner)
+        offset = np.where(at_ymax, -1, 1)
+        for k in range(i):
+            other = corner & ~joined & ((rows == e_ymin[:, k, None]) | (rows == e_ymax[:, k, None])) & \
+                (e_dx[:, k, None] != 0)
+            other &= np.round(x) == np.round(edge_x(k, rows))
+            other &= (rows + offset >= e_ymin[:, k, None]) & (rows + offset <= e_ymax[:, k, None])
+            adjacent = edge_x(i, rows + offset)
+            adjacent_other = edge_x(k, rows + offset)
+            x = np.where(other & (x > adjacent + 1) & (x > adjacent_other + 1),
+                         np.round(np.maximum(adjacent, adjacent_other)) + 1,
+                         np.where(other & (x < adjacent - 1) & (x < adjacent_other - 1),
+                                  np.round(np.minimum(adjacent, adjacent_other)) - 1, x)).astype(np.float32)
+            joined |= other
+        xx[n_idx[on], r_idx[on], j[on]] = x[on]
+        j += on
+        xx[n_idx[twice], r_idx[twice], j[twice]] = x[twice]
+        j += twice
+    xx.sort(axis=-1)
+
+    # spans [start, end] of the rows, filled through the running sum of +1 at start and -1 behind end
+    starts, ends = [], []
+    for p in range((int(j.max(initial=0)) + 1) // 2):
+        span = (2 * p + 1 < j) & row_on
+        starts.append(np.where(span, _round_up(np.where(span, xx[..., 2 * p], 0)), 0))
+        ends.append(np.where(span, _round_down(np.where(span, xx[..., 2 * p + 1], 0)), -1))
+    for i in np.flatnonzero(horizontal.any(axis=0)):
+        # horizontal edges are drawn as they are
+        edge = horizontal[:, i, None] & (rows == e_ymin[:, i, None])
+        starts.append(np.where(edge, np.minimum(ex0, ex1)[:, i, None], 0))
+        ends.append(np.where(edge, np.maximum(ex0, ex1)[:, i, None], -1))
+    starts = np.clip(np.stack(starts, axis=-1) - ox[:, None, None], 0, win)
+    ends = np.clip(np.stack(ends, axis=-1) + 1 - ox[:, None, None], 0, win)
+    filled = starts < ends
+    steps = np.zeros((len(x1), win + 1, win + 1), dtype=np.int16)
+    n_idx, r_idx = np.broadcast_to(n_idx[..., None], filled.shape), np.broadcast_to(r_idx[..., None], filled.shape)
+    np.add.at(steps, (n_idx[filled], r_idx[filled], starts[filled]), 1)
+    np.add.at(steps, (n_idx[filled], r_idx[filled], ends[filled]), -1)
+    masks = np.cumsum(steps, axis=-1, dtype=np.int16)[:, :win, :win] > 0
+
+    # a line of length 0 is a point
+    point = (dx == 0) & (dy == 0)
+    if point.any():
+        masks[point] = False
+        inside = point & (x0 >= ox) & (x0 < ox + win) & (y0 >= oy) & (y0 < oy + win)
+        masks[inside, (y0 - oy)[inside], (x0 - ox)[inside]] = True
+    return masks
+
+
 class Pendulum:
 
     MAX_VELO_KEY = 'max_velo'
@@ -15,12 +139,18 @@ class Pendulum:
     FRICTION_KEY = 'friction'
     DT_KEY = 'dt'
     SIM_DT_KEY = 'sim_dt'
+    INTEGRATOR_KEY = 'integrator'
     TRANSITION_NOISE_TRAIN_KEY = 'transition_noise_train'
     TRANSITION_NOISE_TEST_KEY = 'transition_noise_test'
 
     OBSERVATION_MODE_LINE = "line"
     OBSERVATION_MODE_BALL = "ball"
 
+    # semi-implicit euler (the original simulation) or classic runge kutta, which with a single substep (sim_dt = dt)
+    # is already closer to the exact solution than euler with the default sim_dt 1e-4 (500 substeps)
+    INTEGRATOR_EULER = "euler"
+    INTEGRATOR_RK4 = "rk4"
+
     def __init__(self,
                  img_size,
                  observation_mode,
@@ -45,6 +175,7 @@ class Pendulum:
         self.x0 = self.y0 = 64
         self.plt_length = 55 if self.observation_mode == Pendulum.OBSERVATION_MODE_LINE else 50
         self.plt_width = 8
+        self._resize_weights = _lanczos_weights(self.img_size_internal, self.img_size).astype(np.float32)
 
         self.generate_actions = generate_actions
 
@@ -60,6 +191,8 @@ class Pendulum:
         self.g = pendulum_params[Pendulum.GRAVITY_KEY]
         self.friction = pendulum_params[Pendulum.FRICTION_KEY]
         self.sim_dt = pendulum_params[Pendulum.SIM_DT_KEY]
+        self.integrator = pendulum_params.get(Pendulum.INTEGRATOR_KEY, Pendulum.INTEGRATOR_EULER)
+        assert self.integrator == Pendulum.INTEGRATOR_EULER or self.integrator == Pendulum.INTEGRATOR_RK4
 
         self.observation_noise_std = observation_noise_std
         self.transition_noise_std = transition_noise_std
@@ -106,7 +239,8 @@ class Pendulum:
             Pendulum.FRICTION_KEY: 0,
 
             Pendulum.DT_KEY: 0.05,
-            Pendulum.SIM_DT_KEY: 1e-4}
+            Pendulum.SIM_DT_KEY: 1e-4,
+            Pendulum.INTEGRATOR_KEY: Pendulum.INTEGRATOR_EULER}
 
     def _sample_action(self, shape):
         if self.generate_actions:
@@ -114,20 +248,65 @@ class Pendulum:
         else:
             return np.zeros(shape=shape)
 
-    def _transition_function(self, states, actions):
+    def _num_substeps(self):
         nSteps = self.dt / self.sim_dt
 
         if nSteps != np.round(nSteps):
             print('Warning from Pendulum: dt does not match up')
-            nSteps = np.round(nSteps)
+        return int(np.round(nSteps))
 
-        c = self.g * self.length * self.mass / self.inertia
-        for i in range(0, int(nSteps)):
-            velNew = states[..., 1:2] + self.sim_dt * (c * np.sin(states[..., 0:1])
-                                                     + actions / self.inertia
-                                                     - states[..., 1:2] * self.friction)
-            states = np.concatenate((states[..., 0:1] + self.sim_dt * velNew, velNew), axis=1)
-        return states
+    def _acceleration(self, theta, velo, torque, out, tmp):
+        # c * sin(theta) + torque - friction * velo into out, tmp is a buffer of the same shape
+        np.sin(theta, out=out)
+        out *= self.g * self.length * self.mass / self.inertia
+        out += torque
+        np.multiply(velo, self.friction, out=tmp)
+        out -= tmp
+        return out
+
+    def _transition_function(self, states, actions):
+        """
+        states of all episodes after dt, the substeps run in place on buffers allocated once per call
+        states: shape (..., 2), angle and angular velocity
+        actions: shape (..., 1), torques
+        """
+        n_steps = self._num_substeps()
+        h = self.sim_dt
+        theta, velo = states[..., 0].copy(), states[..., 1].copy()
+        torque = actions[..., 0] / self.inertia
+        acc, tmp = np.empty_like(velo), np.empty_like(velo)
+
+        if self.integrator == Pendulum.INTEGRATOR_EULER:
+            for i in range(n_steps):
+                self._acceleration(theta, velo, torque, acc, tmp)
+                acc *= h
+                velo += acc
+                np.multiply(velo, h, out=tmp)
+                theta += tmp
+        else:
+            theta_stage, velo_stage = np.empty_like(theta), np.empty_like(velo)
+            d_theta, d_velo = np.empty_like(theta), np.empty_like(velo)
+            for i in range(n_steps):
+                self._acceleration(theta, velo, torque, acc, tmp)
+                np.copyto(d_theta, velo)
+                np.copyto(d_velo, acc)
+                np.copyto(velo_stage, velo)
+                for weight, step in ((2, h / 2), (2, h / 2), (1, h)):
+                    # next stage from the slope of the previous one
+                    np.multiply(velo_stage, step, out=theta_stage)
+                    theta_stage += theta
+                    np.multiply(acc, step, out=velo_stage)
+                    velo_stage += velo
+                    self._acceleration(theta_stage, velo_stage, torque, acc, tmp)
+                    np.multiply(velo_stage, weight, out=tmp)
+                    d_theta += tmp
+                    np.multiply(acc, weight, out=tmp)
+                    d_velo += tmp
+                d_theta *= h / 6
+                theta += d_theta
+                d_velo *= h / 6
+                velo += d_velo
+        return np.stack([theta, velo], axis=-1)
 
     def _get_next_states(self, states, actions):
         actions = np.maximum(-self.max_torque, np.minimum(actions, self.max_torque))
@@ -171,13 +350,45 @@ class Pendulum:
         task_space_pos[..., 1] = np.cos(joint_states[..., 0]) * self.length
         return task_space_pos
 
-    def _generate_images(self, ts_pos):
-        imgs = np.zeros(shape=list(ts_pos.shape)[:-1] + [self.img_size, self.img_size], dtype=np.uint8)
-        for seq_idx in range(ts_pos.shape[0]):
-            for idx in range(ts_pos.shape[1]):
-                imgs[seq_idx, idx] = self._generate_single_image(ts_pos[seq_idx, idx])
-
-        return imgs
+    def _generate_images(self, ts_pos, chunk_size=1000):
+        """
+        all frames at once: the shapes _generate_single_image draws with PIL are rasterized for a chunk of frames,
+        pixel for pixel like PIL draws them, in a window of the img_size_internal image around each shape. The windows
+        are downsampled with the matching rows and columns of the Lanczos (Image.ANTIALIAS) weights of PIL's resize.
+        The frames equal those of _generate_single_image (checked by test_pendulum_images.py)
+        ts_pos: task space positions, shape (..., 2)
+        chunk_size: frames rasterized together, bounds the memory of the masks
+        """
+        size = self.img_size_internal
+        weights = self._resize_weights
+        flat_pos = ts_pos.reshape(-1, 2)
+        imgs = np.zeros(shape=(len(flat_pos), self.img_size, self.img_size), dtype=np.uint8)
+        for start in range(0, len(flat_pos), chunk_size):
+            pos = flat_pos[start:start + chunk_size]
+            # end point of the line or center of the ball, PIL truncates the coordinates to integers
+            x1 = np.trunc(pos[:, 0] * (self.plt_length / self.length) + self.x0).astype(np.int64)
+            y1 = np.trunc(pos[:, 1] * (self.plt_length / self.length) + self.y0).astype(np.int64)
+            if self.observation_mode == Pendulum.OBSERVATION_MODE_LINE:
+                win = int(max(np.abs(x1 - self.x0).max(initial=0), np.abs(y1 - self.y0).max(initial=0)))
+                win = min(win + 2 * self.plt_width + 1, size)
+                ox = np.clip(np.minimum(x1, self.x0) - self.plt_width, 0, size - win)
+                oy = np.clip(np.minimum(y1, self.y0) - self.plt_width, 0, size - win)
+                masks = _wide_line_masks(self.x0, self.y0, x1, y1, self.plt_width, size, (ox, oy, win))
+            else:
+                # PIL's ellipse in the box (x1 - plt_width, y1 - plt_width, x1 + plt_width, y1 + plt_width), a disc
+                # of radius plt_width + 1 / 4 around the center of the truncated box
+                win = 2 * self.plt_width + 1
+                ox = np.clip(x1 - self.plt_width, 0, size - win)
+                oy = np.clip(y1 - self.plt_width, 0, size - win)
+                coords = np.arange(win)
+                masks = (coords[None, None, :] + (ox - x1)[:, None, None])**2 + \
+                        (coords[None, :, None] + (oy - y1)[:, None, None])**2 <= (self.plt_width + 0.25)**2
+            col_weights = weights[:, ox[:, None] + np.arange(win)].transpose(1, 2, 0)
+            row_weights = weights[:, oy[:, None] + np.arange(win)].transpose(1, 0, 2)
+            resized = row_weights @ (masks.astype(np.float32) @ col_weights)
+            imgs[start:start + len(pos)] = 255.0 * np.clip(resized, 0, 1)
+
+        return imgs.reshape(list(ts_pos.shape)[:-1] + [self.img_size, self.img_size])
 
     def _generate_single_image(self, pos):
         x1 = pos[0] * (self.plt_length / self.length) + self.x0
@@ -193,25 +404,36 @@ class Pendulum:
             y_u = y1 + self.plt_width
             draw.ellipse((x_l, y_l, x_u, y_u), fill=1.0)
 
-        img = img.resize((self.img_size, self.img_size), resample=Image.ANTIALIAS)
+        img = img.resize((self.img_size, self.img_size), resample=Image.LANCZOS)
         img_as_array = np.asarray(img)
         img_as_array = np.clip(img_as_array, 0, 1)
         return 255.0 * img_as_array
 
     def _kf_transition_function(self, state, noise):
-        nSteps = self.dt / self.sim_dt
-
-        if nSteps != np.round(nSteps):
-            print('Warning from Pendulum: dt does not match up')
-            nSteps = np.round(nSteps)
-
+        """ _transition_function without actions for a single state, on python floats """
+        n_steps = self._num_substeps()
+        h = self.sim_dt
         c = self.g * self.length * self.mass / self.inertia
-        for i in range(0, int(nSteps)):
-            velNew = state[1] + self.sim_dt * (c * np.sin(state[0]) - state[1] * self.friction)
-            state = np.array([state[0] + self.sim_dt * velNew, velNew])
-        state[0] = state[0] % (2 * np.pi)
-        state[1] = state[1] + noise[1]
-        return state
+        theta, velo = float(state[0]), float(state[1])
+
+        if self.integrator == Pendulum.INTEGRATOR_EULER:
+            for i in range(n_steps):
+                velo = velo + h * (c * math.sin(theta) - velo * self.friction)
+                theta = theta + h * velo
+        else:
+            def acceleration(th, v):
+                return c * math.sin(th) - v * self.friction
+            for i in range(n_steps):
+                a1 = acceleration(theta, velo)
+                v2 = velo + h / 2 * a1
+                a2 = acceleration(theta + h / 2 * velo, v2)
+                v3 = velo + h / 2 * a2
+                a3 = acceleration(theta + h / 2 * v2, v3)
+                v4 = velo + h * a3
+                a4 = acceleration(theta + h * v3, v4)
+                theta = theta + h / 6 * (velo + 2 * v2 + 2 * v3 + v4)
+                velo = velo + h / 6 * (a1 + 2 * a2 + 2 * a3 + a4)
+        return np.array([theta % (2 * np.pi), velo + noise[1]])
 
     def pendulum_kinematic_single(self, js):
         theta, theat_dot = js
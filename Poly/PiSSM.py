@@ -6,6 +6,7 @@ import numpy as np
 
 from PiSSMTransitionCell import PiSSMTransitionCell, pack_input, unpack_state, pack_state
 from GINSmoothCell import PiSSMSmoothingCell
+from InputPipeline import batch_dataset, num_batches
 
 
 class PiSSM(k.models.Model):
@@ -19,6 +20,11 @@ class PiSSM(k.models.Model):
                  KG_InputSize = 100,
                  Xgru_InputSize = 15,
                  Fgru_InputSize = 15,
+                 packed_covar = False,
+                 covar_rank = 0,
+                 sqrt_covar = False,
+                 parallel_smoothing = False,
+                 inference_basis = "argmax",
                  lr = 0.001,
                  lr_decay = 0.5,
                  lr_decay_it = 15,
@@ -38,6 +44,22 @@ class PiSSM(k.models.Model):
             "Fgru": Q = GRU(F)
             "nothing": Q is learned jointly with the transition matrix (F(Q) in the paper)
         USE_CONV: defines whether use the convolutional layer for the covariance matrix or not
+        packed_covar: carry covariances as packed upper triangles (lsd*(lsd+1)/2 entries) instead of full lsd^2 vectors
+        covar_rank: if > 0, carry covariances as diagonal plus rank-covar_rank factors, for large latent states. The
+            filter update is then the Joseph form of the gain, not the dense sigma - KG S KG^T, so a model trained with
+            covar_rank > 0 is not interchangeable with a dense one. The KG/J networks and the variance decoder get the
+            packed diagonal and factors
+        sqrt_covar: carry Cholesky factors of the covariances (square root filtering and smoothing). The filter and
+            smoother updates are then Joseph forms of the learned gains, not the dense updates, and the elu+1
+            correction acts on the diagonal of the factor, so a model trained with sqrt_covar is not interchangeable
+            with a dense one. The KG/J networks and the variance decoder get sigma = L L^T as in the dense mode. The
+            filter starts from L = I, the all ones initial covariance of the dense mode has no Cholesky factor
+        parallel_smoothing: run the backward pass as a parallel prefix scan over time instead of a sequential RNN.
+            The J gru is not recurrent then, every gain is one gru step from the initial state, and the positive
+            diagonal correction of the covariances is applied once after the scan instead of at every step, so means
+            and covariances differ from the sequential smoother. It is a training time choice, a model trained with
+            one backward pass is not interchangeable with the other
+        inference_basis: deterministic basis selection used by testing, "argmax" or "expected" (see call)
         """
         super().__init__()
 
@@ -48,6 +70,11 @@ class PiSSM(k.models.Model):
         self._never_invalid = never_invalid
         self._ld_output = np.isscalar(self._output_dim)
         self.Smoothing = Smoothing
+        self.sqrt_covar = sqrt_covar
+        self.parallel_smoothing = parallel_smoothing
+        if inference_basis not in ["argmax", "expected"]:
+            raise AssertionError("Invalid inference basis, needs to be 'argmax' or 'expected'")
+        self.inference_basis = inference_basis
         self.cell_type = cell_type
         self.lr = lr
         self.lr_decay = lr_decay
@@ -83,7 +110,10 @@ class PiSSM(k.models.Model):
                                             Fgru_Units =Fgru_Units,
                                             KG_InputSize = KG_InputSize,
                                             Xgru_InputSize = Xgru_InputSize,
-                                            Fgru_InputSize = Fgru_InputSize)
+                                            Fgru_InputSize = Fgru_InputSize,
+                                            packed_covar = packed_covar,
+                                            covar_rank = covar_rank,
+                                            sqrt_covar = sqrt_covar)
         elif self.cell_type.lower() == "lstm":
             print("Running LSTM Baseline")
             self._cell = k.layers.LSTMCell(2 * self._lsd)
@@ -103,7 +133,11 @@ class PiSSM(k.models.Model):
                                                     self._lod,
                                                     init_kf_matrices = 0.05,
                                                     init_KF_matrices = 0.05,
-                                                    USE_CONV = USE_CONV)
+                                                    USE_CONV = USE_CONV,
+                                                    packed_covar = packed_covar,
+                                                    covar_rank = covar_rank,
+                                                    sqrt_covar = sqrt_covar,
+                                                    parallel_scan = parallel_smoothing)
             self._layer_smooth = k.layers.RNN(self._smoothing_cell, return_sequences=True)
 
         self._dec_hidden = self._time_distribute_layers(self.build_decoder_hidden())
@@ -140,11 +174,13 @@ class PiSSM(k.models.Model):
         """
         raise NotImplementedError
 
-    def call(self, inputs, training=None, mask=None):
+    def call(self, inputs, training=None, mask=None, basis_selection="sample"):
         """
         inputs: original observations
         training: required by k.models.Models
         mask: required by k.models.Model
+        basis_selection: "sample" draws the basis of every step and returns its log-probs for reinforce_loss,
+            "argmax" or "expected" (softmax weighted mixture of the bases) are deterministic and return an empty logp_list
         
         """
         if isinstance(inputs, tuple) or isinstance(inputs, list):
@@ -166,6 +202,7 @@ class PiSSM(k.models.Model):
         
 
         if self.cell_type.lower() == 'gin':
+            self._cell.basis_selection = basis_selection
             z = self._layer_rkn(rkn_in)
             # unpack outputs;[ post_mean = mu_t|t, (posterior_mean, i.e. mean filtered),
                             # post_covar = sigma_t|t, (posterior_covar, i.e. covar filtered) 
@@ -173,13 +210,20 @@ class PiSSM(k.models.Model):
                             # prior_covar = sigma_t|t-1 = A_t sigma_t-1|t-1 A_t^T + Q_t
                             # transition_matrix = A_t
             
-            post_mean, post_covar, prior_mean, prior_covar, transition_matrix, logp_list = z
+            post_mean, post_covar, prior_mean, prior_covar, transition_matrix = z[:5]
+            if basis_selection == "sample":
+                logp_list = z[5]
             post_covar = tf.concat(post_covar, -1)
             if self.Smoothing:
                 smooth_mean_init, smooth_covar_init, post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse, transition_matrix_reverse = self.z_time_reverse(z)
-                init_state = pack_state(smooth_mean_init, smooth_covar_init)
-                post_mean_reverse, post_covar_reverse = self._layer_smooth((post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse,
-                                                            transition_matrix_reverse), initial_state = init_state)
+                if self.parallel_smoothing:
+                    post_mean_reverse, post_covar_reverse = self._smoothing_cell.smooth_parallel(smooth_mean_init, smooth_covar_init,
+                                                            (post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse,
+                                                            transition_matrix_reverse))
+                else:
+                    init_state = self._smoothing_cell.pack_initial_state(smooth_mean_init, smooth_covar_init)
+                    post_mean_reverse, post_covar_reverse = self._layer_smooth((post_mean_reverse, post_covar_reverse, prior_mean_reverse, prior_covar_reverse,
+                                                                transition_matrix_reverse), initial_state = init_state)
                 post_mean_reverse = tf.concat([tf.expand_dims(smooth_mean_init, axis=1), post_mean_reverse], axis=1)
                 post_covar_reverse = tf.concat([tf.expand_dims(smooth_covar_init, axis=1), post_covar_reverse], axis=1)
                 post_mean = tf.reverse(post_mean_reverse, axis=[1])
@@ -195,6 +239,11 @@ class PiSSM(k.models.Model):
             post_mean = w_mean
             post_covar = w_covar
 
+        if self.cell_type.lower() == 'gin' and self.sqrt_covar:
+            # the variance decoder gets the covariance sigma = L L^T, not its Cholesky factor
+            post_L = tf.reshape(post_covar, [-1, self._lsd, self._lsd])
+            post_covar = tf.reshape(tf.matmul(post_L, post_L, transpose_b=True), tf.shape(post_covar))
+
         # decode
         pred_mean = self._layer_dec_out(self._prop_through_layers(post_mean, self._dec_hidden))
         if self._ld_output:
@@ -204,7 +253,7 @@ class PiSSM(k.models.Model):
             return pred_mean, logp_list
 
     def z_time_reverse(self, z):
-        post_mean, post_covar, prior_mean, prior_covar, transition_matrix, _ = z
+        post_mean, post_covar, prior_mean, prior_covar, transition_matrix = z[:5]
         smooth_mean_init = post_mean[:, -1, :]
         smooth_covar_init = post_covar[:, -1, :]
 
@@ -252,7 +301,7 @@ class PiSSM(k.models.Model):
         ### Baseline+ REINFORCE
         baseline = tf.reduce_mean(reward, axis=0)  # shape [T]
         baseline = tf.expand_dims(baseline, axis=0)  # [1, T]
-        baseline = tf.tile(baseline, [pred_mean.shape[0], 1])  # [batch, T]
+        baseline = tf.tile(baseline, [tf.shape(pred_mean)[0], 1])  # [batch, T]
         logps = tf.squeeze(logp_list, axis=-1) 
 
         reward = tf.stop_gradient(reward)
@@ -288,109 +337,176 @@ class PiSSM(k.models.Model):
         sample_wise_error = tf.reduce_sum(point_wise_error, axis=red_axis)
         return tf.reduce_mean(sample_wise_error)
     
+    def _train_step(self, model, obs, target, reinforce_optimizer, phi_optimizer):
+        """
+        one REINFORCE step on the DynamicsNet weights and one NLL step on the remaining weights from a single forward
+        pass. The DynamicsNet input is cut off from the gradient in the cell, so reinforce_loss only reaches the
+        DynamicsNet weights and the NLL has no path to them, one backward pass of the sum gives both gradient groups.
+        If a loss or gradient is not finite, neither optimizer is applied, so the weights stay those of the last
+        finite step
+        returns reinforce_loss, phi_loss
+        """
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+
+        with tf.GradientTape() as tape:
+            preds, logp_list = model(obs)
+            reinforce_loss = self.reinforce_loss(target, preds, logp_list)
+            phi_loss = self.gaussian_nll(target, preds)
+            loss = reinforce_loss + phi_loss
+
+        gradients = tape.gradient(loss, dynamic_variables + phi_vars)
+        finite = tf.reduce_all([tf.math.is_finite(reinforce_loss), tf.math.is_finite(phi_loss)] +
+                               [tf.reduce_all(tf.math.is_finite(g)) for g in gradients if g is not None])
+
+        def apply_gradients():
+            reinforce_optimizer.apply_gradients(zip(gradients[:len(dynamic_variables)], dynamic_variables))
+            phi_optimizer.apply_gradients(zip(gradients[len(dynamic_variables):], phi_vars))
+            return tf.constant(True)
+        tf.cond(finite, apply_gradients, lambda: tf.constant(False))
+        return reinforce_loss, phi_loss
+
+    def build_optimizers(self, model, example_obs, steps_per_epoch=1):
+        """
+        persistent optimizers, one per variable group: self.reinforce_optimizer for the coefficient net and
+        self.phi_optimizer for all remaining weights. Both are kept for the whole run, so the Adam moments carry
+        over between steps and are part of the checkpoint
+        the learning rate decays by lr_decay every lr_decay_it epochs (staircase schedule on the optimizer steps)
+        example_obs: one training batch, used to build the model variables
+        steps_per_epoch: number of training batches per epoch
+        """
+        model(example_obs)
+        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
+        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
+        self.lr_schedule = k.optimizers.schedules.ExponentialDecay(self.lr, decay_steps=self.lr_decay_it * steps_per_epoch,
+                                                                   decay_rate=self.lr_decay, staircase=True)
+        self.reinforce_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr_schedule, clipnorm=5.0)
+        self.phi_optimizer = tf.keras.optimizers.Adam(learning_rate = self.lr_schedule, clipnorm=5.0)
+        self.reinforce_optimizer.build(dynamic_variables)
+        self.phi_optimizer.build(phi_vars)
+
+    def make_train_step(self, model, example_obs, example_target, jit_compile=False):
+        """
+        compiled _train_step on the persistent optimizers of build_optimizers
+        example_obs, example_target: one training batch, used to build the model and the input signature. Batch and
+            time dimensions are left unknown in the signature, so the step is traced once for all batch sizes and
+            sequence lengths
+        jit_compile: compile the step with XLA. XLA compiles once per distinct input shape, it is not available with
+            parallel_smoothing
+        returns the tf.function, its experimental_get_tracing_count() is the number of traces. XLA compiles within a
+            trace are not counted
+        """
+        if jit_compile and self.Smoothing and self.parallel_smoothing:
+            raise AssertionError("parallel_smoothing changes tensor shapes inside its scan loops and can not be compiled with XLA")
+        # build model and optimizer variables eagerly, so the traced function never creates variables
+        if getattr(self, "reinforce_optimizer", None) is None:
+            self.build_optimizers(model, example_obs)
+
+        example_obs, example_target = np.asarray(example_obs), np.asarray(example_target)
+        input_signature = [tf.TensorSpec([None, None] + list(example_obs.shape[2:]), tf.as_dtype(example_obs.dtype)),
+                           tf.TensorSpec([None, None] + list(example_target.shape[2:]), tf.as_dtype(example_target.dtype))]
+
+        def train_step(obs, target):
+            return self._train_step(model, obs, target, self.reinforce_optimizer, self.phi_optimizer)
+        return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+
     def training(self, model, Train_Obs, Train_Target, Valid_Obs, Valid_Target,
                  test_obs, test_targets, epochs, batch_size, 
-                 x_epoch, record, fig, ax0, draw_fig):
+                 x_epoch, record, fig, ax0, draw_fig, compiled=False, jit_compile=False,
+                 checkpoint_dir=None, checkpoint_every=1, resume=False, shuffle=False):
         """
         training procedure
         depending on the task, appropriate loss function is taken account
+        compiled: run the training step as a traced tf.function (see make_train_step), optionally jit compiled by XLA
+        checkpoint_dir: if given, model, optimizers and training progress are saved there every checkpoint_every epochs.
+            Training stops at the first step with a non-finite loss, without saving the epoch it diverged in
+        resume: continue from the latest checkpoint in checkpoint_dir, the loss files are appended to
+        shuffle: draw the training sequences in a new random order every epoch (see InputPipeline.batch_dataset)
         """
 
-        #valid batching
-        batch_size = batch_size
-        Valid_Ybatch = []
-        Valid_Ubatch = []
-        Valid_ValidBatch = []
-        for bid in range(int(len(Valid_Target)/batch_size)):
-            Valid_Ybatch.append( Valid_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Valid_Obs)/batch_size)):
-            Valid_Ubatch.append( Valid_Obs[bid*batch_size:(bid+1)*batch_size])
+        train_data = batch_dataset(Train_Obs, Train_Target, batch_size, shuffle=shuffle)
+        num_valid_batches = num_batches(len(Valid_Obs), batch_size)
 
-        Valid_Ybatch = np.array(Valid_Ybatch)
-        Valid_Ubatch = np.array(Valid_Ubatch)
+        self.build_optimizers(model, Train_Obs[:batch_size], steps_per_epoch=num_batches(len(Train_Obs), batch_size))
+        if compiled:
+            train_step = self.make_train_step(model, Train_Obs[:batch_size], Train_Target[:batch_size], jit_compile)
 
-        
-        #train batching
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        ValidBatch = []
-        for bid in range(int(len(Train_Target)/batch_size)):
-            Ybatch.append( Train_Target[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(Train_Obs)/batch_size)):
-            Ubatch.append( Train_Obs[bid*batch_size:(bid+1)*batch_size])
-
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
-
-        
         Training_Loss = []
-        min_test_loss = 500
-        min_train_loss = 500
-        with open(self.result_path + '/trainloss.txt', 'w') as trl:
-            with open(self.result_path + '/testloss.txt', 'w') as tel:
+        min_test_loss = tf.Variable(500., dtype=tf.float64, trainable=False)
+        min_train_loss = tf.Variable(500., dtype=tf.float64, trainable=False)
+        start_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        if checkpoint_dir is not None:
+            checkpoint = tf.train.Checkpoint(model=model, reinforce_optimizer=self.reinforce_optimizer,
+                                             phi_optimizer=self.phi_optimizer, epoch=start_epoch,
+                                             min_train_loss=min_train_loss, min_test_loss=min_test_loss)
+            checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
+            if resume:
+                if checkpoint_manager.latest_checkpoint is None:
+                    raise AssertionError("No checkpoint to resume from in " + checkpoint_dir)
+                checkpoint.restore(checkpoint_manager.latest_checkpoint).assert_existing_objects_matched()
+                print('resumed from %s at epoch %d' % (checkpoint_manager.latest_checkpoint, int(start_epoch)))
+        file_mode = 'a' if resume else 'w'
+        with open(self.result_path + '/trainloss.txt', file_mode) as trl:
+            with open(self.result_path + '/testloss.txt', file_mode) as tel:
                 
-                for epoch in range(epochs):
+                diverged = False
+                for epoch in range(int(start_epoch), epochs):
                     train_loss_epoch =[]
-                    for i in range(len(Ybatch)):
-                        NetIn = Ubatch[i]
-                        with tf.GradientTape() as tape:
-                            preds, logp_list = model(NetIn)
-                            reinforce_loss = self.reinforce_loss(Ybatch[i], preds, logp_list)
+                    for i, (NetIn, target) in enumerate(train_data):
+                        if compiled:
+                            reinforce_loss, phi_loss = train_step(NetIn, target)
+                        else:
+                            reinforce_loss, phi_loss = self._train_step(model, NetIn, target,
+                                                                        self.reinforce_optimizer, self.phi_optimizer)
 
                         print('epoch: %d  reinforce_loss: %s' % (epoch, reinforce_loss.numpy()))
-                        if np.isnan(reinforce_loss.numpy()):
-                            break
-                        dynamic_variables = model._layer_rkn.cell._coefficient_net.weights
-                        # dynamic_variables = model._layer_rkn.cell._coefficient_net.trainable_variables
-                        gradients = tape.gradient(reinforce_loss, dynamic_variables)
-                        tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(gradients, dynamic_variables))
-
-                        with tf.GradientTape() as tape2:
-                            preds, _ = model(NetIn)  # recompute
-                            phi_loss = self.gaussian_nll(Ybatch[i], preds)
-                        
                         print('epoch: %d  base_loss: %s' % (epoch, phi_loss.numpy()))
-                        if np.isnan(phi_loss.numpy()):
+                        if not (np.isfinite(reinforce_loss.numpy()) and np.isfinite(phi_loss.numpy())):
+                            diverged = True
                             break
 
-                        phi_vars =  [v for v in model.trainable_variables if all(v is not d for d in dynamic_variables)]
-                        grads_phi = tape2.gradient(phi_loss, phi_vars)
-                        tf.keras.optimizers.Adam(learning_rate = self.lr, clipnorm=5.0).apply_gradients(zip(grads_phi, phi_vars))
-
                         if i %10==0:
-                            rand_sel = np.random.randint(0, len(Valid_Ubatch))
-                            val_preds, val_logp_list = model(Valid_Ubatch[rand_sel])
-                            val_reinforce_loss = self.reinforce_loss(Valid_Ybatch[rand_sel], val_preds, val_logp_list)
-                            val_phi_loss = self.gaussian_nll(Valid_Ybatch[rand_sel], val_preds)
+                            rand_sel = np.random.randint(0, num_valid_batches)
+                            val_preds, val_logp_list = model(Valid_Obs[rand_sel*batch_size:(rand_sel+1)*batch_size])
+                            val_reinforce_loss = self.reinforce_loss(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds, val_logp_list)
+                            val_phi_loss = self.gaussian_nll(Valid_Target[rand_sel*batch_size:(rand_sel+1)*batch_size], val_preds)
                             val_loss = val_reinforce_loss + val_phi_loss
                             print('val loss: %s' % (val_loss.numpy()))
                         
                         loss = phi_loss + reinforce_loss
                         print('epoch: %d  total_loss: %s' % (epoch, loss.numpy()))
-                        if np.isnan(loss.numpy()):
-                            break
                         train_loss_epoch.append(loss)
                         Training_Loss.append(loss)  
 
+                    if diverged:
+                        # the diverged epoch is not checkpointed, resume starts from the last saved epoch
+                        trl.write("epoch: {}, diverged \n".format(epoch))
+                        print('epoch: %d  training diverged, stopped without saving a checkpoint' % epoch)
+                        break
+
                     average_train_loss = np.mean(np.array(train_loss_epoch))
                     
                     if (average_train_loss < min_train_loss):
-                        min_train_loss = average_train_loss
-                        trl.write("*********************************min_train_loss:{} \n".format(min_train_loss))
+                        min_train_loss.assign(average_train_loss)
+                        trl.write("*********************************min_train_loss:{} \n".format(average_train_loss))
                     average_test_loss = np.mean(np.array(self.testing(model, test_obs, test_targets, batch_size)))
                     if (average_test_loss < min_test_loss):
-                        min_test_loss = average_test_loss
-                        tel.write("*********************************min_train_loss:{} \n".format(min_test_loss))
+                        min_test_loss.assign(average_test_loss)
+                        tel.write("*********************************min_train_loss:{} \n".format(average_test_loss))
                     tel.write("epoch: {}, test_loss:{} \n".format(epoch, average_test_loss))
                     trl.write("epoch: {}, train_loss:{} \n".format(epoch, average_train_loss))
                     if np.isnan(average_train_loss):
                         break
                     self.draw_curve(epoch, average_train_loss, average_test_loss, record, fig, ax0, x_epoch, batch_size, batch_size)
+                    if compiled:
+                        print('train step traces: %d' % train_step.experimental_get_tracing_count())
 
                     if ((epoch+1) % self.lr_decay_it == 0):
-                        self.lr *= self.lr_decay
-                        print(self.lr)
+                        print(float(self.lr_schedule(self.phi_optimizer.iterations)))
+                    start_epoch.assign(epoch+1)
+                    if checkpoint_dir is not None and (epoch+1) % checkpoint_every == 0:
+                        checkpoint_manager.save(checkpoint_number=epoch+1)
                     
             tel.close()
         trl.close()
@@ -402,24 +518,10 @@ class PiSSM(k.models.Model):
         depending on the task, appropriate loss function is taken account
         """
         
-        batch_size = batch_size
-        Ybatch = []
-        Ubatch = []
-        ValidBatch = []
-        for bid in range(int(len(test_targets)/batch_size)):
-            Ybatch.append( test_targets[bid*batch_size:(bid+1)*batch_size])
-        for bid in range(int(len(test_obs)/batch_size)):
-            Ubatch.append( test_obs[bid*batch_size:(bid+1)*batch_size])
-
-        Ybatch = np.array(Ybatch)
-        Ubatch = np.array(Ubatch)
-
-        
         Test_Loss = []
-        for i in range(len(Ybatch)):
-            NetIn = Ubatch[i]
-            preds = model(NetIn)
-            loss = self.gaussian_nll(Ybatch[i], preds)
+        for NetIn, target in batch_dataset(test_obs, test_targets, batch_size):
+            preds, _ = model(NetIn, basis_selection = self.inference_basis)
+            loss = self.gaussian_nll(target, preds)
             print('test loss: %s' % (loss.numpy()))
             Test_Loss.append(loss)
         return Test_Loss
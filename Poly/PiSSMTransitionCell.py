@@ -30,6 +30,61 @@ def unpack_state(state, lsd):
     return mean, covar
 
 
+def packed_covar_size(lsd):
+    """number of entries in the upper triangle (incl. diagonal) of a (lsd, lsd) covariance"""
+    return lsd * (lsd + 1) // 2
+
+
+def pack_covar(covar_matrix, lsd):
+    """
+    packs symmetric covariance matrices [batch, lsd, lsd] into their upper triangle [batch, lsd*(lsd+1)/2]
+    """
+    rows, cols = np.triu_indices(lsd)
+    covar_vector = tf.reshape(covar_matrix, [-1, lsd * lsd])
+    return tf.gather(covar_vector, rows * lsd + cols, axis=-1)
+
+
+def unpack_covar(covar_packed, lsd):
+    """
+    unpacks upper triangles [batch, lsd*(lsd+1)/2] into full symmetric covariance matrices [batch, lsd, lsd]
+    """
+    rows, cols = np.triu_indices(lsd)
+    packed_idx = np.zeros([lsd, lsd], dtype=np.int32)
+    packed_idx[rows, cols] = np.arange(len(rows))
+    packed_idx[cols, rows] = np.arange(len(rows))
+    return tf.reshape(tf.gather(covar_packed, packed_idx.reshape(-1), axis=-1), [-1, lsd, lsd])
+
+
+def pack_low_rank_covar(diag, factors):
+    """
+    packs a diagonal plus low rank covariance diag(d) + U U^T into a single vector
+    diag: [batch, lsd], factors: [batch, lsd, rank] -> [batch, lsd*(rank+1)]
+    """
+    lsd, rank = factors.shape[-2], factors.shape[-1]
+    return tf.concat([diag, tf.reshape(factors, [-1, lsd * rank])], -1)
+
+
+def unpack_low_rank_covar(covar, lsd, rank):
+    """
+    unpacks vectors packed by 'pack_low_rank_covar' into diagonal [batch, lsd] and factors [batch, lsd, rank]
+    """
+    diag = covar[..., :lsd]
+    factors = tf.reshape(covar[..., lsd:], [-1, lsd, rank])
+    return diag, factors
+
+
+def tria(pre_array):
+    """
+    lower triangular square root L of M M^T, L L^T = M M^T, computed by a QR decomposition of M^T
+    pre_array: M [batch, lsd, k] with k >= lsd -> L [batch, lsd, lsd] with non-negative diagonal
+    """
+    _, r = tf.linalg.qr(tf.transpose(pre_array, perm=[0, 2, 1]))
+    L = tf.transpose(r, perm=[0, 2, 1])
+    # flip column signs so the diagonal is non-negative, L L^T is unchanged
+    signs = tf.where(tf.linalg.diag_part(L) < 0, -tf.ones_like(L[:, 0, :]), tf.ones_like(L[:, 0, :]))
+    return L * tf.expand_dims(signs, 1)
+
+
 def pack_input(obs_mean, obs_covar, obs_valid):
     
     if not obs_valid.dtype == tf.float32:
@@ -106,7 +161,10 @@ class PiSSMTransitionCell(k.layers.Layer):
                  Xgru_InputSize = 15,
                  Fgru_InputSize = 15,
                  trans_net_hidden_units=[],
-                 never_invalid=False):
+                 never_invalid=False,
+                 packed_covar=False,
+                 covar_rank=0,
+                 sqrt_covar=False):
 
         """
         latent_state_dim: dimension of the latent state 
@@ -118,6 +176,13 @@ class PiSSMTransitionCell(k.layers.Layer):
         KG_Units: state size of gru cell in the GIN cell
         trans_net_hidden_units: list of number 
         never_invalid: boolean indicating whether all observations are available or a part of it is missing
+        packed_covar: carry the covariance as its packed upper triangle (lsd*(lsd+1)/2 entries) instead of the full lsd^2 
+        covar_rank: if > 0, carry the covariance as diagonal plus rank-covar_rank factors (lsd*(covar_rank+1) entries),
+            prediction and update then work on the factors and never form a (lsd, lsd) covariance. The update is the
+            Joseph form, not the dense sigma - KG S KG^T (see _update_low_rank_covar)
+        sqrt_covar: carry lower triangular Cholesky factors L (sigma = L L^T) instead of the covariance, so covariances
+            are positive definite by construction. The update is the Joseph form, not the dense sigma - KG S KG^T
+            (see _update_sqrt_covar). The KG network gets sigma = L L^T, the initial factor is L = I
         
         """
 
@@ -136,6 +201,9 @@ class PiSSMTransitionCell(k.layers.Layer):
         
         
         self.onelayervar = False # F and H are one layer variable
+        # basis selection of the DynamicsNet: "sample" draws k_t and keeps its log-prob for reinforce_loss,
+        # "argmax" and "expected" (softmax weighted mixture of the bases) are deterministic and keep no log-prob
+        self.basis_selection = "sample"
         self.Qnetwork = Qnetwork
         self.USE_CONV = USE_CONV 
         self.USE_MLP_AFTER_KGGRU = USE_MLP_AFTER_KGGRU
@@ -146,6 +214,25 @@ class PiSSMTransitionCell(k.layers.Layer):
         self.KG_InputSize = KG_InputSize
         self.Xgru_InputSize = Xgru_InputSize
         self.Fgru_InputSize = Fgru_InputSize
+        # hidden states of the KG and Q gru cells are part of the RNN state, Q has none unless a gru is used
+        self.GRUKGunit = self.KG_Units
+        self.GRUQunit = {"Fgru": self.Fgru_Units, "Xgru": self.Xgru_Units}.get(self.Qnetwork, 0)
+
+        self.packed_covar = packed_covar
+        self.covar_rank = covar_rank
+        self.sqrt_covar = sqrt_covar
+        if self.sqrt_covar and (self.packed_covar or self.covar_rank > 0):
+            raise AssertionError("sqrt_covar can not be combined with packed_covar or covar_rank > 0")
+        if self.covar_rank > 0:
+            if self.packed_covar or self.USE_CONV:
+                raise AssertionError("covar_rank > 0 can not be combined with packed_covar or USE_CONV")
+            if self.covar_rank > self._lsd:
+                raise AssertionError("covar_rank can not be larger than the latent state dimension")
+            self._covar_size = self._lsd * (self.covar_rank + 1)
+        elif self.packed_covar:
+            self._covar_size = packed_covar_size(self._lsd)
+        else:
+            self._covar_size = self._lsd**2
         
         
     def build(self, input_shape):
@@ -194,54 +281,45 @@ class PiSSMTransitionCell(k.layers.Layer):
             
         if self.Qnetwork == "Fgru":
             #build Q gru parameters
-            self.GRUQunit = self.Fgru_Units
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lod * self._lod], name="grulastweight", initializer='random_normal') #(KG, lod^2)
             self.NextWeightGRUQ = self.add_weight(shape=[self.GRUQunit , self._lsd], name="grunextweight", initializer='random_normal') #(gru out, Q)
             self.PrevWeightGRUQ = self.add_weight(shape=[  self._lsd**2 , self.Fgru_InputSize ], name="gruprevweight", initializer='random_normal')# (2*lsd, gru in)
             self.GRUQ = k.layers.GRUCell( self.GRUQunit)
-            self.GRUQ_state = self.init_Q_matrices * tf.ones([input_shape[0],  self.GRUQunit ])
             
         if self.Qnetwork == "Xgru":
             #build Q gru parameters
-            self.GRUQunit = self.Xgru_Units
             # self.CholeskyKG = self.add_weight(shape=[ self._lsd * self._lod , self._lod * self._lod], name="grulastweight", initializer='random_normal') #(KG, lod^2)
             self.NextWeightGRUQ = self.add_weight(shape=[self.GRUQunit , self._lsd], name="grunextweight", initializer='random_normal') #(gru out, Q)
             self.PrevWeightGRUQ = self.add_weight(shape=[  self._lsd , self.Xgru_InputSize ], name="gruprevweight", initializer='random_normal')# (2*lsd, gru in)
             self.GRUQ = k.layers.GRUCell( self.GRUQunit)
-            self.GRUQ_state = self.init_Q_matrices * tf.ones([input_shape[0],  self.GRUQunit ])
             
         
         
         if self.USE_CONV == True:
             #build KG gru parameters
             if self.USE_MLP_AFTER_KGGRU == True:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[4 * self._lsd * self._lod , self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(4*KG, KG)
                 self.NextWeightKG = self.add_weight(shape=[self.GRUKGunit ,4 * self._lsd * self._lod], name="grunextweight", initializer='random_normal') #(gru out, KG*4)
-                self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
+                self.PrevWeightKG = self.add_weight(shape=[3*self._lsd + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + conv out, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
             else:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[self.GRUKGunit, self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(gru out, KG)
-                self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
+                self.PrevWeightKG = self.add_weight(shape=[3*self._lsd + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + conv out, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
+            #build conv covariance encoder once, its weights are tracked by the cell and reused at every step
+            self._conv_covar_layers = self.build_conv_gru()
+            self._build_layers(self._conv_covar_layers, [None, self._lsd, self._lsd, 1])
         if self.USE_CONV == False:
             #build KG gru parameters
             if self.USE_MLP_AFTER_KGGRU == True:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[4 * self._lsd * self._lod , self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(4*KG, KG)
                 self.NextWeightKG = self.add_weight(shape=[self.GRUKGunit ,4 * self._lsd * self._lod], name="grunextweight", initializer='random_normal') #(gru out, KG*4)
-                self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
+                self.PrevWeightKG = self.add_weight(shape=[self._covar_size + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + covar, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
             else:
-                self.GRUKGunit = self.KG_Units 
                 self.LastWeightKG = self.add_weight(shape=[self.GRUKGunit, self._lsd * self._lod], name="grulastweight", initializer='random_normal') #(gru out, KG)
-                self.PrevWeightKG = self.add_weight(shape=[self._lsd**2 + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + lsd^2, gru in)
+                self.PrevWeightKG = self.add_weight(shape=[self._covar_size + self._lod, self.KG_InputSize], name="gruprevweight", initializer='random_normal')# (lod + covar, gru in)
                 self.GRUKG = k.layers.GRUCell( self.GRUKGunit)
-                self.GRUKG_state = self.init_KF_matrices * tf.ones([input_shape[0],  self.GRUKGunit ])
         
         #build dense layer for diag covariance
         self._layer_covar_gru = k.layers.Dense(self._lsd, activation=lambda x: k.activations.elu(x) + 1)
@@ -252,24 +330,25 @@ class PiSSMTransitionCell(k.layers.Layer):
         """ similar to the LSTM and GRU cells. The names and parameters of the GIN cell 
         mathch with those of the RNN based cells
         inputs: Mean and covariance vectors 
-        states: Last Latent Posterior State 
+        states: Last Latent Posterior State and the hidden states of the KG and Q gru cells
         
         """
         # unpack inputs
         obs_mean, obs_covar, obs_valid = unpack_input(inputs)
-        state_mean, state_covar = states[0]  # mu_t-1 and sigma_t-1 at time t
+        state_mean, state_covar, gru_kg_state, gru_q_state = states[0]  # mu_t-1 and sigma_t-1 at time t
 
         # save logp of categorical samples for REINFORCE
         logp_list = []
         # predict step (next prior from current posterior (i.e. cell state))
-        prior_mean, prior_covar, logp_list = self._predict(state_mean, state_covar, logp_list) # mu_t|t-1 and sigma_t|t-1 at time t
+        prior_mean, prior_covar, logp_list, gru_q_state = self._predict(state_mean, state_covar, logp_list, gru_q_state) # mu_t|t-1 and sigma_t|t-1 at time t
         
 
         # update step (current posterior from current prior)
+        KG, gru_kg_state = self._predict_kg_gru(prior_covar, obs_covar, gru_kg_state)
         if self._never_invalid:
-            dec_mean, dec_covar = self._update(prior_mean, prior_covar, obs_mean, obs_covar)# mu_t|t  and sigma_t|t  at time t
+            dec_mean, dec_covar = self._update(prior_mean, prior_covar, obs_mean, obs_covar, KG)# mu_t|t  and sigma_t|t  at time t
         else:
-            dec_mean, dec_covar = self._masked_update(prior_mean, prior_covar, obs_mean, obs_covar, obs_valid)
+            dec_mean, dec_covar = self._masked_update(prior_mean, prior_covar, obs_mean, obs_covar, obs_valid, KG)
         
 
         # pack outputs;[ dec_mean = mu_t|t, (posterior_mean, i.e. mean filtered),
@@ -277,15 +356,17 @@ class PiSSMTransitionCell(k.layers.Layer):
                        # prior_mean = mu_t|t-1 = A_t mu_t-1|t-1, 
                        # prior_covar = sigma_t|t-1 = A_t sigma_t-1|t-1 A_t^T + Q_t
                        # transition_matrix = A_t
-        output = [dec_mean, dec_covar, prior_mean, prior_covar, self.transition_matrix, logp_list]
+        output = [dec_mean, dec_covar, prior_mean, prior_covar, self.transition_matrix]
+        if self.basis_selection == "sample":
+            output.append(logp_list)
         # pack states
-        post_state = (dec_mean, dec_covar)
+        post_state = (dec_mean, dec_covar, gru_kg_state, gru_q_state)
         
         return output, [post_state]
     
     
 
-    def _predict(self, post_mean, prior_covar, logp_list):
+    def _predict(self, post_mean, prior_covar, logp_list, gru_q_state):
         """ 
         Performs prediction step
         
@@ -293,13 +374,23 @@ class PiSSMTransitionCell(k.layers.Layer):
         # compute state dependent transition matrix and Hmatrix
         # coefficients = self._coefficient_net(post_mean)
 
-        logits = self._coefficient_net(post_mean)  # shape: [batch_size, K]
-        k_t = tf.random.categorical(logits, num_samples=1)  # shape: [batch_size, 1]
-        k_t = tf.squeeze(k_t, axis=-1)  # shape: [batch_size]
-
-        logp = tf.nn.log_softmax(logits)  # [batch, K]
-        logp_k = tf.gather(logp, k_t[:, None], batch_dims=1)  # shape [batch, 1]
-        logp_list.append(logp_k) # at the enf will be [batch, T, 1]
+        # a sampled basis carries no gradient to the posterior mean, so the DynamicsNet input is cut off and
+        # reinforce_loss only reaches the DynamicsNet weights
+        dynamics_in = tf.stop_gradient(post_mean) if self.basis_selection == "sample" else post_mean
+        logits = self._coefficient_net(dynamics_in)  # shape: [batch_size, K]
+        if self.basis_selection == "sample":
+            k_t = tf.random.categorical(logits, num_samples=1)  # shape: [batch_size, 1]
+            k_t = tf.squeeze(k_t, axis=-1)  # shape: [batch_size]
+
+            logp = tf.nn.log_softmax(logits)  # [batch, K]
+            logp_k = tf.gather(logp, k_t[:, None], batch_dims=1)  # shape [batch, 1]
+            logp_list.append(logp_k) # at the enf will be [batch, T, 1]
+        elif self.basis_selection == "argmax":
+            k_t = tf.argmax(logits, axis=-1)  # shape: [batch_size]
+        elif self.basis_selection == "expected":
+            coefficients = tf.nn.softmax(logits)  # shape: [batch_size, K]
+        else:
+            raise AssertionError("Invalid basis selection, needs to be 'sample', 'argmax' or 'expected'")
 
         if self.onelayervar:
             #stack F matrix 
@@ -318,84 +409,115 @@ class PiSSMTransitionCell(k.layers.Layer):
         # scaled_H = tf.reshape(coefficients, [-1, self._num_basis, 1, 1]) * self.Hmatrix
         # self.H_matrix = tf.reduce_sum(scaled_H, 1)
             
-        # Fetch F_k and H_k
-        F_k = tf.gather(tf.squeeze(self.Fmatrix, axis=0) , k_t)  # shape: [batch_size, lsd, lsd]
-        H_k = tf.gather(tf.squeeze(self.Hmatrix, axis=0) , k_t)  # shape: [batch_size, m, lsd]
-        self.transition_matrix = F_k
-        self.H_matrix = H_k
+        if self.basis_selection == "expected":
+            # Soft weight matrices
+            self.transition_matrix = tf.reduce_sum(tf.reshape(coefficients, [-1, self._num_basis, 1, 1]) * self.Fmatrix, 1)
+            self.H_matrix = tf.reduce_sum(tf.reshape(coefficients, [-1, self._num_basis, 1, 1]) * self.Hmatrix, 1)
+        else:
+            # Fetch F_k and H_k
+            F_k = tf.gather(tf.squeeze(self.Fmatrix, axis=0) , k_t)  # shape: [batch_size, lsd, lsd]
+            H_k = tf.gather(tf.squeeze(self.Hmatrix, axis=0) , k_t)  # shape: [batch_size, m, lsd]
+            self.transition_matrix = F_k
+            self.H_matrix = H_k
 
         # predict next prior mean
         expanded_state_mean = tf.expand_dims(post_mean, -1)
         new_mean = tf.squeeze(tf.matmul(self.transition_matrix, expanded_state_mean), -1)
         
         #compute Q 
-        prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
         if self.Qnetwork == "Fmlp":
             Q = self._predict_q_Fmlp(self.transition_matrix)
-            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "Fgru":
-            Q = self._predict_q_Fgru(self.transition_matrix)
-            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
+            Q, gru_q_state = self._predict_q_Fgru(self.transition_matrix, gru_q_state)
         if self.Qnetwork == "Xmlp":
             Q = self._predict_q_Xmlp(post_mean)
-            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
         if self.Qnetwork == "Xgru":
-            Q = self._predict_q_Xgru(post_mean)
-            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
+            Q, gru_q_state = self._predict_q_Xgru(post_mean, gru_q_state)
         if self.Qnetwork == "nothing":
             # Q = self._predict_q_Xgru(post_mean)
-            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) 
-        new_covar = tf.reshape(new_covar, [new_covar.shape[0], -1])
+            Q = tf.zeros_like(post_mean)
+
+        if self.covar_rank > 0:
+            new_covar = self._predict_low_rank_covar(prior_covar, Q)
+        elif self.sqrt_covar:
+            new_covar = self._predict_sqrt_covar(prior_covar, Q)
+        else:
+            prior_covar_matrix = self._covar_to_matrix(prior_covar)
+            new_covar = tf.matmul (tf.matmul(self.transition_matrix, prior_covar_matrix), tf.transpose(self.transition_matrix, perm=[0, 2, 1])) + tf.linalg.diag(Q)
+            new_covar = self._matrix_to_covar(new_covar)
      
-        return new_mean, new_covar, logp_list
+        return new_mean, new_covar, logp_list, gru_q_state
+
+    def _predict_low_rank_covar(self, post_covar, Q):
+        """
+        F (D + U U^T) F^T + Q with P = D + U U^T: the factors are propagated exactly (U <- F U) and F D F^T is
+        projected on the diagonal, diag(F D F^T) = F^2 d. Only F itself is lsd x lsd, the cost is O(lsd^2 * rank)
+        instead of O(lsd^3)
+        """
+        diag, factors = unpack_low_rank_covar(post_covar, self._lsd, self.covar_rank)
+        new_factors = tf.matmul(self.transition_matrix, factors)
+        new_diag = tf.squeeze(tf.matmul(tf.square(self.transition_matrix), tf.expand_dims(diag, -1)), -1) + Q
+        return pack_low_rank_covar(new_diag, new_factors)
+
+    def _predict_sqrt_covar(self, post_covar, Q):
+        """
+        square root prediction, sigma_t|t-1 = [F L, Q^1/2] [F L, Q^1/2]^T is triangularized by a QR decomposition
+        """
+        post_L = self._covar_to_matrix(post_covar)
+        pre_array = tf.concat([tf.matmul(self.transition_matrix, post_L), tf.linalg.diag(tf.sqrt(tf.maximum(Q, 1e-12)))], -1) # [batch, lsd, 2*lsd], floored so Q = 0 keeps finite gradients
+        return self._matrix_to_covar(tria(pre_array))
     
     def _predict_q_Fmlp(self, transition_matrix): # F_t is used
-        stacked_states = tf.reshape(transition_matrix, [transition_matrix.shape[0], -1])
+        stacked_states = tf.reshape(transition_matrix, [-1, self._lsd**2])
         Q = self._layer_Q_MLP(stacked_states)   
         return Q
     
     def _predict_q_Xmlp(self, state_mean): # state_mean = mu_t-1|t-1
-        stacked_states = tf.reshape(state_mean, [state_mean.shape[0], -1])
+        stacked_states = tf.reshape(state_mean, [-1, self._lsd])
         Q = self._layer_Q_MLP(stacked_states)   
         return Q
     
-    def _predict_q_Fgru(self, transition_matrix): # F_t is used
-        stacked_states = tf.reshape(transition_matrix, [transition_matrix.shape[0], -1])
+    def _predict_q_Fgru(self, transition_matrix, gru_q_state): # F_t is used
+        stacked_states = tf.reshape(transition_matrix, [-1, self._lsd**2])
         in_GRU = tf.matmul(stacked_states, self.PrevWeightGRUQ)
-        Q, _ = self.GRUQ(in_GRU, self.GRUQ_state)
-        self.GRUQ_state = Q # next self.GRUQ_state
+        Q, _ = self.GRUQ(in_GRU, gru_q_state)
+        gru_q_state = Q # next gru_q_state
         Q = tf.matmul(Q, self.NextWeightGRUQ)
         Q = elup1(Q)
-        return Q
+        return Q, gru_q_state
     
-    def _predict_q_Xgru(self, state_mean): # state_mean = mu_t-1|t-1
+    def _predict_q_Xgru(self, state_mean, gru_q_state): # state_mean = mu_t-1|t-1
         # stacked_states = tf.concat([state_mean, prior_mean], axis=-1)
         in_GRU = tf.matmul(state_mean, self.PrevWeightGRUQ)
-        Q, _ = self.GRUQ(in_GRU, self.GRUQ_state)
-        self.GRUQ_state = Q # next self.GRUQ_state
+        Q, _ = self.GRUQ(in_GRU, gru_q_state)
+        gru_q_state = Q # next gru_q_state
         Q = tf.matmul(Q, self.NextWeightGRUQ)
         Q = elup1(Q)
-        return Q
+        return Q, gru_q_state
     
-    def _predict_kg_gru(self, prior_covar, obs_covar):
+    def _predict_kg_gru(self, prior_covar, obs_covar, gru_kg_state):
         
+        if self.sqrt_covar:
+            # the gain network gets the covariance sigma = L L^T as in the dense mode, not its Cholesky factor
+            prior_L = self._covar_to_matrix(prior_covar)
+            prior_covar = self._matrix_to_covar(tf.matmul(prior_L, prior_L, transpose_b=True))
         if self.USE_CONV == True:
             #propagate covar matrix through the conv2d
-            prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+            prior_covar_matrix = self._covar_to_matrix(prior_covar)
             prior_covar_matrix = tf.expand_dims(prior_covar_matrix, -1)
-            prior_covar = self._prop_to_layers(prior_covar_matrix, self.build_conv_gru())
+            prior_covar = self._prop_to_layers(prior_covar_matrix, self._conv_covar_layers)
             
         #
         stacked_covars = tf.concat([prior_covar, obs_covar], axis=-1)
         in_GRU = tf.matmul(stacked_covars, self.PrevWeightKG)
-        KG, _ = self.GRUKG(in_GRU, self.GRUKG_state)
-        self.GRUKG_state = KG # next self.GRUKG_state
+        KG, _ = self.GRUKG(in_GRU, gru_kg_state)
+        gru_kg_state = KG # next gru_kg_state
         if self.USE_MLP_AFTER_KGGRU == True:
             KG = tf.matmul(KG, self.NextWeightKG)
             KG = tf.matmul(KG, self.LastWeightKG)
         else:
             KG = tf.matmul(KG, self.LastWeightKG)
-        KG = tf.reshape(KG, [KG.shape[0], self._lsd, self._lod])
+        KG = tf.reshape(KG, [-1, self._lsd, self._lod])
 
         # KG = tf.matmul(KG, self.NextWeightKG)
         # KG = tf.matmul(KG, self.LastWeightKG)
@@ -407,7 +529,7 @@ class PiSSMTransitionCell(k.layers.Layer):
         # Positive_KG = elup_Diag_elements + ( KG - tf.linalg.diag(tf.linalg.diag_part(KG)))
         # KG = tf.matmul(tf.matmul(prior_covar, tf.transpose(self.H_matrix)), tf.matmul(Positive_KG, tf.transpose(Positive_KG)))
 
-        return KG
+        return KG, gru_kg_state
     
     def build_conv_gru(self):
         return [
@@ -425,37 +547,38 @@ class PiSSMTransitionCell(k.layers.Layer):
             # 3: Dense Layer
             k.layers.Dense(3*self._lsd, activation=k.activations.linear, name="dense gru")]
 
-    def _masked_update(self, prior_mean, prior_covar, obs_mean, obs_covar, obs_valid):
+    def _masked_update(self, prior_mean, prior_covar, obs_mean, obs_covar, obs_valid, KG):
         
 
-        posterior_mean, posterior_covar_vector = self._update(prior_mean, prior_covar, obs_mean, obs_covar)
+        posterior_mean, posterior_covar_vector = self._update(prior_mean, prior_covar, obs_mean, obs_covar, KG)
         
         #select posterior if obs is available, otherwise select prior
+        #obs_valid is [batch], expand it so one tf.where broadcasts over the whole batch
+        obs_valid = tf.expand_dims(obs_valid, -1)
         #select mean
-        masked_mean = tf.squeeze(tf.convert_to_tensor([tf.where(obs_valid[i], posterior_mean[i], prior_mean[i]) for i in range(len(obs_valid))],
-                                 dtype=tf.float32)) # masked_mean = posterior_mean if obs_valid else prior_mean
-        
+        masked_mean = tf.where(obs_valid, posterior_mean, prior_mean) # masked_mean = posterior_mean if obs_valid else prior_mean
         
         #select covar        
-        masked_covar = tf.convert_to_tensor([tf.where(obs_valid[i], posterior_covar_vector[i], prior_covar[i]) for i in range(len(obs_valid))],
-                                 dtype=tf.float32) # masked_mean = posterior_mean if obs_valid else prior_mean
+        masked_covar = tf.where(obs_valid, posterior_covar_vector, prior_covar) # masked_covar = posterior_covar if obs_valid else prior_covar
         
         return masked_mean, masked_covar
 
-    def _update(self, prior_mean, prior_covar, obs_mean, obs_covar):
-        #(mu_t|t-1, sigma_t|t-1, obs_mu_t, obs_covar_t)
-        
-        
-        KG = self._predict_kg_gru( prior_covar, obs_covar)
+    def _update(self, prior_mean, prior_covar, obs_mean, obs_covar, KG):
+        #(mu_t|t-1, sigma_t|t-1, obs_mu_t, obs_covar_t, KG_t)
         
         # posterior mean
         expanded_prior_mean_mean = tf.expand_dims(prior_mean, -1)
         expanded_obs_mean = tf.expand_dims(obs_mean, -1)
         diff_y = expanded_obs_mean - tf.matmul(self.H_matrix, expanded_prior_mean_mean)
-        posterior_mean = prior_mean - tf.squeeze(tf.matmul(KG, diff_y))
+        posterior_mean = prior_mean - tf.squeeze(tf.matmul(KG, diff_y), -1)
+
+        if self.covar_rank > 0:
+            return posterior_mean, self._update_low_rank_covar(prior_covar, obs_covar, KG)
+        if self.sqrt_covar:
+            return posterior_mean, self._update_sqrt_covar(prior_covar, obs_covar, KG)
         
         #posterior covar
-        prior_covar_matrix = tf.reshape(prior_covar, [prior_covar.shape[0], self._lsd, self._lsd])
+        prior_covar_matrix = self._covar_to_matrix(prior_covar)
         S = tf.matmul( tf.matmul(self.H_matrix , prior_covar_matrix), tf.transpose(self.H_matrix, perm=[0, 2, 1])) + tf.linalg.diag(obs_covar)
         posterior_covar_matrix = prior_covar_matrix - tf.matmul(tf.matmul(KG,S), tf.transpose(KG, perm=[0, 2, 1]))
         #
@@ -464,8 +587,50 @@ class PiSSMTransitionCell(k.layers.Layer):
         elup_Diag_elements = tf.linalg.diag(elup1(Diag_elements_dense))
         posterior_covar_matrix = elup_Diag_elements + ( posterior_covar_matrix - tf.linalg.diag(tf.linalg.diag_part(posterior_covar_matrix)))
         #
-        posterior_covar_vector = tf.reshape(posterior_covar_matrix, [posterior_covar_matrix.shape[0], -1])
+        posterior_covar_vector = self._matrix_to_covar(posterior_covar_matrix)
         return posterior_mean, posterior_covar_vector # mu_t|t, sigma_t|t at t
+
+    def _update_low_rank_covar(self, prior_covar, obs_covar, KG):
+        """
+        posterior covariance in diagonal plus low rank form. The mean update is mu - KG (y - H mu), i.e. the effective
+        gain is G = -KG, and the Joseph form (I - G H) P (I - G H)^T + G R G^T keeps the result positive semi-definite.
+        This is a different update than the P - KG S KG^T of the dense path: both agree only for the optimal gain
+        G = P H^T S^-1, with the learned KG the low rank mode is a different filter, and weights trained in one mode
+        do not carry over to the other.
+        The factors are propagated exactly (U <- U + KG (H U)), the remaining terms are projected on the diagonal:
+        diag((I + KG H) D (I + KG H)^T + KG R KG^T) = d + 2 d diag(KG H) + diag(KG (H D H^T + R) KG^T). No lsd x lsd
+        matrix is formed, the cost is O(lsd * lod * (lod + rank)). The elu+1 correction acts on that diagonal part
+        only, the dense path corrects the whole diagonal of P
+        """
+        diag, factors = unpack_low_rank_covar(prior_covar, self._lsd, self.covar_rank)
+        H_T = tf.transpose(self.H_matrix, perm=[0, 2, 1]) # [batch, lsd, lod]
+        new_factors = factors + tf.matmul(KG, tf.matmul(self.H_matrix, factors))
+        KGH_diag = tf.reduce_sum(KG * H_T, -1) # diag(KG H)
+        S_diag = tf.matmul(self.H_matrix, H_T * tf.expand_dims(diag, -1)) + tf.linalg.diag(obs_covar) # H D H^T + R, [batch, lod, lod]
+        new_diag = diag * (1. + 2. * KGH_diag) + tf.reduce_sum(tf.matmul(KG, S_diag) * KG, -1)
+        #
+        new_diag = elup1(self._layer_covar_gru(new_diag))
+        #
+        return pack_low_rank_covar(new_diag, new_factors)
+
+    def _update_sqrt_covar(self, prior_covar, obs_covar, KG):
+        """
+        square root update of the Joseph form (I - G H) L L^T (I - G H)^T + G R G^T with the effective gain G = -KG,
+        triangularized by a QR decomposition. Like the low rank mode, this is the dense P - KG S KG^T only for the
+        optimal gain G = P H^T S^-1, with the learned KG it is a different filter. The Joseph form is kept because
+        P - KG S KG^T need not be positive definite and then has no Cholesky factor.
+        The learned elu+1 diagonal correction acts on the diagonal of the factor, not of the covariance, so L stays
+        non-singular and the posterior covariance positive definite
+        """
+        prior_L = self._covar_to_matrix(prior_covar)
+        I_KGH = tf.eye(self._lsd, batch_shape=[1]) + tf.matmul(KG, self.H_matrix)
+        pre_array = tf.concat([tf.matmul(I_KGH, prior_L), KG * tf.expand_dims(tf.sqrt(obs_covar), 1)], -1) # [batch, lsd, lsd+lod]
+        posterior_L = tria(pre_array)
+        #
+        Diag_elements_dense = self._layer_covar_gru(tf.linalg.diag_part(posterior_L))
+        posterior_L = tf.linalg.set_diag(posterior_L, elup1(Diag_elements_dense))
+        #
+        return self._matrix_to_covar(posterior_L)
         
     
     def get_initial_state(self, inputs, batch_size, dtype):
@@ -474,10 +639,43 @@ class PiSSMTransitionCell(k.layers.Layer):
         
         """
         initial_mean = tf.zeros([batch_size,  self._lsd], dtype=dtype)
-        initial_covar = tf.ones([batch_size,  self._lsd * self._lsd], dtype=dtype)
+        if self.covar_rank > 0:
+            # all ones covariance as in the full case, 1 1^T: zero diagonal and the first factor set to ones
+            init_factors = np.zeros([1, self._lsd, self.covar_rank])
+            init_factors[..., 0] = 1.
+            initial_covar = tf.tile(pack_low_rank_covar(tf.zeros([1, self._lsd], dtype=dtype), tf.constant(init_factors, dtype=dtype)), [batch_size, 1])
+        elif self.sqrt_covar:
+            # the all ones covariance of the full case is singular and has no Cholesky factor, start from L = I
+            initial_covar = tf.tile(tf.reshape(tf.eye(self._lsd, dtype=dtype), [1, -1]), [batch_size, 1])
+        else:
+            initial_covar = tf.ones([batch_size,  self._covar_size], dtype=dtype)
+        # gru hidden states start from their init value at the beginning of every sequence
+        initial_gru_kg_state = self.init_KF_matrices * tf.ones([batch_size, self.GRUKGunit], dtype=dtype)
+        initial_gru_q_state = self.init_Q_matrices * tf.ones([batch_size, self.GRUQunit], dtype=dtype)
         
-        return [(initial_mean, initial_covar)]
+        return [(initial_mean, initial_covar, initial_gru_kg_state, initial_gru_q_state)]
     
+    def _covar_to_matrix(self, covar):
+        """flat (or packed) covariance vector to [batch, lsd, lsd]"""
+        if self.packed_covar:
+            return unpack_covar(covar, self._lsd)
+        return tf.reshape(covar, [-1, self._lsd, self._lsd])
+
+    def _matrix_to_covar(self, covar_matrix):
+        """[batch, lsd, lsd] to flat (or packed) covariance vector"""
+        if self.packed_covar:
+            return pack_covar(covar_matrix, self._lsd)
+        return tf.reshape(covar_matrix, [-1, self._covar_size])
+
+    @staticmethod
+    def _build_layers(layers, input_shape):
+        """builds layers once, in order, starting from input_shape"""
+        shape = tf.TensorShape(input_shape)
+        for layer in layers:
+            layer.build(shape)
+            shape = layer.compute_output_shape(shape)
+        return shape
+
     @staticmethod
     def _prop_to_layers(inputs, convlayers):
         """propagation"""
@@ -489,4 +687,4 @@ class PiSSMTransitionCell(k.layers.Layer):
     @property
     def state_size(self):
         """ state size as a required function of RNN based cell"""
-        return self._lsd + self._lsd**2
\ No newline at end of file
+        return self._lsd + self._covar_size + self.GRUKGunit + self.GRUQunit
\ No newline at end of file
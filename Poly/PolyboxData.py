@@ -1,36 +1,358 @@
 
-import pygame
-import pymunk.pygame_util
+import pymunk
 import numpy as np
+import multiprocessing
 import os
+import shutil
 
+# version of the generated data, part of the cache key of the data sets (see DatasetCache). Increase it with every
+# change of the frames or states BallBox generates
+DATA_VERSION = 1
 
-class BallBox:
-    def __init__(self, dt=0.2, res=(32, 32), init_pos=(3, 3), init_std=0, wall=None):
-        pygame.init()
 
-        self.dt = dt
+# color of the ball and the walls, pygame.color.THECOLORS["white"] without importing pygame (only the pygame renderer
+# needs it, it is imported there)
+WHITE = (255, 255, 255, 255)
+
+# corner points of the static walls of BallBox.run(shape=...), the last point closes the polygon
+WALLS = {1: [(1, 8), (1, 22), (8, 30), (22, 30), (30, 22), (30, 8), (22, 1), (8, 1), (1, 8)],
+         2: [(3, 1), (1, 15), (8, 30), (25, 30), (30, 8), (15, 1), (3, 1)]}
+
+
+def _color_value(color):
+    # frame value of a color on the 24 bit screen, as read back by BallBox.run
+    return ((int(color[0]) << 16) + (int(color[1]) << 8) + int(color[2])) / (2**24 - 1)
+
+
+def _draw_line(canvas, p1, p2, value):
+    # pygame.draw.line with width 1 (Bresenham)
+    (x1, y1), (x2, y2) = p1, p2
+    dx, sx = abs(x2 - x1), 1 if x1 < x2 else -1
+    dy, sy = abs(y2 - y1), 1 if y1 < y2 else -1
+    err = int((dx if dx > dy else -dy) / 2)
+    points = [(x2, y2)]
+    while x1 != x2 or y1 != y2:
+        points.append((x1, y1))
+        e2 = err
+        if e2 > -dx:
+            err -= dy
+            x1 += sx
+        if e2 < dy:
+            err += dx
+            y1 += sy
+    for x, y in points:
+        if 0 <= x < canvas.shape[1] and 0 <= y < canvas.shape[0]:
+            canvas[y, x] = value
+
+
+def _circle_offsets(radius):
+    # pixels of pygame.draw.circle(..., radius, 0) relative to its center, as (dx, dy) rows
+    rows = {}
+
+    def hline(x1, x2, y):
+        lo, hi = rows.get(y, (x1, x2))
+        rows[y] = (min(lo, x1), max(hi, x2))
+
+    f, ddf_x, ddf_y, x, y = 1 - radius, 0, -2 * radius, 0, radius
+    while x < y:
+        if f >= 0:
+            y -= 1
+            ddf_y += 2
+            f += ddf_y
+        x += 1
+        ddf_x += 2
+        f += ddf_x + 1
+        if f >= 0:
+            hline(-x, x - 1, y - 1)
+            hline(-x, x - 1, -y)
+        hline(-y, y - 1, x - 1)
+        hline(-y, y - 1, -x)
+    return np.array([(dx, dy) for dy, (lo, hi) in rows.items() for dx in range(lo, hi + 1)], dtype=np.int64)
+
+
+class FrameRenderer:
+    """
+    headless replacement of the pygame frames of BallBox: rasterizes the ball and the static walls for a whole batch of
+    positions with array operations, pixel for pixel like space.debug_draw on the 24 bit screen, except for the contact
+    points: debug_draw marks them with small anti-aliased dots in collision_point_color (231, 76, 60) while the ball
+    touches a wall, FrameRenderer does not draw them. A few pixels differ, by up to about 0.95, in 8 to 14 of the 90
+    frames of a 6 sequence, 15 step run (test_frame_renderer.py), all other pixels are the same
+    res: (width, height) of the frames
+    radius: radius of the ball
+    walls: corner points of the wall polygon (see WALLS)
+    """
+    def __init__(self, res=(32, 32), radius=3, walls=WALLS[1], ball_color=(255, 255, 255),
+                 wall_color=(255, 255, 255), outline_color=(44, 62, 80)):
         self.res = res
-        if os.environ.get('SDL_VIDEODRIVER', '') == 'dummy':
-            pygame.display.set_mode(res, 0, 24)
-            self.screen = pygame.Surface(res, pygame.SRCCOLORKEY, 24)
-            pygame.draw.rect(self.screen, (0, 0, 0), (0, 0, res[0], res[1]), 0)
+        self.radius = radius
+        self.ball_value = _color_value(ball_color)
+        self.outline_value = _color_value(outline_color)
+        self.circle = _circle_offsets(int(round(radius)))
+
+        # the static walls are drawn last, on top of the ball, in every frame
+        walls_layer = np.full((res[1], res[0]), np.nan, dtype=np.float32)
+        value = _color_value(wall_color)
+        for p1, p2 in zip(walls[:-1], walls[1:]):
+            _draw_line(walls_layer, tuple(int(round(p)) for p in p1), tuple(int(round(p)) for p in p2), value)
+        self.walls_mask = ~np.isnan(walls_layer)
+        self.walls_layer = np.nan_to_num(walls_layer)
+
+    def _stamp(self, flat, points, value):
+        # flat: frames as (N, height * width), points: (N, K, 2) pixel coordinates (x, y)
+        width, height = self.res
+        inside = (points[..., 0] >= 0) & (points[..., 0] < width) & (points[..., 1] >= 0) & (points[..., 1] < height)
+        frame_index = np.broadcast_to(np.arange(len(flat))[:, None], inside.shape)
+        flat[frame_index[inside], points[..., 1][inside] * width + points[..., 0][inside]] = value
+
+    def render(self, position, angle=None, out=None):
+        """
+        position: ball positions, shape (..., 2), e.g. (sequences, T, 2)
+        angle: ball angles, shape (...), the orientation line of debug_draw, 0 if None
+        out: optional contiguous float32 array of shape (..., height, width) to render into
+        returns the frames, shape (..., height, width), float32 in [0, 1]
+        """
+        position = np.asarray(position, dtype=np.float64)
+        batch_shape = position.shape[:-1]
+        position = position.reshape(-1, 2)
+        angle = np.zeros(len(position)) if angle is None else np.asarray(angle, dtype=np.float64).reshape(-1)
+        width, height = self.res
+        if out is None:
+            out = np.empty(batch_shape + (height, width), dtype=np.float32)
+        flat = out.reshape(-1, height * width)
+        flat[:] = 0
+
+        center = np.round(position).astype(np.int64)
+        self._stamp(flat, center[:, None, :] + self.circle[None], self.ball_value)
+
+        # orientation line from the center to the edge, Bresenham on all frames at once
+        edge = np.round(position + self.radius * np.stack([np.cos(angle), np.sin(angle)], axis=-1)).astype(np.int64)
+        d = np.abs(edge - center)
+        s = np.where(center < edge, 1, -1)
+        err = np.trunc(np.where(d[:, 0] > d[:, 1], d[:, 0], -d[:, 1]) / 2).astype(np.int64)
+        p = center.copy()
+        points = [edge]
+        for _ in range(d.max(initial=0)):
+            points.append(p.copy())
+            e2 = err.copy()
+            step_x = (e2 > -d[:, 0]) & (p[:, 0] != edge[:, 0])
+            step_y = (e2 < d[:, 1]) & (p[:, 1] != edge[:, 1])
+            err = err - np.where(step_x, d[:, 1], 0) + np.where(step_y, d[:, 0], 0)
+            p[:, 0] += np.where(step_x, s[:, 0], 0)
+            p[:, 1] += np.where(step_y, s[:, 1], 0)
+        self._stamp(flat, np.stack(points, axis=1), self.outline_value)
+
+        np.copyto(out, self.walls_layer, where=self.walls_mask)
+        return out
+
+
+
+def _bb_tree_order(bbs):
+    # order in which chipmunk's bounding box tree (the static index of a pymunk space) visits its leaves, for leaves
+    # (l, b, r, t) inserted in the given order. The solver handles the contacts in this order
+    def area(bb):
+        return (bb[2] - bb[0]) * (bb[3] - bb[1])
+
+    def merge(a, b):
+        return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+    def proximity(a, b):
+        return abs(a[0] + a[2] - b[0] - b[2]) + abs(a[1] + a[3] - b[1] - b[3])
+
+    def insert(node, leaf):
+        # nodes are (bb, index) leaves or [bb, A, B]
+        if node is None:
+            return leaf
+        if len(node) == 2:
+            return [merge(leaf[0], node[0]), leaf, node]
+        cost_a = area(node[2][0]) + area(merge(node[1][0], leaf[0]))
+        cost_b = area(node[1][0]) + area(merge(node[2][0], leaf[0]))
+        if cost_a == cost_b:
+            cost_a, cost_b = proximity(node[1][0], leaf[0]), proximity(node[2][0], leaf[0])
+        if cost_b < cost_a:
+            node[2] = insert(node[2], leaf)
         else:
-            self.screen = pygame.display.set_mode(res, 0, 24)
+            node[1] = insert(node[1], leaf)
+        node[0] = merge(node[0], leaf[0])
+        return node
+
+    def leaves(node):
+        return [node[1]] if len(node) == 2 else leaves(node[1]) + leaves(node[2])
+
+    root = None
+    for i, bb in enumerate(bbs):
+        root = insert(root, (tuple(bb), i))
+    return leaves(root)
+
+
+class BatchPhysics:
+    """
+    vectorized replacement of the pymunk space of BallBox: advances many balls at once, one per sequence, inside the
+    static wall polygon. Each step does what pymunk (chipmunk) does for a single circle against radius 0 segments:
+    move by velocity plus bias velocity, find the contacts with the segments, reflect the velocity with the restitution
+    impulse along the precomputed contact normals and push penetrating balls out with the bias impulse, solved
+    iteratively with impulses warm started from the previous contacts. Trajectories match pymunk up to float rounding
+    and the order the solver visits two simultaneous contacts in (checked by test_batch_physics.py)
+    walls: corner points of the wall polygon (see WALLS)
+    radius: radius of the balls
+    dt: time step
+    the remaining parameters are the pymunk.Space defaults, elasticity 1 and mass 1 as in BallBox
+    """
+    def __init__(self, walls=WALLS[1], radius=3, dt=0.2, iterations=10, collision_slop=0.10000000149011612,
+                 collision_bias=0.0017970074436457143, collision_persistence=3, elasticity=1.0):
+        walls = np.asarray(walls, dtype=np.float64)
+        self.seg_a = walls[:-1]
+        self.seg_delta = walls[1:] - walls[:-1]
+        self.seg_lengthsq = np.sum(self.seg_delta**2, axis=-1)
+        self.solve_order = _bb_tree_order(np.concatenate([np.minimum(walls[:-1], walls[1:]),
+                                                          np.maximum(walls[:-1], walls[1:])], axis=-1))
+        # segment normals, the contact normal of a ball centered exactly on a segment
+        self.seg_normal = np.stack([self.seg_delta[:, 1], -self.seg_delta[:, 0]], axis=-1) / \
+            np.sqrt(self.seg_lengthsq)[:, None]
+        self.radius = radius
+        self.dt = dt
+        self.iterations = iterations
+        self.slop = collision_slop
+        self.bias_coef = 1.0 - collision_bias ** dt
+        self.persistence = collision_persistence
+        self.elasticity = elasticity
+
+    def _contacts(self, position):
+        # contact normals (ball to segment, x and y), penetration depths and contact flags of all balls with all
+        # segments, shape (N, segments), in chipmunk's order of operations
+        px, py = position[:, 0, None], position[:, 1, None]
+        ax, ay = self.seg_a[:, 0], self.seg_a[:, 1]
+        dx, dy = self.seg_delta[:, 0], self.seg_delta[:, 1]
+        t = np.clip((dx * (px - ax) + dy * (py - ay)) / self.seg_lengthsq, 0.0, 1.0)
+        closest_x, closest_y = ax + dx * t, ay + dy * t
+        delta_x, delta_y = closest_x - px, closest_y - py
+        distsq = delta_x * delta_x + delta_y * delta_y
+        touching = distsq < self.radius**2
+        dist = np.sqrt(distsq)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv = 1.0 / dist
+        on_segment = dist == 0
+        nx = np.where(on_segment, self.seg_normal[:, 0], delta_x * inv)
+        ny = np.where(on_segment, self.seg_normal[:, 1], delta_y * inv)
+        depth = (closest_x - (px + nx * self.radius)) * nx + (closest_y - (py + ny * self.radius)) * ny
+        return nx, ny, depth, touching
+
+    def step(self, position, velocity, v_bias, jn_cache, last_contact, it):
+        """
+        one time step of all balls, updates the arrays in place
+        position, velocity, v_bias: (N, 2)
+        jn_cache: (N, segments) normal impulses of the last contact with each segment, warm start of the solver
+        last_contact: (N, segments) step of the last contact with each segment
+        it: index of the step
+        """
+        position += (velocity + v_bias) * self.dt
+        v_bias[:] = 0
+        nx, ny, depth, touching = self._contacts(position)
+        # only the balls touching a wall take part in the solver
+        hit = np.flatnonzero(touching.any(axis=1))
+        if len(hit) == 0:
+            return
+        nx, ny, depth, touching = nx[hit], ny[hit], depth[hit], touching[hit]
+        vx, vy = velocity[hit, 0], velocity[hit, 1]
+        vbx, vby = np.zeros(len(hit)), np.zeros(len(hit))
+
+        bias = -self.bias_coef * np.minimum(0.0, depth + self.slop) / self.dt
+        bounce = -(vx[:, None] * nx + vy[:, None] * ny) * self.elasticity
+        # contacts of the last collision_persistence steps keep their impulse
+        cached = touching & (it - last_contact[hit] <= self.persistence)
+        jn_acc = np.where(cached, jn_cache[hit], 0.0)
+        jb_acc = np.zeros_like(jn_acc)
+
+        touched = touching.any(axis=0)
+        active = [k for k in self.solve_order if touched[k]]
+        for k in active:
+            vx = vx - nx[:, k] * jn_acc[:, k]
+            vy = vy - ny[:, k] * jn_acc[:, k]
+        for _ in range(self.iterations):
+            for k in active:
+                n_x, n_y, on = nx[:, k], ny[:, k], touching[:, k]
+                jb_old = jb_acc[:, k]
+                jb_new = np.where(on, np.maximum(jb_old + bias[:, k] + (vbx * n_x + vby * n_y), 0.0), 0.0)
+                vbx, vby = vbx - n_x * (jb_new - jb_old), vby - n_y * (jb_new - jb_old)
+                jb_acc[:, k] = jb_new
+                jn_old = jn_acc[:, k]
+                jn_new = np.where(on, np.maximum(jn_old - bounce[:, k] + (vx * n_x + vy * n_y), 0.0), 0.0)
+                vx, vy = vx - n_x * (jn_new - jn_old), vy - n_y * (jn_new - jn_old)
+                jn_acc[:, k] = jn_new
+
+        velocity[hit, 0], velocity[hit, 1] = vx, vy
+        v_bias[hit, 0], v_bias[hit, 1] = vbx, vby
+        jn_cache[hit] = np.where(touching, jn_acc, jn_cache[hit])
+        last_contact[hit] = np.where(touching, it, last_contact[hit])
+
+    def simulate(self, position, velocity, iterations, chunk_size=10000):
+        """
+        position, velocity: initial positions and velocities of the balls, shape (N, 2)
+        iterations: number of time steps
+        chunk_size: balls stepped together, bounds the memory of the contact arrays
+        returns positions and velocities, shape (N, iterations + 1, 2), the initial ones first
+        """
+        positions = np.empty((len(position), iterations + 1, 2))
+        velocities = np.empty((len(position), iterations + 1, 2))
+        for start in range(0, len(position), chunk_size):
+            p = np.array(position[start:start + chunk_size], dtype=np.float64)
+            v = np.array(velocity[start:start + chunk_size], dtype=np.float64)
+            positions[start:start + len(p), 0], velocities[start:start + len(p), 0] = p, v
+            v_bias = np.zeros_like(p)
+            jn_cache = np.zeros((len(p), len(self.seg_a)))
+            last_contact = np.full((len(p), len(self.seg_a)), -self.persistence - 1)
+            for i in range(iterations):
+                self.step(p, v, v_bias, jn_cache, last_contact, i)
+                positions[start:start + len(p), i + 1], velocities[start:start + len(p), i + 1] = p, v
+        return positions, velocities
+
+
+class BallBox:
+    def __init__(self, dt=0.2, res=(32, 32), init_pos=(3, 3), init_std=0, wall=None, renderer='pygame',
+                 physics='pymunk'):
+        """
+        renderer: 'pygame' draws every frame with space.debug_draw, 'numpy' simulates with pymunk only and rasterizes
+            the frames of all sequences with FrameRenderer afterwards, without initializing pygame (no SDL display on
+            headless nodes). The frames are the same up to the contact points debug_draw marks while the ball touches a
+            wall
+        physics: 'pymunk' steps one ball after the other in a pymunk space, 'numpy' steps all balls of a run at once
+            with BatchPhysics (needs the numpy renderer)
+        """
+        if renderer not in ['pygame', 'numpy']:
+            raise AssertionError("Invalid renderer, needs to be 'pygame' or 'numpy'")
+        if physics not in ['pymunk', 'numpy']:
+            raise AssertionError("Invalid physics, needs to be 'pymunk' or 'numpy'")
+        if physics == 'numpy' and renderer != 'numpy':
+            raise AssertionError("numpy physics need the numpy renderer")
+        self.renderer = renderer
+        self.physics = physics
+        self.dt = dt
+        self.res = res
         self.gravity = (0.0, 0.0)
         self.initial_position = init_pos
         self.initial_std = init_std
         self.space = pymunk.Space()
         self.space.gravity = self.gravity
-        self.draw_options = pymunk.pygame_util.DrawOptions(self.screen)
-        self.clock = pygame.time.Clock()
         self.wall = wall
         self.static_lines = None
 
         self.dd = 2
+        if renderer == 'numpy':
+            return
+
+        import pygame
+        from pymunk import pygame_util
+        pygame.init()
+        if os.environ.get('SDL_VIDEODRIVER', '') == 'dummy':
+            pygame.display.set_mode(res, 0, 24)
+            self.screen = pygame.Surface(res, pygame.SRCCOLORKEY, 24)
+            pygame.draw.rect(self.screen, (0, 0, 0), (0, 0, res[0], res[1]), 0)
+        else:
+            self.screen = pygame.display.set_mode(res, 0, 24)
+        self.draw_options = pygame_util.DrawOptions(self.screen)
+        self.clock = pygame.time.Clock()
 
     def _clear(self):
-        self.screen.fill(pygame.color.THECOLORS["black"])
+        self.screen.fill((0, 0, 0))
 
     def create_ball(self, radius=3):
         inertia = pymunk.moment_for_circle(1, 0, radius, (0, 0))
@@ -41,9 +363,24 @@ class BallBox:
 
         shape = pymunk.Circle(body, radius, (0, 0))
         shape.elasticity = 1.0
-        shape.color = pygame.color.THECOLORS["white"]
+        shape.color = WHITE
         return shape
 
+    def initial_states(self, sequences, angle_limits=(0, 360), velocity_limits=(10, 25), radius=3):
+        """
+        initial positions and velocities, shape (sequences, 2), drawn from np.random in the order run and fire draw
+        them with the pymunk physics, so both physics start from the same states for the same seed
+        """
+        position = np.empty((sequences, 2))
+        velocity = np.empty((sequences, 2))
+        for s in range(sequences):
+            angle = np.random.uniform(*angle_limits)
+            speed = np.random.uniform(*velocity_limits)
+            velocity[s] = speed * np.cos(angle * np.pi / 180), speed * np.sin(angle * np.pi / 180)
+            position[s] = np.array(self.initial_position) + self.initial_std * np.random.normal(size=(2,))
+        position = np.clip(position, self.dd + radius + 1, self.res[0] - self.dd - radius - 1)
+        return position, velocity
+
     def fire(self, angle=50, velocity=20, radius=3):
         speedX = velocity * np.cos(angle * np.pi / 180)
         speedY = velocity * np.sin(angle * np.pi / 180)
@@ -56,30 +393,43 @@ class BallBox:
 
     def run(self, iterations=20, sequences=500, angle_limits=(0, 360), velocity_limits=(10, 25), radius=3,
             flip_gravity=None, save=None, filepath='../../data/balls.npz', delay=None, shape=1):
-        if save:
+        """
+        save: None, 'png', 'npz' (float32 frames), 'uint8' or 'bits'. The last two write memory mappable .npy files
+            (filepath + '_images.npy' / '_bits.npy' and filepath + '_state.npy'), frame by frame, for PymunkData.
+            'uint8' keeps the frames rounded to 8 bit, 'bits' keeps only the occupied pixels (frame > 0), packed 8 per
+            byte along the width. 'bits' is lossy for these renders, which are not binary: the ball and the walls are 1, the
+            outline and orientation line of the ball 44/255 (outline_color (44, 62, 80)), and with the pygame renderer
+            the anti-aliased contact point marks lie between 57/255 and 249/255, all become 1.
+            Only use it where a binary occupancy image is wanted, it does not give the frames of 'uint8'
+        """
+        if self.renderer == 'numpy' and save == 'png':
+            raise AssertionError("png frames need the pygame renderer")
+        if self.renderer == 'pygame':
+            import pygame
+        if save in ['uint8', 'bits']:
+            if save == 'bits' and self.res[0] % 8 != 0:
+                raise AssertionError("bit packed frames need a width divisible by 8")
+            filepath = os.path.abspath(filepath)
+            # the loader prefers bit packed frames, drop the ones of the other format
+            stale = filepath + ('_images.npy' if save == 'bits' else '_bits.npy')
+            if os.path.exists(stale):
+                os.remove(stale)
+            width = self.res[0] // 8 if save == 'bits' else self.res[0]
+            images = np.lib.format.open_memmap(filepath + ('_bits.npy' if save == 'bits' else '_images.npy'), mode='w+',
+                                               dtype=np.uint8, shape=(sequences, iterations, self.res[1], width))
+            state = np.lib.format.open_memmap(filepath + '_state.npy', mode='w+', dtype=np.float32,
+                                              shape=(sequences, iterations, 4))
+        elif save:
             images = np.empty((sequences, iterations, self.res[0], self.res[1]), dtype=np.float32)
             state = np.empty((sequences, iterations, 4), dtype=np.float32)
 
         dd = self.dd
 
-        if shape==1:
-            points = [(1, 8),
-                      (1, 22),
-                      (8, 30),
-                      (22, 30),
-                      (30, 22),
-                      (30, 8),
-                      (22, 1),
-                      (8, 1),
-                      (1, 8)]
-        elif shape==2:
-            points = [(3, 1),
-                      (1, 15),
-                      (8, 30),
-                      (25, 30),
-                      (30, 8),
-                      (15, 1),
-                      (3, 1)]
+        points = WALLS[shape]
+        if self.renderer == 'numpy' and save:
+            # ball position and angle of every frame, rendered after the simulation
+            position = np.empty((sequences, iterations, 2))
+            ball_angle = np.empty((sequences, iterations))
 
         # points = [[(1, 1), (1,31)],
         #           [(1, 1), (31, 1)],
@@ -98,38 +448,169 @@ class BallBox:
         #                                     (self.res[0]-dd, dd), 0.0)]
         for line in self.static_lines:
             line.elasticity = 1.0
-            line.color = pygame.color.THECOLORS["white"]
+            line.color = WHITE
             self.space.add(line)
 
-        for s in range(sequences):
+        if self.physics == 'numpy':
+            start_position, start_velocity = self.initial_states(sequences, angle_limits, velocity_limits, radius)
+            trajectory, velocity = BatchPhysics(points, radius, self.dt).simulate(start_position, start_velocity,
+                                                                                   iterations)
+            if save:
+                position[:] = trajectory[:, :-1]
+                # without friction the balls never spin
+                ball_angle[:] = 0
+                state[:] = np.concatenate([trajectory[:, 1:], velocity[:, 1:]], axis=-1)
+        else:
+            for s in range(sequences):
 
-            if s % 100 == 0:
-                print(s)
+                if s % 100 == 0:
+                    print(s)
 
-            angle = np.random.uniform(*angle_limits)
-            velocity = np.random.uniform(*velocity_limits)
-            # controls[:, s] = np.array([angle, velocity])
-            ball = self.fire(angle, velocity, radius)
-            for i in range(iterations):
-                self._clear()
-                self.space.debug_draw(self.draw_options)
-                self.space.step(self.dt)
-                pygame.display.flip()
+                angle = np.random.uniform(*angle_limits)
+                velocity = np.random.uniform(*velocity_limits)
+                # controls[:, s] = np.array([angle, velocity])
+                ball = self.fire(angle, velocity, radius)
+                for i in range(iterations):
+                    if self.renderer == 'numpy':
+                        if save:
+                            position[s, i] = ball.body.position
+                            ball_angle[s, i] = ball.body.angle
+                        self.space.step(self.dt)
+                        if save in ['npz', 'uint8', 'bits']:
+                            state[s, i] = list(ball.body.position) + list(ball.body.velocity)
+                        continue
+
+                    self._clear()
+                    self.space.debug_draw(self.draw_options)
+                    self.space.step(self.dt)
+                    pygame.display.flip()
+
+                    if delay:
+                        self.clock.tick(delay)
 
-                if delay:
-                    self.clock.tick(delay)
+                    if save == 'png':
+                        pygame.image.save(self.screen, os.path.join(filepath, "bouncing_balls_%02d_%02d.png" % (s, i)))
+                    elif save == 'npz':
+                        images[s, i] = pygame.surfarray.array2d(self.screen).swapaxes(1, 0).astype(np.float32) / (2**24 - 1)
+                        state[s, i] = list(ball.body.position) + list(ball.body.velocity)
+                    elif save in ['uint8', 'bits']:
+                        frame = pygame.surfarray.array2d(self.screen).swapaxes(1, 0).astype(np.float32) / (2**24 - 1)
+                        images[s, i] = np.packbits(frame > 0, axis=-1) if save == 'bits' else np.round(frame * 255)
+                        state[s, i] = list(ball.body.position) + list(ball.body.velocity)
 
-                if save == 'png':
-                    pygame.image.save(self.screen, os.path.join(filepath, "bouncing_balls_%02d_%02d.png" % (s, i)))
-                elif save == 'npz':
-                    images[s, i] = pygame.surfarray.array2d(self.screen).swapaxes(1, 0).astype(np.float32) / (2**24 - 1)
-                    state[s, i] = list(ball.body.position) + list(ball.body.velocity)
+                # Remove the ball and the wall from the space
+                self.space.remove(ball, ball.body)
 
-            # Remove the ball and the wall from the space
-            self.space.remove(ball, ball.body)
+        if self.renderer == 'numpy' and save:
+            renderer = FrameRenderer(self.res, radius, points)
+            for start in range(0, sequences, 100):
+                frames = renderer.render(position[start:start + 100], ball_angle[start:start + 100])
+                if save == 'npz':
+                    images[start:start + 100] = frames
+                elif save == 'bits':
+                    images[start:start + 100] = np.packbits(frames > 0, axis=-1)
+                else:
+                    images[start:start + 100] = np.round(frames * 255)
 
         if save == 'npz':
             np.savez(os.path.abspath(filepath), images=images, state=state)
+        elif save in ['uint8', 'bits']:
+            images.flush()
+            state.flush()
+
+
+def _shard_files(shard_path, save):
+    if save == 'npz':
+        return [shard_path + '.npz']
+    return [shard_path + ('_bits.npy' if save == 'bits' else '_images.npy'), shard_path + '_state.npy']
+
+
+def _load_shard(shard_path, save):
+    if save == 'npz':
+        npzfile = np.load(shard_path + '.npz')
+        return npzfile['images'], npzfile['state']
+    return [np.load(f, mmap_mode='r') for f in _shard_files(shard_path, save)]
+
+
+def _run_shard(args):
+    shard_path, shard_seed, sequences, iterations, ballbox_params, run_params = args
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    np.random.seed(shard_seed)
+    cannon = BallBox(**ballbox_params)
+    cannon.run(iterations=iterations, sequences=sequences, filepath=shard_path + ('.npz' if run_params['save'] == 'npz' else ''),
+               **run_params)
+    if cannon.renderer == 'pygame':
+        import pygame
+        # SDL keeps SIGTERM from ending the process until pygame quits, the pool terminates its workers with it
+        pygame.quit()
+    # marks the shard as complete for resumed runs
+    open(shard_path + '.done', 'w').close()
+    return shard_path
+
+
+def generate_parallel(filepath, sequences, iterations, seed, ballbox_params, run_params, workers=None, shard_size=100):
+    """
+    BallBox(**ballbox_params).run(iterations, sequences, filepath, **run_params) split into shards of shard_size
+    sequences that are simulated and rendered on a pool of worker processes, then merged into filepath
+    run_params['save'] is 'npz', 'uint8' or 'bits' (see BallBox.run). Shard k is seeded from (seed, k), so the data
+    set only depends on seed and shard_size, not on the number of workers
+    filepath: base path of the data set, '.npz' is appended for save='npz'
+    shards are kept in filepath + '_shards' until the merge, completed shards (and merged data sets) are skipped when
+    an interrupted run is started again
+    workers: number of processes, defaults to the number of cpus
+    """
+    save = run_params['save']
+    if save not in ['npz', 'uint8', 'bits']:
+        raise AssertionError("Invalid save mode, needs to be 'npz', 'uint8' or 'bits'")
+    if os.path.exists(filepath + '.done'):
+        return
+    shard_dir = filepath + '_shards'
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    shards = []
+    for k, start in enumerate(range(0, sequences, shard_size)):
+        shard_seed = np.random.SeedSequence([seed, k]).generate_state(1)[0]
+        shards.append((os.path.join(shard_dir, 'shard_%05d' % k), shard_seed, min(shard_size, sequences - start),
+                       iterations, ballbox_params, run_params))
+    todo = [shard for shard in shards if not os.path.exists(shard[0] + '.done')]
+    print('%d of %d shards left' % (len(todo), len(shards)))
+
+    workers = min(workers or os.cpu_count(), len(todo))
+    if workers > 1:
+        # fresh interpreters, pygame and pymunk state must not be shared with the parent
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            for shard_path in pool.imap_unordered(_run_shard, todo):
+                print('done %s' % shard_path)
+    else:
+        for shard in todo:
+            _run_shard(shard)
+
+    # merge in shard order
+    res = ballbox_params.get('res', (32, 32))
+    if save == 'npz':
+        loaded = [_load_shard(shard[0], save) for shard in shards]
+        np.savez(os.path.abspath(filepath), images=np.concatenate([l[0] for l in loaded]),
+                 state=np.concatenate([l[1] for l in loaded]))
+    else:
+        width = res[0] // 8 if save == 'bits' else res[0]
+        images_file, state_file = _shard_files(filepath, save)
+        stale = filepath + ('_images.npy' if save == 'bits' else '_bits.npy')
+        if os.path.exists(stale):
+            os.remove(stale)
+        images = np.lib.format.open_memmap(images_file, mode='w+', dtype=np.uint8,
+                                           shape=(sequences, iterations, res[1], width))
+        state = np.lib.format.open_memmap(state_file, mode='w+', dtype=np.float32, shape=(sequences, iterations, 4))
+        start = 0
+        for shard in shards:
+            shard_images, shard_state = _load_shard(shard[0], save)
+            images[start:start + len(shard_images)] = shard_images
+            state[start:start + len(shard_state)] = shard_state
+            start += len(shard_images)
+        images.flush()
+        state.flush()
+    open(filepath + '.done', 'w').close()
+    shutil.rmtree(shard_dir)
 
 
 if __name__ == '__main__':
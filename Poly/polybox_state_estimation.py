@@ -10,8 +10,9 @@ import tensorflow as tf
 from tensorflow import keras as k
 from PiSSM import PiSSM
 from LayerNormalizer import LayerNormalizer
-from PolyboxData import BallBox
+from PolyboxData import BallBox, generate_parallel, DATA_VERSION
 from PymunkData import PymunkData
+from DatasetCache import cached_dir
 
 
 
@@ -28,31 +29,53 @@ def parse_args():
         
 
 def generate_poly_filter_dataset( num_seqs_train, num_seqs_test, num_seqs_valid,
-                                  seq_length_train, seq_length_test, seq_length_valid):
+                                  seq_length_train, seq_length_test, seq_length_valid, storage="npz",
+                                  cache_dir="./data/cache", workers=0, shard_size=100, renderer="pygame",
+                                  physics="pymunk"):
+    """
+    storage: "npz" for float32 frames held in RAM, "uint8" or "bits" for memory mapped 8 bit or bit packed frames
+        that are decoded per batch (see BallBox.run and PymunkData). "bits" binarizes the frames, it is not the same
+        data set as "npz" or "uint8"
+    cache_dir: the rendered sequences are cached there, keyed by all generator parameters and seeds (see DatasetCache),
+        so runs and configs with the same parameters render them only once
+    workers: 0 renders every split serially in this process, otherwise the splits are rendered in shards of shard_size
+        sequences on that many processes (see PolyboxData.generate_parallel). Sharded data sets do not depend on the
+        number of workers and resume from the completed shards after an interruption
+    renderer: "pygame" or "numpy", how BallBox draws the frames (see BallBox)
+    physics: "pymunk" or "numpy", how BallBox moves the balls (see BallBox, "numpy" needs the numpy renderer)
+    """
     os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    ext = ".npz" if storage == "npz" else ""
 
     scale = 1
+    ballbox_params = dict(dt=0.2, res=(32*scale, 32*scale), init_pos=(16*scale, 16*scale), init_std=2.5, wall=None)
+    if renderer != "pygame":
+        # the default stays out of the parameters, data sets cached before keep their key
+        ballbox_params["renderer"] = renderer
+    if physics != "pymunk":
+        ballbox_params["physics"] = physics
+    run_params = dict(delay=None, radius=3*scale, angle_limits=(0, 360), shape=2,
+                      velocity_limits=(10.0*scale, 15.0*scale), save=storage)
+    # (file name, seed, sequences, iterations)
+    splits = [("polygon", 1234, num_seqs_train, seq_length_train),
+              ("polygon_test", 5678, num_seqs_test, seq_length_test),
+              ("polygon_valid", 7788, num_seqs_valid, seq_length_valid)]
+
+    def generate(path):
+        for name, seed, sequences, iterations in splits:
+            if workers:
+                generate_parallel(os.path.join(path, name), sequences, iterations, seed, ballbox_params, run_params,
+                                  workers=workers, shard_size=shard_size)
+                continue
+            np.random.seed(seed)
+            cannon = BallBox(**ballbox_params)
+            cannon.run(iterations=iterations, sequences=sequences, filepath=os.path.join(path, name) + ext, **run_params)
+
+    params = dict(generator="polybox", version=DATA_VERSION, ballbox=ballbox_params, run=run_params, splits=splits)
+    if workers:
+        params["shard_size"] = shard_size
+    data_dir = cached_dir(cache_dir, params, generate)
 
-    np.random.seed(1234)
-
-    # Create data dir
-    if not os.path.exists('./data'):
-        os.makedirs('./data')
-
-    cannon = BallBox(dt=0.2, res=(32*scale, 32*scale), init_pos=(16*scale, 16*scale), init_std=2.5, wall=None)
-    cannon.run(delay=None, iterations=seq_length_train, sequences=num_seqs_train, radius=3*scale, angle_limits=(0, 360), shape=2,
-               velocity_limits=(10.0*scale, 15.0*scale), filepath='./data/polygon.npz', save='npz')
-
-    np.random.seed(5678)
-    cannon = BallBox(dt=0.2, res=(32*scale, 32*scale), init_pos=(16*scale, 16*scale), init_std=2.5, wall=None)
-    cannon.run(delay=None, iterations=seq_length_test, sequences=num_seqs_test, radius=3*scale, angle_limits=(0, 360), shape=2,
-               velocity_limits=(10.0*scale, 15.0*scale), filepath='./data/polygon_test.npz', save='npz')
-    
-    np.random.seed(7788)
-    cannon = BallBox(dt=0.2, res=(32*scale, 32*scale), init_pos=(16*scale, 16*scale), init_std=2.5, wall=None)
-    cannon.run(delay=None, iterations=seq_length_valid, sequences=num_seqs_valid, radius=3*scale, angle_limits=(0, 360), shape=2,
-               velocity_limits=(10.0*scale, 15.0*scale), filepath='./data/polygon_valid.npz', save='npz')
-    
     rs = np.random.RandomState(seed=1515)
     train_valid = rs.rand(num_seqs_train, seq_length_train, 1) < 0.5
     train_valid[:, :20] = True
@@ -65,9 +88,9 @@ def generate_poly_filter_dataset( num_seqs_train, num_seqs_test, num_seqs_valid,
     valid_valid = rs.rand(num_seqs_valid, seq_length_valid, 1) < 0.5
     valid_valid[:, :20] = True
     
-    train_data = PymunkData("./data/{}.npz".format("polygon"))
-    test_data = PymunkData("./data/{}_test.npz".format("polygon"))
-    valid_data = PymunkData("./data/{}_valid.npz".format("polygon"))
+    train_data = PymunkData(os.path.join(data_dir, "polygon") + ext)
+    test_data = PymunkData(os.path.join(data_dir, "polygon_test") + ext)
+    valid_data = PymunkData(os.path.join(data_dir, "polygon_valid") + ext)
     # train_data = PymunkData("./data/{}.npz".format("polygon"))
     # test_data = PymunkData("./data/{}_test.npz".format("polygon"))
     # valid_data = PymunkData("./data/{}_valid.npz".format("polygon"))
@@ -128,7 +151,11 @@ def main():
 
         print("running config: {}".format(config_name))
 
-        train_data, test_data, valid_data, train_valid, test_valid, valid_valid = generate_poly_filter_dataset(1000, 100, 100, 70, 70, 70)
+        train_data, test_data, valid_data, train_valid, test_valid, valid_valid = generate_poly_filter_dataset(1000, 100, 100, 70, 70, 70,
+                                                                                              storage = configs[key].get("Storage", "npz"),
+                                                                                              workers = configs[key].get("Data_Workers", 0),
+                                                                                              renderer = configs[key].get("Renderer", "pygame"),
+                                                                                              physics = configs[key].get("Physics", "pymunk"))
 
         #Build Model
         gin = PolyStateEstemPiSSM(observation_shape=train_data.images.shape[-3:],
@@ -148,6 +175,11 @@ def main():
                                 KG_InputSize = configs[key]["KG_InputSize"],
                                 Xgru_InputSize = configs[key]["Xgru_InputSize"],
                                 Fgru_InputSize = configs[key]["Fgru_InputSize"],
+                                packed_covar = bool(configs[key].get("Packed_Covar", 0)),
+                                covar_rank = configs[key].get("Covar_Rank", 0),
+                                sqrt_covar = bool(configs[key].get("Sqrt_Covar", 0)),
+                                parallel_smoothing = bool(configs[key].get("Parallel_Smoothing", 0)),
+                                inference_basis = configs[key].get("Inference_Basis", "argmax"),
                                 lr = configs[key]["lr"],
                                 lr_decay = configs[key]["lr_decay"],
                                 lr_decay_it = configs[key]["lr_decay_iteration"],
@@ -165,7 +197,13 @@ def main():
 
         Training_Loss = gin.training( gin, train_data.images, train_data.state, valid_data.images, valid_data.state,
                                     test_data.images, test_data.state, epochs, batch_size,
-                                    x_epoch, record, fig, ax0, draw_fig= bool(configs[key]["draw_fig"]))
+                                    x_epoch, record, fig, ax0, draw_fig= bool(configs[key]["draw_fig"]),
+                                    compiled = bool(configs[key].get("Compiled", 0)),
+                                    jit_compile = bool(configs[key].get("Jit_Compile", 0)),
+                                    checkpoint_dir = configs[key].get("Checkpoint_Dir", None),
+                                    checkpoint_every = configs[key].get("Checkpoint_Every", 1),
+                                    resume = bool(configs[key].get("Resume", 0)),
+                                    shuffle = bool(configs[key].get("Shuffle", 0)))
         Test_Loss = gin.testing( gin, test_data.images, test_data.state, batch_size)
 
 if __name__ == '__main__':
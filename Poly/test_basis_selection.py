@@ -0,0 +1,69 @@
+"""
+checks of the basis selection modes of PiSSMTransitionCell: "argmax" and "expected" are deterministic and return no
+log-probs, "argmax" takes the most likely basis and "expected" the softmax weighted mixture of the bases
+run from this directory: python -m pytest test_basis_selection.py
+"""
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras as k
+
+from PiSSMTransitionCell import PiSSMTransitionCell, pack_input
+
+lsd, lod, batch, T, num_basis = 4, 2, 6, 5, 3
+
+
+def make_cell():
+    cell = PiSSMTransitionCell(lsd, lod, number_of_basis=num_basis, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                               init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=False, never_invalid=True)
+    cell.build([None, 2 * lod + 1])
+    # distinct bases, so the selected one can be told apart
+    cell.Fmatrix.assign(np.random.RandomState(0).randn(*cell.Fmatrix.shape))
+    return cell
+
+
+def filter_inputs():
+    random = np.random.RandomState(1)
+    return pack_input(tf.constant(random.randn(batch, T, lod), tf.float32),
+                      tf.constant(random.uniform(0.5, 1.5, (batch, T, lod)), tf.float32), tf.ones([batch, T, 1]))
+
+
+@pytest.mark.parametrize("basis_selection", ["argmax", "expected"])
+def test_deterministic_modes_repeat_and_return_no_logp(basis_selection):
+    cell = make_cell()
+    cell.basis_selection = basis_selection
+    rnn = k.layers.RNN(cell, return_sequences=True)
+    first, second = rnn(filter_inputs()), rnn(filter_inputs())
+    assert len(first) == 5
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a.numpy(), b.numpy())
+
+
+def test_sample_mode_returns_logp():
+    cell = make_cell()
+    outputs = k.layers.RNN(cell, return_sequences=True)(filter_inputs())
+    # the list of per step log-probs comes out of the RNN layer as a list of one [batch, T, 1] sequence
+    (logp,) = outputs[5]
+    assert len(outputs) == 6 and logp.shape == (batch, T, 1)
+    assert np.all(logp.numpy() <= 0)
+
+
+@pytest.mark.parametrize("basis_selection", ["argmax", "expected"])
+def test_transition_matrix_of_the_mode(basis_selection):
+    cell = make_cell()
+    cell.basis_selection = basis_selection
+    post_mean = tf.constant(np.random.RandomState(2).randn(batch, lsd), tf.float32)
+    post_covar = tf.reshape(tf.eye(lsd, batch_shape=[batch]), [batch, -1])
+    gru_q_state = tf.zeros([batch, cell.GRUQunit])
+    _, _, logp_list, _ = cell._predict(post_mean, post_covar, [], gru_q_state)
+    assert logp_list == []
+
+    logits = cell._coefficient_net(post_mean).numpy()
+    bases = cell.Fmatrix.numpy()[0]
+    if basis_selection == "argmax":
+        expected = bases[np.argmax(logits, -1)]
+    else:
+        weights = np.exp(logits - logits.max(-1, keepdims=True))
+        weights /= weights.sum(-1, keepdims=True)
+        expected = np.einsum("bk,kij->bij", weights, bases)
+    np.testing.assert_allclose(cell.transition_matrix.numpy(), expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,34 @@
+"""
+checks of the numpy physics of BallBox (BatchPhysics) against the pymunk space it replaces: the same seed gives the
+same states and, rendered with the numpy renderer, the same frames
+run from this directory: python -m pytest test_batch_physics.py
+"""
+import numpy as np
+import pytest
+
+from PolyboxData import BallBox, BatchPhysics, WALLS
+
+
+def run_ballbox(physics, shape, filepath):
+    np.random.seed(3)
+    BallBox(res=(32, 32), init_pos=(16, 16), init_std=2.5, renderer='numpy', physics=physics).run(
+        iterations=20, sequences=200, velocity_limits=(10, 15), save='uint8', filepath=filepath, shape=shape)
+    return np.load(filepath + '_state.npy'), np.load(filepath + '_images.npy')
+
+
+@pytest.mark.parametrize("shape", sorted(WALLS))
+def test_batch_physics_matches_pymunk(shape, tmp_path):
+    pymunk_state, pymunk_images = run_ballbox('pymunk', shape, str(tmp_path / 'pymunk'))
+    numpy_state, numpy_images = run_ballbox('numpy', shape, str(tmp_path / 'numpy'))
+    # the balls have to hit the walls for the comparison to cover the contact solver
+    assert np.mean(np.any(np.abs(np.diff(pymunk_state[..., 2:], axis=1)) > 1e-3, axis=(1, 2))) > 0.5
+    np.testing.assert_allclose(numpy_state, pymunk_state, rtol=0, atol=1e-4)
+    np.testing.assert_array_equal(numpy_images, pymunk_images)
+
+
+def test_batch_physics_stays_inside_the_walls():
+    np.random.seed(4)
+    box = BallBox(res=(32, 32), init_pos=(16, 16), init_std=2.5, renderer='numpy', physics='numpy')
+    position, velocity = box.initial_states(500, velocity_limits=(10, 15))
+    trajectory, _ = BatchPhysics(WALLS[2], radius=3, dt=0.2).simulate(position, velocity, 50)
+    assert trajectory.min() > 1 and trajectory.max() < 31
@@ -0,0 +1,60 @@
+"""
+checks of the USE_CONV covariance encoder of the transition and smoothing cells: it is built once with the cell, its
+weights are tracked and trained, and every step reuses it
+run from this directory: python -m pytest test_conv_covariance_encoder.py
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras as k
+
+from GINSmoothCell import PiSSMSmoothingCell
+from PiSSMTransitionCell import PiSSMTransitionCell, pack_input
+
+lsd, lod, batch, T = 4, 2, 3, 5
+
+
+def conv_weights(cell):
+    return [w for layer in cell._conv_covar_layers for w in layer.trainable_weights]
+
+
+def filter_inputs(seed):
+    random = np.random.RandomState(seed)
+    obs_valid = np.ones((batch, T, 1), dtype=np.float32)
+    return pack_input(tf.constant(random.randn(batch, T, lod), tf.float32),
+                      tf.constant(random.uniform(0.5, 1.5, (batch, T, lod)), tf.float32), tf.constant(obs_valid))
+
+
+def test_transition_cell_builds_the_encoder_once():
+    cell = PiSSMTransitionCell(lsd, lod, number_of_basis=2, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                               init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=True, never_invalid=True)
+    rnn = k.layers.RNN(cell, return_sequences=True)
+    with tf.GradientTape() as tape:
+        first = rnn(filter_inputs(0))
+        loss = tf.reduce_sum(first[0])
+    weights = conv_weights(cell)
+    assert weights and all(any(w is v for v in cell.trainable_weights) for w in weights)
+    layers = list(cell._conv_covar_layers)
+    # the gradient reaches the encoder through the gain at every step
+    assert all(g is not None for g in tape.gradient(loss, weights))
+
+    second = rnn(filter_inputs(0))
+    assert cell._conv_covar_layers == layers and len(conv_weights(cell)) == len(weights)
+    np.testing.assert_array_equal(first[0].numpy(), second[0].numpy())
+
+
+def test_smoothing_cell_builds_the_encoder_once():
+    cell = PiSSMSmoothingCell(lsd, lod, init_kf_matrices=0.05, init_KF_matrices=0.05, USE_CONV=True)
+    cell.build([[None, lsd]])
+    layers = list(cell._conv_covar_layers)
+    weights = conv_weights(cell)
+    assert weights and all(any(w is v for v in cell.trainable_weights) for w in weights)
+
+    random = np.random.RandomState(1)
+    factors = random.randn(batch, lsd, lsd)
+    prior_covar = tf.constant((factors @ factors.transpose(0, 2, 1)).reshape(batch, -1), tf.float32)
+    gru_j_state = tf.zeros([batch, cell.GRUJunit])
+    first, _ = cell._predict_J_gru(prior_covar, gru_j_state)
+    second, _ = cell._predict_J_gru(prior_covar, gru_j_state)
+    assert first.shape == (batch, lsd, lsd)
+    assert cell._conv_covar_layers == layers and len(conv_weights(cell)) == len(weights)
+    np.testing.assert_array_equal(first.numpy(), second.numpy())
@@ -0,0 +1,177 @@
+"""
+checks of the low rank and square root covariance modes of PiSSMTransitionCell against the dense update
+sigma_t|t = sigma_t|t-1 - KG S KG^T. The modes use the Joseph form of the gain, which is the dense update only for
+the optimal gain KG = -sigma H^T S^-1 (the mean update is mu - KG (y - H mu)), so that is the gain compared here
+run from this directory: python -m pytest test_covariance_modes.py
+"""
+import numpy as np
+import tensorflow as tf
+
+from GINSmoothCell import PiSSMSmoothingCell
+from PiSSMTransitionCell import PiSSMTransitionCell, pack_low_rank_covar, unpack_low_rank_covar
+
+lsd, lod, batch = 4, 2, 3
+
+
+def make_cell(correction_bias=0., **kwargs):
+    cell = PiSSMTransitionCell(lsd, lod, number_of_basis=2, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                               init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=False, never_invalid=True, **kwargs)
+    cell.build([None, 2 * lod + 1])
+    # identity weights, the elu+1 correction then adds 2 + correction_bias to every diagonal entry above
+    # -correction_bias, correction_bias=-2 leaves diagonals above 2 unchanged
+    cell._layer_covar_gru.build([None, lsd])
+    cell._layer_covar_gru.set_weights([np.eye(lsd, dtype=np.float32), np.full(lsd, correction_bias, dtype=np.float32)])
+    return cell
+
+
+def random_problem(seed):
+    random = np.random.RandomState(seed)
+    factors = random.randn(batch, lsd, lsd)
+    H = random.randn(batch, lod, lsd)
+    obs_covar = random.uniform(0.5, 1.5, size=(batch, lod))
+    return factors, H, obs_covar
+
+
+def dense_posterior(cell, prior_covar, H, obs_covar, KG):
+    cell.H_matrix = tf.constant(H, tf.float32)
+    _, covar = cell._update(tf.zeros([batch, lsd]), tf.constant(prior_covar.reshape(batch, -1), tf.float32),
+                            tf.zeros([batch, lod]), tf.constant(obs_covar, tf.float32), tf.constant(KG, tf.float32))
+    return covar.numpy().reshape(batch, lsd, lsd)
+
+
+def optimal_gain(prior_covar, H, obs_covar):
+    S = H @ prior_covar @ H.transpose(0, 2, 1) + obs_covar[:, None] * np.eye(lod)
+    return -prior_covar @ H.transpose(0, 2, 1) @ np.linalg.inv(S)
+
+
+def low_rank_posterior(cell, factors, H, obs_covar, KG):
+    cell.H_matrix = tf.constant(H, tf.float32)
+    prior_covar = pack_low_rank_covar(tf.zeros([batch, lsd]), tf.constant(factors, tf.float32))
+    covar = cell._update_low_rank_covar(prior_covar, tf.constant(obs_covar, tf.float32), tf.constant(KG, tf.float32))
+    diag, new_factors = unpack_low_rank_covar(covar, lsd, cell.covar_rank)
+    return diag.numpy(), new_factors.numpy()
+
+
+def test_low_rank_matches_dense_at_full_rank():
+    # full rank factors and no diagonal part, the optimal gain and no observation noise: nothing is projected
+    factors, H, _ = random_problem(0)
+    obs_covar = np.zeros([batch, lod])
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    KG = optimal_gain(prior_covar, H, obs_covar)
+
+    dense = dense_posterior(make_cell(), prior_covar, H, obs_covar, KG)
+    diag, new_factors = low_rank_posterior(make_cell(covar_rank=lsd), factors, H, obs_covar, KG)
+    low_rank = new_factors @ new_factors.transpose(0, 2, 1) + diag[:, :, None] * np.eye(lsd)
+    np.testing.assert_allclose(low_rank, dense, rtol=1e-3, atol=1e-3)
+
+
+def test_low_rank_diagonal_matches_dense_for_optimal_gain():
+    # with observation noise the off-diagonal part of KG R KG^T is projected away, the diagonal is kept
+    factors, H, obs_covar = random_problem(1)
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    KG = optimal_gain(prior_covar, H, obs_covar)
+
+    dense = dense_posterior(make_cell(), prior_covar, H, obs_covar, KG)
+    diag, new_factors = low_rank_posterior(make_cell(covar_rank=lsd), factors, H, obs_covar, KG)
+    low_rank_diag = np.sum(new_factors**2, -1) + diag
+    np.testing.assert_allclose(low_rank_diag, np.diagonal(dense, axis1=1, axis2=2), rtol=1e-3, atol=1e-3)
+
+
+def test_low_rank_differs_from_dense_for_learned_gain():
+    # for any other gain the Joseph form is a different covariance than sigma - KG S KG^T
+    factors, H, obs_covar = random_problem(2)
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    KG = 0.3 * np.random.RandomState(3).randn(batch, lsd, lod)
+
+    dense = dense_posterior(make_cell(), prior_covar, H, obs_covar, KG)
+    diag, new_factors = low_rank_posterior(make_cell(covar_rank=lsd), factors, H, obs_covar, KG)
+    low_rank_diag = np.sum(new_factors**2, -1) + diag
+    assert not np.allclose(low_rank_diag, np.diagonal(dense, axis1=1, axis2=2), rtol=1e-2, atol=1e-2)
+
+
+def sqrt_posterior(cell, factors, H, obs_covar, KG):
+    cell.H_matrix = tf.constant(H, tf.float32)
+    prior_L = np.linalg.cholesky(factors @ factors.transpose(0, 2, 1))
+    covar = cell._update_sqrt_covar(tf.constant(prior_L.reshape(batch, -1), tf.float32),
+                                    tf.constant(obs_covar, tf.float32), tf.constant(KG, tf.float32))
+    return covar.numpy().reshape(batch, lsd, lsd)
+
+
+def test_sqrt_matches_dense_for_optimal_gain():
+    # covariances large enough that every diagonal of sigma and of L is above 2, so the correction is the identity
+    factors, H, obs_covar = random_problem(4)
+    factors, obs_covar = 20 * factors, 400 * obs_covar
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    KG = optimal_gain(prior_covar, H, obs_covar)
+
+    dense = dense_posterior(make_cell(correction_bias=-2.), prior_covar, H, obs_covar, KG)
+    posterior_L = sqrt_posterior(make_cell(correction_bias=-2., sqrt_covar=True), factors, H, obs_covar, KG)
+    assert np.all(np.diagonal(posterior_L, axis1=1, axis2=2) > 2) and np.all(np.diagonal(dense, axis1=1, axis2=2) > 2)
+    np.testing.assert_allclose(posterior_L @ posterior_L.transpose(0, 2, 1), dense, rtol=1e-3, atol=1e-2)
+
+
+def test_sqrt_differs_from_dense_for_learned_gain():
+    factors, H, obs_covar = random_problem(5)
+    factors, obs_covar = 20 * factors, 400 * obs_covar
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    KG = 0.3 * np.random.RandomState(6).randn(batch, lsd, lod)
+
+    dense = dense_posterior(make_cell(correction_bias=-2.), prior_covar, H, obs_covar, KG)
+    posterior_L = sqrt_posterior(make_cell(correction_bias=-2., sqrt_covar=True), factors, H, obs_covar, KG)
+    assert not np.allclose(posterior_L @ posterior_L.transpose(0, 2, 1), dense, rtol=1e-2, atol=1e-1)
+
+
+def test_low_rank_update_forms_no_lsd_by_lsd_matrix():
+    # large latent state: apart from the weights (the lsd x lsd kernel of the elu+1 correction), the traced update
+    # must only hold [batch, lsd, lod] and [batch, lsd, rank] sized tensors
+    large_lsd, rank = 2048, 3
+    cell = PiSSMTransitionCell(large_lsd, lod, number_of_basis=2, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                               init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=False, never_invalid=True, covar_rank=rank)
+    cell.build([None, 2 * lod + 1])
+    random = np.random.RandomState(7)
+    cell.H_matrix = tf.constant(random.randn(batch, lod, large_lsd), tf.float32)
+    prior_covar = pack_low_rank_covar(tf.constant(random.uniform(size=(batch, large_lsd)), tf.float32),
+                                      tf.constant(random.randn(batch, large_lsd, rank), tf.float32))
+    obs_covar = tf.constant(random.uniform(0.5, 1.5, size=(batch, lod)), tf.float32)
+    KG = tf.constant(0.01 * random.randn(batch, large_lsd, lod), tf.float32)
+
+    graph = tf.function(cell._update_low_rank_covar).get_concrete_function(prior_covar, obs_covar, KG).graph
+    shapes = [output.shape for op in graph.get_operations() if op.type != "ReadVariableOp" for output in op.outputs
+              if output.shape.rank is not None]
+    assert not any(list(shape).count(large_lsd) > 1 for shape in shapes)
+    assert max(shape.num_elements() or 0 for shape in shapes) <= batch * large_lsd * (rank + 1)
+
+    covar = cell._update_low_rank_covar(prior_covar, obs_covar, KG)
+    assert covar.shape == (batch, large_lsd * (rank + 1))
+
+
+def test_sqrt_gain_networks_get_the_covariance():
+    # with the same weights, the KG gru of the sqrt mode on L gives the gain of the dense mode on sigma = L L^T,
+    # and so does the J gru of the smoother
+    factors, _, obs_covar = random_problem(7)
+    prior_covar = factors @ factors.transpose(0, 2, 1)
+    prior_L = np.linalg.cholesky(prior_covar)
+    dense, sqrt = make_cell(), make_cell(sqrt_covar=True)
+    gru_kg_state = tf.zeros([batch, dense.GRUKGunit])
+    obs_covar = tf.constant(obs_covar, tf.float32)
+    dense_KG, _ = dense._predict_kg_gru(tf.constant(prior_covar.reshape(batch, -1), tf.float32), obs_covar, gru_kg_state)
+    # the KG gru is built on its first call
+    sqrt._predict_kg_gru(tf.constant(prior_L.reshape(batch, -1), tf.float32), obs_covar, gru_kg_state)
+    sqrt.set_weights(dense.get_weights())
+    sqrt_KG, _ = sqrt._predict_kg_gru(tf.constant(prior_L.reshape(batch, -1), tf.float32), obs_covar, gru_kg_state)
+    np.testing.assert_allclose(sqrt_KG.numpy(), dense_KG.numpy(), rtol=1e-4, atol=1e-5)
+
+    dense_smoother = PiSSMSmoothingCell(lsd, lod, init_kf_matrices=0.05, init_KF_matrices=0.05, USE_CONV=False)
+    sqrt_smoother = PiSSMSmoothingCell(lsd, lod, init_kf_matrices=0.05, init_KF_matrices=0.05, USE_CONV=False,
+                                       sqrt_covar=True)
+    dense_smoother.build([[None, lsd]])
+    sqrt_smoother.build([[None, lsd]])
+    sqrt_smoother.PrevWeightKG.assign(dense_smoother.PrevWeightKG)
+    np.testing.assert_allclose(sqrt_smoother._J_gru_input(tf.constant(prior_L.reshape(batch, -1), tf.float32)).numpy(),
+                               dense_smoother._J_gru_input(tf.constant(prior_covar.reshape(batch, -1), tf.float32)).numpy(),
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_sqrt_initial_factor_is_identity():
+    (_, initial_L, _, _), = make_cell(sqrt_covar=True).get_initial_state(None, batch, tf.float32)
+    np.testing.assert_array_equal(initial_L.numpy().reshape(batch, lsd, lsd), np.eye(lsd)[None].repeat(batch, 0))
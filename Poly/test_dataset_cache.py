@@ -0,0 +1,161 @@
+"""
+checks of the DatasetCache entries and locks, of PolyboxData.generate_parallel: the data set does not depend on
+the number of workers and an interrupted run resumes from its completed shards, and of the cached Polybox data sets
+of polybox_state_estimation, which are rendered once per parameter set
+run from this directory: python -m pytest test_dataset_cache.py
+"""
+import os
+import socket
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import DatasetCache
+import PolyboxData
+from DatasetCache import cache_key, cached_arrays, cached_dir
+from PolyboxData import BallBox
+
+
+def arrays_generator(calls):
+    def generate():
+        calls.append(1)
+        return np.arange(6).reshape(2, 3), np.ones(4, dtype=np.float32)
+    return generate
+
+
+def test_cached_arrays_generates_once(tmp_path):
+    calls = []
+    params = dict(generator="test", version=1, n=3)
+    first = cached_arrays(str(tmp_path), params, arrays_generator(calls))
+    second = cached_arrays(str(tmp_path), params, arrays_generator(calls))
+    assert len(calls) == 1
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+    assert os.path.exists(os.path.join(str(tmp_path), cache_key(params), "params.json"))
+
+
+def test_version_and_parameters_change_the_key():
+    params = dict(generator="test", version=1, n=3)
+    assert cache_key(params) == cache_key(dict(params))
+    assert cache_key(params) != cache_key(dict(params, version=2))
+    assert cache_key(params) != cache_key(dict(params, n=4))
+
+
+def test_interrupted_generate_leaves_no_entry(tmp_path):
+    params = dict(generator="test", version=1)
+
+    def interrupted(path):
+        open(os.path.join(path, "half"), "w").close()
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cached_dir(str(tmp_path), params, interrupted)
+    path = os.path.join(str(tmp_path), cache_key(params))
+    assert not os.path.exists(path) and not os.path.exists(path + ".partial.lock")
+    # the next run continues in the partial directory
+    seen = []
+    cached_dir(str(tmp_path), params, lambda partial: seen.extend(os.listdir(partial)))
+    assert seen == ["half"] and os.path.exists(path)
+
+
+def test_lock_of_an_exited_run_is_taken_over(tmp_path):
+    params = dict(generator="test", version=1)
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    lock_path = os.path.join(str(tmp_path), cache_key(params)) + ".partial.lock"
+    with open(lock_path, "w") as f:
+        f.write("%d %s" % (exited.pid, socket.gethostname()))
+    calls = []
+    cached_arrays(str(tmp_path), params, arrays_generator(calls))
+    assert calls == [1] and not os.path.exists(lock_path)
+
+
+def test_lock_of_a_running_run_times_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(DatasetCache, "LOCK_POLL", 0.01)
+    params = dict(generator="test", version=1)
+    lock_path = os.path.join(str(tmp_path), cache_key(params)) + ".partial.lock"
+    with open(lock_path, "w") as f:
+        f.write("%d %s" % (os.getpid(), socket.gethostname()))
+    with pytest.raises(AssertionError):
+        cached_dir(str(tmp_path), params, lambda path: None, lock_timeout=0.1)
+    assert os.path.exists(lock_path)
+
+
+ballbox_params = dict(dt=0.2, res=(32, 32), init_pos=(16, 16), init_std=2.5, wall=None, renderer="numpy")
+run_params = dict(delay=None, radius=3, angle_limits=(0, 360), shape=2, velocity_limits=(10.0, 15.0), save="uint8")
+
+
+def generate(filepath, workers):
+    PolyboxData.generate_parallel(filepath, sequences=25, iterations=6, seed=3, ballbox_params=ballbox_params,
+                                  run_params=run_params, workers=workers, shard_size=10)
+    return np.load(filepath + "_images.npy"), np.load(filepath + "_state.npy")
+
+
+def test_generate_parallel_does_not_depend_on_workers(tmp_path):
+    serial = generate(str(tmp_path / "serial"), workers=1)
+    parallel = generate(str(tmp_path / "parallel"), workers=2)
+    assert serial[0].shape == (25, 6, 32, 32)
+    for a, b in zip(serial, parallel):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_generate_parallel_resumes_from_completed_shards(tmp_path, monkeypatch):
+    reference = generate(str(tmp_path / "reference"), workers=1)
+
+    run_shard = PolyboxData._run_shard
+    runs = []
+
+    def killed_after_first_shard(args):
+        if runs:
+            raise KeyboardInterrupt
+        runs.append(args[0])
+        return run_shard(args)
+
+    monkeypatch.setattr(PolyboxData, "_run_shard", killed_after_first_shard)
+    with pytest.raises(KeyboardInterrupt):
+        generate(str(tmp_path / "resumed"), workers=1)
+
+    resumed_runs = []
+
+    def recorded(args):
+        resumed_runs.append(args[0])
+        return run_shard(args)
+
+    monkeypatch.setattr(PolyboxData, "_run_shard", recorded)
+    resumed = generate(str(tmp_path / "resumed"), workers=1)
+    assert len(resumed_runs) == 2 and runs[0] not in resumed_runs
+    for a, b in zip(reference, resumed):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_polybox_filter_dataset_is_rendered_once(tmp_path, monkeypatch):
+    # the experiment script plots its results
+    pytest.importorskip("matplotlib")
+    import polybox_state_estimation
+
+    renders = []
+    run = BallBox.run
+
+    def counted_run(self, *args, **kwargs):
+        renders.append(kwargs["filepath"])
+        return run(self, *args, **kwargs)
+
+    monkeypatch.setattr(BallBox, "run", counted_run)
+
+    def load(num_seqs_test):
+        data = polybox_state_estimation.generate_poly_filter_dataset(
+            4, num_seqs_test, 2, 21, 21, 21, storage="uint8", cache_dir=str(tmp_path), renderer="numpy",
+            physics="numpy")
+        return [np.asarray(split.images[:]) for split in data[:3]]
+
+    first = load(3)
+    assert len(renders) == 3
+    second = load(3)
+    assert len(renders) == 3 and len(os.listdir(str(tmp_path))) == 1
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+    # any other parameter is another entry
+    load(2)
+    assert len(renders) == 6 and len(os.listdir(str(tmp_path))) == 2
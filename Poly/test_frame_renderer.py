@@ -0,0 +1,35 @@
+"""
+checks of the numpy renderer of BallBox (FrameRenderer) against the pygame frames of space.debug_draw, which it
+matches pixel for pixel except for the contact point marks of debug_draw. Skipped without pygame
+run from this directory: python -m pytest test_frame_renderer.py
+"""
+import numpy as np
+import pytest
+
+from PolyboxData import BallBox, WALLS
+
+pygame = pytest.importorskip("pygame")
+
+
+def run_ballbox(renderer, shape, filepath):
+    np.random.seed(0)
+    BallBox(res=(32, 32), init_pos=(16, 16), init_std=2.5, renderer=renderer).run(
+        iterations=15, sequences=6, velocity_limits=(10, 15), save='uint8', filepath=filepath, shape=shape)
+    return np.load(filepath + '_state.npy'), np.load(filepath + '_images.npy')
+
+
+@pytest.mark.parametrize("shape", sorted(WALLS))
+def test_numpy_renderer_matches_pygame(shape, tmp_path, monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    pygame_state, pygame_images = run_ballbox('pygame', shape, str(tmp_path / 'pygame'))
+    numpy_state, numpy_images = run_ballbox('numpy', shape, str(tmp_path / 'numpy'))
+    np.testing.assert_array_equal(numpy_state, pygame_state)
+    # FrameRenderer draws black, the ball outline (44) and the ball and walls (255), any other value of a pygame
+    # frame belongs to an anti-aliased contact point mark
+    contact_marks = ~np.isin(pygame_images, [0, 44, 255])
+    np.testing.assert_array_equal(numpy_images[~contact_marks], pygame_images[~contact_marks])
+    assert np.all(numpy_images[contact_marks] != pygame_images[contact_marks])
+    # the marks are a few pixels, in the frames where the ball touches a wall
+    marked_frames = np.any(contact_marks, axis=(2, 3))
+    assert 0 < np.mean(marked_frames) < 0.25
+    assert np.max(np.sum(contact_marks, axis=(2, 3))) <= 12
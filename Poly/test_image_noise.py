@@ -0,0 +1,138 @@
+"""
+checks of the chunked add_img_noise and add_img_noise4 against the original per sequence loops, copied below: the
+same random state gives bit for bit the same images and factors and leaves the random state at the same position
+run from this directory: python -m pytest test_image_noise.py
+"""
+import numpy as np
+import pytest
+
+from ImageGen import add_img_noise, add_img_noise4
+
+
+def original_add_img_noise(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0):
+    assert lowlow <= lowup <= uplow <= upup, "Invalid bounds"
+    if len(imgs.shape) < 5:
+        imgs = np.expand_dims(imgs, -1)
+    batch_size, seq_len = imgs.shape[:2]
+    factors = np.zeros([batch_size, seq_len])
+    factors[:, 0] = random.uniform(low=0.0, high=1.0, size=batch_size)
+    for i in range(seq_len - 1):
+        factors[:, i + 1] = np.clip(factors[:, i] + random.uniform(low=-corr, high=corr, size=batch_size), a_min=0.0, a_max=1.0)
+
+    t1 = random.uniform(low=lowlow, high=lowup, size=(batch_size, 1))
+    t2 = random.uniform(low=uplow, high=upup, size=(batch_size, 1))
+
+    factors = (factors - t1) / (t2 - t1)
+    factors = np.clip(factors, a_min=0.0, a_max=1.0)
+    factors = np.reshape(factors, list(factors.shape) + [1, 1, 1])
+    factors[:, :first_n_clean] = 1.0
+    noisy_imgs = []
+
+    for i in range(batch_size):
+        if imgs.dtype == np.uint8:
+            noise = random.uniform(low=0.0, high=255, size=imgs.shape[1:])
+            noisy_imgs.append((factors[i] * imgs[i] + (1 - factors[i]) * noise).astype(np.uint8))
+        else:
+            noise = random.uniform(low=0.0, high=1.1, size=imgs.shape[1:])
+            noisy_imgs.append(factors[i] * imgs[i] + (1 - factors[i]) * noise)
+
+    return np.squeeze(np.concatenate([np.expand_dims(n, 0) for n in noisy_imgs], 0)), factors
+
+
+def original_add_img_noise4(imgs, first_n_clean, random, corr=0.2, lowlow=0.0, lowup=0.25, uplow=0.75, upup=1.0):
+    # the uint8 branch, the float branch of the original fails on its pendulum detection
+    half_x = int(imgs.shape[2] / 2)
+    half_y = int(imgs.shape[3] / 2)
+    assert lowlow <= lowup <= uplow <= upup, "Invalid bounds"
+    if len(imgs.shape) < 5:
+        imgs = np.expand_dims(imgs, -1)
+    batch_size, seq_len = imgs.shape[:2]
+    factors = np.zeros([batch_size, seq_len, 4])
+    factors[:, 0] = random.uniform(low=0.0, high=1.0, size=(batch_size, 4))
+    for i in range(seq_len - 1):
+        factors[:, i + 1] = np.clip(factors[:, i] + random.uniform(low=-corr, high=corr, size=(batch_size, 4)), a_min=0.0, a_max=1.0)
+
+    t1 = random.uniform(low=lowlow, high=lowup, size=(batch_size, 1, 4))
+    t2 = random.uniform(low=uplow, high=upup, size=(batch_size, 1, 4))
+
+    factors = (factors - t1) / (t2 - t1)
+    factors = np.clip(factors, a_min=0.0, a_max=1.0)
+    factors = np.reshape(factors, list(factors.shape) + [1, 1, 1])
+    factors[:, :first_n_clean] = 1.0
+    noisy_imgs = []
+    qs = []
+    for i in range(batch_size):
+        qs.append(original_detect_pendulums(imgs[i], half_x, half_y))
+        noise = random.uniform(low=0.0, high=255, size=[4, seq_len, half_x, half_y, imgs.shape[-1]]).astype(np.uint8)
+        curr = np.zeros(imgs.shape[1:], dtype=np.uint8)
+        curr[:, :half_x, :half_y] = (factors[i, :, 0] * imgs[i, :, :half_x, :half_y] + (1 - factors[i, :, 0]) * noise[0]).astype(np.uint8)
+        curr[:, :half_x, half_y:] = (factors[i, :, 1] * imgs[i, :, :half_x, half_y:] + (1 - factors[i, :, 1]) * noise[1]).astype(np.uint8)
+        curr[:, half_x:, :half_y] = (factors[i, :, 2] * imgs[i, :, half_x:, :half_y] + (1 - factors[i, :, 2]) * noise[2]).astype(np.uint8)
+        curr[:, half_x:, half_y:] = (factors[i, :, 3] * imgs[i, :, half_x:, half_y:] + (1 - factors[i, :, 3]) * noise[3]).astype(np.uint8)
+        noisy_imgs.append(curr)
+
+    factors_ext = np.concatenate([np.squeeze(factors), np.zeros([factors.shape[0], factors.shape[1], 1])], -1)
+    q = np.concatenate([np.expand_dims(q, 0) for q in qs], 0)
+    f = np.zeros(q.shape)
+    for i in range(f.shape[0]):
+        for j in range(f.shape[1]):
+            for k in range(3):
+                f[i, j, k] = factors_ext[i, j, q[i, j, k]]
+
+    return np.squeeze(np.concatenate([np.expand_dims(n, 0) for n in noisy_imgs], 0)), f
+
+
+def original_detect_pendulums(imgs, half_x, half_y):
+    qs = [imgs[:, :half_x, :half_y], imgs[:, :half_x, half_y:], imgs[:, half_x:, :half_y], imgs[:, half_x:, half_y:]]
+
+    r_cts = np.array([np.count_nonzero(q[:, :, :, 0] > 5, axis=(-1, -2)) for q in qs]).T
+    g_cts = np.array([np.count_nonzero(q[:, :, :, 1] > 5, axis=(-1, -2)) for q in qs]).T
+    b_cts = np.array([np.count_nonzero(q[:, :, :, 2] > 5, axis=(-1, -2)) for q in qs]).T
+
+    cts = np.concatenate([np.expand_dims(c, 1) for c in [r_cts, g_cts, b_cts]], 1)
+
+    q_max = np.max(cts, -1)
+    q = np.argmax(cts, -1)
+    q[q_max < 10] = 4
+    return q
+
+
+def grey_images(dtype):
+    images = np.random.RandomState(0).uniform(0, 1, (7, 5, 12, 12))
+    return (255 * images).astype(np.uint8) if dtype == np.uint8 else images
+
+
+def pendulum_images():
+    # three color channels with a 4 x 4 blob each in a random quadrant, or none
+    random = np.random.RandomState(1)
+    images = np.zeros((7, 5, 16, 16, 3), dtype=np.uint8)
+    for index in np.ndindex(7, 5, 3):
+        quadrant = random.randint(5)
+        if quadrant < 4:
+            x, y = 8 * (quadrant // 2) + random.randint(5), 8 * (quadrant % 2) + random.randint(5)
+            images[index[:2] + (slice(x, x + 4), slice(y, y + 4), index[2])] = random.randint(6, 256)
+    return images
+
+
+def assert_same_draws(new, original, new_random, original_random):
+    for a, b in zip(new, original):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+    np.testing.assert_array_equal(new_random.uniform(size=3), original_random.uniform(size=3))
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.float64])
+@pytest.mark.parametrize("chunk_size", [None, 1, 3])
+def test_add_img_noise_matches_original(dtype, chunk_size):
+    images = grey_images(dtype)
+    new_random, original_random = np.random.RandomState(2), np.random.RandomState(2)
+    assert_same_draws(add_img_noise(images, 2, new_random, chunk_size=chunk_size),
+                      original_add_img_noise(images, 2, original_random), new_random, original_random)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 3])
+def test_add_img_noise4_matches_original(chunk_size):
+    images = pendulum_images()
+    new_random, original_random = np.random.RandomState(3), np.random.RandomState(3)
+    assert_same_draws(add_img_noise4(images, 1, new_random, chunk_size=chunk_size),
+                      original_add_img_noise4(images, 1, original_random), new_random, original_random)
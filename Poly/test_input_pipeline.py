@@ -0,0 +1,60 @@
+"""
+checks of InputPipeline.batch_dataset against the int(len / batch_size) slicing of the training loops it replaces:
+in order batches are the slices, shuffled batches are reproducible for a fixed seed and an incomplete last batch is
+dropped in both cases
+run from this directory: python -m pytest test_input_pipeline.py
+"""
+import numpy as np
+import pytest
+
+from InputPipeline import batch_dataset, num_batches
+
+num_seqs, batch_size = 23, 5
+
+
+def make_arrays():
+    # every sequence holds its index, so a batch tells which sequences it was taken from
+    obs = np.arange(num_seqs, dtype=np.float32)[:, None, None] * np.ones((1, 4, 3), dtype=np.float32)
+    targets = np.arange(num_seqs, dtype=np.int64)[:, None] * np.ones((1, 4), dtype=np.int64)
+    return obs, targets
+
+
+def sequence_indices(dataset):
+    batches = [(obs.numpy(), targets.numpy()) for obs, targets in dataset]
+    for obs, targets in batches:
+        np.testing.assert_array_equal(obs[:, 0, 0], targets[:, 0])
+    return [targets[:, 0] for _, targets in batches]
+
+
+@pytest.mark.parametrize("memory_mapped", [False, True])
+def test_in_order_batches_are_the_slices(memory_mapped, tmp_path):
+    obs, targets = make_arrays()
+    if memory_mapped:
+        np.save(str(tmp_path / "obs.npy"), obs)
+        obs = np.load(str(tmp_path / "obs.npy"), mmap_mode="r")
+    batches = list(batch_dataset(obs, targets, batch_size))
+    assert len(batches) == num_batches(num_seqs, batch_size) == int(num_seqs / batch_size)
+    for i, (batch_obs, batch_targets) in enumerate(batches):
+        np.testing.assert_array_equal(batch_obs.numpy(), obs[i * batch_size:(i + 1) * batch_size])
+        np.testing.assert_array_equal(batch_targets.numpy(), targets[i * batch_size:(i + 1) * batch_size])
+
+
+def test_shuffled_batches_are_reproducible_for_a_seed():
+    obs, targets = make_arrays()
+    first = sequence_indices(batch_dataset(obs, targets, batch_size, shuffle=True, seed=4))
+    second = sequence_indices(batch_dataset(obs, targets, batch_size, shuffle=True, seed=4))
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+    assert not all(np.array_equal(a, b) for a, b in
+                   zip(first, sequence_indices(batch_dataset(obs, targets, batch_size, shuffle=True, seed=5))))
+
+
+def test_shuffled_batches_drop_the_remainder_and_reshuffle():
+    obs, targets = make_arrays()
+    dataset = batch_dataset(obs, targets, batch_size, shuffle=True, seed=4)
+    epochs = [sequence_indices(dataset) for _ in range(2)]
+    for epoch in epochs:
+        assert len(epoch) == int(num_seqs / batch_size) and all(len(batch) == batch_size for batch in epoch)
+        # no sequence is drawn twice in an epoch
+        assert len(np.unique(np.concatenate(epoch))) == len(epoch) * batch_size
+    assert not all(np.array_equal(a, b) for a, b in zip(*epochs))
@@ -0,0 +1,43 @@
+"""
+checks of PiSSMTransitionCell._masked_update against the original per sequence selection, copied below: valid
+observations give the posterior, invalid ones keep the prior
+run from this directory: python -m pytest test_masked_update.py
+"""
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from PiSSMTransitionCell import PiSSMTransitionCell
+
+lsd, lod, batch = 4, 2, 6
+
+
+def original_selection(obs_valid, posterior_mean, prior_mean, posterior_covar_vector, prior_covar):
+    masked_mean = tf.squeeze(tf.convert_to_tensor([tf.where(obs_valid[i], posterior_mean[i], prior_mean[i]) for i in range(len(obs_valid))],
+                             dtype=tf.float32))
+    masked_covar = tf.convert_to_tensor([tf.where(obs_valid[i], posterior_covar_vector[i], prior_covar[i]) for i in range(len(obs_valid))],
+                             dtype=tf.float32)
+    return masked_mean, masked_covar
+
+
+@pytest.mark.parametrize("valid", [[True, False, True, True, False, False], [True] * batch, [False] * batch])
+def test_masked_update_matches_original_selection(valid):
+    cell = PiSSMTransitionCell(lsd, lod, number_of_basis=2, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                               init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=False, never_invalid=False)
+    cell.build([None, 2 * lod + 1])
+    random = np.random.RandomState(0)
+    cell.H_matrix = tf.constant(random.randn(batch, lod, lsd), tf.float32)
+    factors = random.randn(batch, lsd, lsd)
+    prior_mean = tf.constant(random.randn(batch, lsd), tf.float32)
+    prior_covar = tf.constant((factors @ factors.transpose(0, 2, 1)).reshape(batch, -1), tf.float32)
+    obs_mean = tf.constant(random.randn(batch, lod), tf.float32)
+    obs_covar = tf.constant(random.uniform(0.5, 1.5, (batch, lod)), tf.float32)
+    KG = tf.constant(0.3 * random.randn(batch, lsd, lod), tf.float32)
+    obs_valid = tf.constant(valid)
+
+    masked_mean, masked_covar = cell._masked_update(prior_mean, prior_covar, obs_mean, obs_covar, obs_valid, KG)
+    posterior_mean, posterior_covar = cell._update(prior_mean, prior_covar, obs_mean, obs_covar, KG)
+    original_mean, original_covar = original_selection(obs_valid, posterior_mean, prior_mean, posterior_covar, prior_covar)
+    np.testing.assert_array_equal(masked_mean.numpy(), original_mean.numpy())
+    np.testing.assert_array_equal(masked_covar.numpy(), original_covar.numpy())
+    np.testing.assert_array_equal(masked_mean.numpy()[~np.array(valid)], prior_mean.numpy()[~np.array(valid)])
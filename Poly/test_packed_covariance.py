@@ -0,0 +1,98 @@
+"""
+checks of the packed symmetric covariances (packed_covar): packing is lossless for symmetric matrices, and a packed
+cell whose gain network sees the same weighted sum of covariance entries filters and smooths like the dense cell
+run from this directory: python -m pytest test_packed_covariance.py
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras as k
+
+from GINSmoothCell import PiSSMSmoothingCell
+from PiSSMTransitionCell import PiSSMTransitionCell, pack_covar, pack_input, packed_covar_size, unpack_covar
+
+lsd, lod, batch, T = 4, 2, 3, 5
+
+
+def random_covariances(random, shape):
+    factors = random.randn(*shape, lsd, lsd)
+    return factors @ np.swapaxes(factors, -1, -2) + np.eye(lsd)
+
+
+def packed_weight(dense_weight):
+    # rows of the upper triangle entries, off-diagonal entries stand for both of their symmetric entries
+    rows, cols = np.triu_indices(lsd)
+    covar_rows = dense_weight[rows * lsd + cols] + np.where((rows != cols)[:, None], dense_weight[cols * lsd + rows], 0)
+    return np.concatenate([covar_rows, dense_weight[lsd * lsd:]], 0)
+
+
+def copy_weights(dense, packed):
+    assert len(dense.weights) == len(packed.weights)
+    for dense_weight, packed_weight_variable in zip(dense.weights, packed.weights):
+        value = dense_weight.numpy()
+        if dense_weight is dense.PrevWeightKG:
+            value = packed_weight(value)
+        packed_weight_variable.assign(value)
+
+
+def test_pack_unpack_round_trip():
+    covariances = random_covariances(np.random.RandomState(0), [batch]).astype(np.float32)
+    packed = pack_covar(tf.constant(covariances), lsd)
+    assert packed.shape == (batch, packed_covar_size(lsd))
+    np.testing.assert_array_equal(unpack_covar(packed, lsd).numpy(), covariances)
+
+
+def test_packed_filter_matches_dense():
+    random = np.random.RandomState(1)
+    inputs = pack_input(tf.constant(random.randn(batch, T, lod), tf.float32),
+                        tf.constant(random.uniform(0.5, 1.5, (batch, T, lod)), tf.float32),
+                        tf.ones([batch, T, 1]))
+    outputs = []
+    for packed_covar in [False, True]:
+        cell = PiSSMTransitionCell(lsd, lod, number_of_basis=2, init_kf_matrices=0.05, init_Q_matrices=0.05,
+                                   init_KF_matrices=0.1, Qnetwork="Xmlp", USE_CONV=False, never_invalid=True,
+                                   packed_covar=packed_covar)
+        cell.basis_selection = "expected"
+        rnn = k.layers.RNN(cell, return_sequences=True)
+        rnn(inputs)
+        if packed_covar:
+            copy_weights(dense_cell, cell)
+        else:
+            dense_cell = cell
+        outputs.append(rnn(inputs))
+    (dense_mean, dense_covar, _, dense_prior_covar, _), (mean, covar, _, prior_covar, _) = outputs
+    np.testing.assert_allclose(mean.numpy(), dense_mean.numpy(), rtol=1e-4, atol=1e-4)
+    for dense_c, packed_c in [(dense_covar, covar), (dense_prior_covar, prior_covar)]:
+        assert packed_c.shape[-1] == packed_covar_size(lsd)
+        np.testing.assert_allclose(unpack_covar(tf.reshape(packed_c, [-1, packed_covar_size(lsd)]), lsd).numpy(),
+                                   tf.reshape(dense_c, [-1, lsd, lsd]).numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_packed_smoother_matches_dense():
+    random = np.random.RandomState(2)
+    filt_covar, prior_covar = random_covariances(random, [batch, T]), random_covariances(random, [batch, T])
+    transition_matrix = np.eye(lsd) + 0.1 * random.randn(batch, T, lsd, lsd)
+    filt_mean, prior_mean, smooth_mean_init = random.randn(batch, T, lsd), random.randn(batch, T, lsd), random.randn(batch, lsd)
+    smooth_covar_init = random_covariances(random, [batch])
+
+    outputs = []
+    for packed_covar in [False, True]:
+        def covar(c):
+            c = tf.constant(c.reshape(-1, lsd, lsd), tf.float32)
+            c = pack_covar(c, lsd) if packed_covar else tf.reshape(c, [-1, lsd * lsd])
+            return tf.reshape(c, [batch, -1, c.shape[-1]])
+        cell = PiSSMSmoothingCell(lsd, lod, init_kf_matrices=0.05, init_KF_matrices=0.05, USE_CONV=False,
+                                  packed_covar=packed_covar)
+        inputs = (tf.constant(filt_mean, tf.float32), covar(filt_covar), tf.constant(prior_mean, tf.float32),
+                  covar(prior_covar), tf.constant(transition_matrix, tf.float32))
+        initial_state = cell.pack_initial_state(tf.constant(smooth_mean_init, tf.float32), covar(smooth_covar_init)[:, 0])
+        rnn = k.layers.RNN(cell, return_sequences=True)
+        rnn(inputs, initial_state=initial_state)
+        if packed_covar:
+            copy_weights(dense_cell, cell)
+        else:
+            dense_cell = cell
+        outputs.append(rnn(inputs, initial_state=initial_state))
+    (dense_mean, dense_covar), (mean, covar) = outputs
+    np.testing.assert_allclose(mean.numpy(), dense_mean.numpy(), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(unpack_covar(tf.reshape(covar, [-1, packed_covar_size(lsd)]), lsd).numpy(),
+                               tf.reshape(dense_covar, [-1, lsd, lsd]).numpy(), rtol=1e-4, atol=1e-4)
@@ -0,0 +1,91 @@
+"""
+checks of PiSSMSmoothingCell.smooth_parallel against the sequential smoothing steps run with the same gains
+(_parallel_J). The steps are affine, so the scan gives the same means. The positive diagonal correction is not
+affine, the scan applies it once after the recursion, so the covariances agree (rtol 1e-3, atol 1e-2 on entries of
+order 100) only where the correction is the identity. Against the RNN layer, whose J gru is recurrent, the means
+differ as well
+run from this directory: python -m pytest test_parallel_smoothing.py
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras as k
+
+from GINSmoothCell import PiSSMSmoothingCell
+
+lsd, lod, batch, T = 3, 2, 2, 6
+
+
+def make_cell(correction_bias, gain_scale=1.):
+    cell = PiSSMSmoothingCell(lsd, lod, init_kf_matrices=0.05, init_KF_matrices=0.05, USE_CONV=False)
+    cell.build([[None, lsd]])
+    cell.GRUJ.build([None, 2 * cell.GRUJunit])
+    cell.LastWeightKG.assign(gain_scale * cell.LastWeightKG)
+    # identity weights, with correction_bias=-2 the elu+1 correction leaves diagonals above 2 unchanged
+    cell._layer_covar_gru.build([None, lsd])
+    cell._layer_covar_gru.set_weights([np.eye(lsd, dtype=np.float32), np.full(lsd, correction_bias, dtype=np.float32)])
+    return cell
+
+
+def random_inputs(seed):
+    # time reversed filter outputs, covariances large enough that every smoothed diagonal stays above 2
+    random = np.random.RandomState(seed)
+    factors = random.randn(batch, T, lsd, lsd)
+    filt_covar = 100 * (factors @ np.swapaxes(factors, -1, -2) + np.eye(lsd))
+    transition_matrix = np.eye(lsd) + 0.1 * random.randn(batch, T, lsd, lsd)
+    prior_covar = transition_matrix @ filt_covar @ np.swapaxes(transition_matrix, -1, -2) + 10 * np.eye(lsd)
+    filt_mean = random.randn(batch, T, lsd)
+    prior_mean = np.squeeze(transition_matrix @ filt_mean[..., None], -1)
+    smooth_mean_init = random.randn(batch, lsd)
+    smooth_covar_init = 100 * np.eye(lsd)[None].repeat(batch, 0)
+    inputs = [filt_mean, filt_covar.reshape(batch, T, -1), prior_mean, prior_covar.reshape(batch, T, -1),
+              transition_matrix]
+    return (tf.constant(smooth_mean_init, tf.float32), tf.constant(smooth_covar_init.reshape(batch, -1), tf.float32),
+            tuple(tf.constant(x, tf.float32) for x in inputs))
+
+
+def smooth_sequential(cell, smooth_mean_init, smooth_covar_init, inputs):
+    # the smoothing steps of the RNN cell, one at a time, with the gains of the parallel smoother
+    filt_mean, filt_covar, prior_mean, prior_covar, transition_matrix = inputs
+    J = tf.reshape(cell._parallel_J(tf.reshape(prior_covar, [-1, lsd * lsd])), [batch, T, lsd, lsd])
+    smooth_mean, smooth_covar = smooth_mean_init, smooth_covar_init
+    means, covars = [], []
+    for t in range(T):
+        smooth_mean, smooth_covar = cell._update(smooth_mean, smooth_covar, filt_mean[:, t], filt_covar[:, t],
+                                                 prior_mean[:, t], prior_covar[:, t], transition_matrix[:, t], J[:, t])
+        means.append(smooth_mean.numpy())
+        covars.append(smooth_covar.numpy())
+    return np.stack(means, 1), np.stack(covars, 1)
+
+
+def smooth_both(correction_bias, seed, gain_scale=1.):
+    cell = make_cell(correction_bias, gain_scale)
+    smooth_mean_init, smooth_covar_init, inputs = random_inputs(seed)
+    sequential = smooth_sequential(cell, smooth_mean_init, smooth_covar_init, inputs)
+    parallel = cell.smooth_parallel(smooth_mean_init, smooth_covar_init, inputs)
+    return sequential, [x.numpy() for x in parallel]
+
+
+def test_parallel_means_match_sequential():
+    (seq_mean, _), (par_mean, _) = smooth_both(0., 0)
+    np.testing.assert_allclose(par_mean, seq_mean, rtol=1e-4, atol=1e-3)
+
+
+def test_parallel_covariances_match_sequential_without_correction():
+    (_, seq_covar), (_, par_covar) = smooth_both(-2., 1)
+    seq_diag = np.diagonal(seq_covar.reshape(batch, T, lsd, lsd), axis1=-2, axis2=-1)
+    assert np.all(seq_diag > 2)
+    np.testing.assert_allclose(par_covar, seq_covar, rtol=1e-3, atol=1e-2)
+
+
+def test_parallel_covariances_differ_from_sequential_with_correction():
+    # the correction adds 10 to every diagonal, the sequential smoother carries it back through J at every step
+    (_, seq_covar), (_, par_covar) = smooth_both(8., 2, gain_scale=30.)
+    assert not np.allclose(par_covar, seq_covar, rtol=1e-2, atol=1e-1)
+
+
+def test_parallel_means_differ_from_recurrent_gains():
+    cell = make_cell(0., gain_scale=30.)
+    smooth_mean_init, smooth_covar_init, inputs = random_inputs(3)
+    recurrent_mean, _ = k.layers.RNN(cell, return_sequences=True)(inputs, initial_state=cell.pack_initial_state(smooth_mean_init, smooth_covar_init))
+    parallel_mean, _ = cell.smooth_parallel(smooth_mean_init, smooth_covar_init, inputs)
+    assert not np.allclose(parallel_mean.numpy(), recurrent_mean.numpy(), rtol=1e-2, atol=1e-2)
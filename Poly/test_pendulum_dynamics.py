@@ -0,0 +1,89 @@
+"""
+checks of the in place pendulum integration against the original substep loops, copied below: with the euler
+integrator the states are bit for bit the same under the same random state. The rk4 integrator with one substep is
+checked against a fine rk4 solution
+run from this directory: python -m pytest test_pendulum_dynamics.py
+"""
+import numpy as np
+import pytest
+
+from PendulumData import Pendulum
+
+
+def original_transition_function(self, states, actions):
+    nSteps = self.dt / self.sim_dt
+
+    if nSteps != np.round(nSteps):
+        print('Warning from Pendulum: dt does not match up')
+        nSteps = np.round(nSteps)
+
+    c = self.g * self.length * self.mass / self.inertia
+    for i in range(0, int(nSteps)):
+        velNew = states[..., 1:2] + self.sim_dt * (c * np.sin(states[..., 0:1])
+                                                 + actions / self.inertia
+                                                 - states[..., 1:2] * self.friction)
+        states = np.concatenate((states[..., 0:1] + self.sim_dt * velNew, velNew), axis=1)
+    return states
+
+
+def original_kf_transition_function(self, state, noise):
+    nSteps = self.dt / self.sim_dt
+
+    if nSteps != np.round(nSteps):
+        print('Warning from Pendulum: dt does not match up')
+        nSteps = np.round(nSteps)
+
+    c = self.g * self.length * self.mass / self.inertia
+    for i in range(0, int(nSteps)):
+        velNew = state[1] + self.sim_dt * (c * np.sin(state[0]) - state[1] * self.friction)
+        state = np.array([state[0] + self.sim_dt * velNew, velNew])
+    state[0] = state[0] % (2 * np.pi)
+    state[1] = state[1] + noise[1]
+    return state
+
+
+def make_pendulum(**params):
+    pendulum_params = dict(Pendulum.pendulum_default_params(), friction=0.1, **params)
+    return Pendulum(24, Pendulum.OBSERVATION_MODE_LINE, generate_actions=True, transition_noise_std=0.1,
+                    pendulum_params=pendulum_params, seed=0)
+
+
+def test_euler_path_matches_original(monkeypatch):
+    imgs, targets, states, _ = make_pendulum().sample_data_set(8, 12, full_targets=True, seed=1)
+    monkeypatch.setattr(Pendulum, "_transition_function", original_transition_function)
+    original = make_pendulum().sample_data_set(8, 12, full_targets=True, seed=1)
+    np.testing.assert_array_equal(states, original[2])
+    np.testing.assert_array_equal(targets, original[1])
+    np.testing.assert_array_equal(imgs, original[0])
+
+
+def test_kf_transition_matches_original():
+    pendulum = make_pendulum()
+    random = np.random.RandomState(2)
+    for state, noise in zip(random.uniform(-3, 3, (20, 2)), random.normal(size=(20, 2))):
+        np.testing.assert_array_equal(pendulum._kf_transition_function(state, noise),
+                                      original_kf_transition_function(pendulum, state.copy(), noise))
+
+
+def test_rk4_single_substep_beats_default_euler():
+    states = np.random.RandomState(3).uniform(0, 2 * np.pi, (50, 2)) - [0, np.pi]
+    actions = np.zeros((50, 1))
+    exact = make_pendulum(integrator=Pendulum.INTEGRATOR_RK4, sim_dt=0.05 / 200)
+    rk4 = make_pendulum(integrator=Pendulum.INTEGRATOR_RK4, sim_dt=0.05)
+    euler = make_pendulum()
+    reference, rk4_states, euler_states = states, states, states
+    for _ in range(10):
+        reference = exact._transition_function(reference, actions)
+        rk4_states = rk4._transition_function(rk4_states, actions)
+        euler_states = euler._transition_function(euler_states, actions)
+    assert np.max(np.abs(rk4_states - reference)) < np.max(np.abs(euler_states - reference))
+
+
+@pytest.mark.parametrize("integrator", [Pendulum.INTEGRATOR_EULER, Pendulum.INTEGRATOR_RK4])
+def test_kf_transition_matches_batched_transition(integrator):
+    pendulum = make_pendulum(integrator=integrator, sim_dt=0.05 / 20)
+    states = np.random.RandomState(4).uniform(-3, 3, (10, 2))
+    batched = pendulum._transition_function(states, np.zeros((10, 1)))
+    single = np.stack([pendulum._kf_transition_function(state, np.zeros(2)) for state in states])
+    np.testing.assert_allclose(single[:, 1], batched[:, 1], rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(single[:, 0], batched[:, 0] % (2 * np.pi), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,28 @@
+"""
+checks of the vectorized Pendulum._generate_images against the PIL reference _generate_single_image it replaces
+run from this directory: python -m pytest test_pendulum_images.py
+"""
+import numpy as np
+import pytest
+
+from PendulumData import Pendulum
+
+
+@pytest.mark.parametrize("observation_mode", [Pendulum.OBSERVATION_MODE_LINE, Pendulum.OBSERVATION_MODE_BALL])
+@pytest.mark.parametrize("img_size", [24, 48])
+def test_images_match_pil(observation_mode, img_size):
+    pendulum = Pendulum(img_size, observation_mode, seed=0)
+    joint_states = np.random.RandomState(1).uniform(0, 2 * np.pi, (300, 1))
+    ts_pos = pendulum._get_task_space_pos(joint_states)
+    images = pendulum._generate_images(ts_pos, chunk_size=128)
+    # the frames are stored as uint8, as _generate_images stores them
+    reference = np.stack([pendulum._generate_single_image(pos) for pos in ts_pos]).astype(np.uint8)
+    np.testing.assert_array_equal(images, reference)
+
+
+def test_images_keep_the_leading_shape():
+    pendulum = Pendulum(24, Pendulum.OBSERVATION_MODE_LINE, seed=0)
+    ts_pos = pendulum._get_task_space_pos(np.random.RandomState(2).uniform(0, 2 * np.pi, (3, 5, 1)))
+    images = pendulum._generate_images(ts_pos)
+    assert images.shape == (3, 5, 24, 24)
+    np.testing.assert_array_equal(images[1, 2], pendulum._generate_single_image(ts_pos[1, 2]).astype(np.uint8))